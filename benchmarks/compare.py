@@ -0,0 +1,50 @@
+"""
+Compare two results files of benchmarks/run.py, e.g. from two versions of lambda_setuptools.
+Exits with 1 if any median got slower than the threshold allows.
+
+    python benchmarks/compare.py before.json after.json --threshold 1.1
+"""
+import argparse
+import json
+import sys
+
+
+def medians(results):
+    """Return {(scenario, command, measurement): median seconds} of a results file"""
+    flat = {}
+    for scenario, result in results['scenarios'].items():
+        for command in ('ldist', 'ldeploy'):
+            for measurement, summary in result.get(command, {}).items():
+                flat[(scenario, command, measurement)] = summary['median']
+    return flat
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark results files')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=1.1,
+                        help='Largest after/before ratio that is not a regression (defaults to 1.1)')
+    args = parser.parse_args(argv)
+
+    with open(args.before) as f:
+        before = medians(json.load(f))
+    with open(args.after) as f:
+        after = medians(json.load(f))
+
+    regressions = 0
+    print('{:<40} {:>10} {:>10} {:>8}'.format('measurement', 'before', 'after', 'ratio'))
+    for key in sorted(set(before) & set(after)):
+        ratio = after[key] / before[key] if before[key] else float('inf')
+        flag = ''
+        if ratio > args.threshold:
+            regressions += 1
+            flag = ' slower'
+        print('{:<40} {:>9.3f}s {:>9.3f}s {:>8.2f}{}'.format('/'.join(key), before[key], after[key], ratio, flag))
+    for key in sorted(set(before) ^ set(after)):
+        print('{:<40} only in {}'.format('/'.join(key), 'before' if key in before else 'after'))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
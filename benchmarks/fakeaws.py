@@ -0,0 +1,493 @@
+"""
+An in-memory stand-in for the AWS APIs used by lupload and ldeploy, with a fixed latency
+injected into every call. Clients emit the same botocore events as real ones, so the
+metrics report of a benchmarked run has its API statistics too.
+"""
+import base64
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+from botocore.hooks import HierarchicalEmitter
+
+ACCOUNT_ID = '123456789012'
+
+
+class _Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class _Paginator(object):
+    def __init__(self, client, operation, page_size):
+        self._client = client
+        self._operation = operation
+        self._page_size = page_size
+
+    def paginate(self, **kwargs):
+        marker = None
+        while True:
+            page = self._client._call(self._operation, dict(kwargs, Marker=marker), self._page_size)
+            yield page
+            marker = page.get('NextMarker')
+            if not marker:
+                return
+
+
+class FakeClient(object):
+    service_name = None
+
+    def __init__(self, aws, region):
+        self._aws = aws
+        self._region = region or 'us-east-1'
+        self.meta = _Namespace(
+            events=HierarchicalEmitter(),
+            service_model=_Namespace(service_name=self.service_name),
+            region_name=self._region
+        )
+
+    def _call(self, operation, params, *args):
+        context = {}
+        model = _Namespace(name=operation)
+        prefix = '{}.{}'.format(self.service_name, operation)
+        self.meta.events.emit('before-parameter-build.' + prefix, params=params, model=model, context=context)
+        time.sleep(self._aws.latency)
+        try:
+            with self._aws.lock:
+                result = getattr(self, '_' + operation)(params, *args)
+        except Exception as e:
+            self.meta.events.emit('after-call-error.' + prefix, exception=e, context=context)
+            raise
+        result.setdefault('ResponseMetadata', {'HTTPStatusCode': 200, 'RetryAttempts': 0})
+        self.meta.events.emit('after-call.' + prefix, http_response=None, parsed=result, model=model,
+                              context=context)
+        return result
+
+    @staticmethod
+    def _error(code, operation, message=''):
+        return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+    @staticmethod
+    def _page(items, marker, page_size):
+        start = int(marker or 0)
+        end = start + page_size
+        return items[start:end], (str(end) if end < len(items) else None)
+
+
+class FakeIAM(FakeClient):
+    service_name = 'iam'
+
+    def get_role(self, **kwargs):
+        return self._call('GetRole', kwargs)
+
+    def _GetRole(self, params):
+        return {'Role': {'RoleName': params['RoleName'],
+                         'Arn': 'arn:aws:iam::{}:role/{}'.format(ACCOUNT_ID, params['RoleName'])}}
+
+
+class FakeSTS(FakeClient):
+    service_name = 'sts'
+
+    def get_caller_identity(self, **kwargs):
+        return self._call('GetCallerIdentity', kwargs)
+
+    def _GetCallerIdentity(self, params):
+        return {'Account': ACCOUNT_ID}
+
+
+class FakeS3(FakeClient):
+    service_name = 's3'
+
+    def head_object(self, **kwargs):
+        return self._call('HeadObject', kwargs)
+
+    def put_object(self, **kwargs):
+        return self._call('PutObject', kwargs)
+
+    def create_multipart_upload(self, **kwargs):
+        return self._call('CreateMultipartUpload', kwargs)
+
+    def upload_part(self, **kwargs):
+        return self._call('UploadPart', kwargs)
+
+    def complete_multipart_upload(self, **kwargs):
+        return self._call('CompleteMultipartUpload', kwargs)
+
+    def abort_multipart_upload(self, **kwargs):
+        return self._call('AbortMultipartUpload', kwargs)
+
+    def _encryption(self, params):
+        """What HEAD reports of the encryption requested by params, keys given as ARNs as S3 does"""
+        encryption = {'ServerSideEncryption': params.get('ServerSideEncryption', 'AES256')}
+        key_id = params.get('SSEKMSKeyId')
+        if key_id:
+            encryption['SSEKMSKeyId'] = key_id if key_id.startswith('arn:') else \
+                'arn:aws:kms:{}:{}:key/{}'.format(self._region, ACCOUNT_ID, key_id)
+        return encryption
+
+    def _HeadObject(self, params):
+        obj = self._aws.objects.get((params['Bucket'], params['Key']))
+        if obj is None:
+            raise self._error('404', 'HeadObject')
+        head = {'ContentLength': len(obj['Body']), 'Metadata': dict(obj['Metadata'])}
+        head.update(obj['Encryption'])
+        return head
+
+    def _PutObject(self, params):
+        body = params['Body']
+        self._aws.objects[(params['Bucket'], params['Key'])] = {
+            'Body': body if isinstance(body, bytes) else body.read(),
+            'Metadata': dict(params.get('Metadata') or {}),
+            'Encryption': self._encryption(params)
+        }
+        return {'ETag': uuid.uuid4().hex}
+
+    def _CreateMultipartUpload(self, params):
+        upload_id = uuid.uuid4().hex
+        self._aws.uploads[upload_id] = {'Metadata': dict(params.get('Metadata') or {}),
+                                        'Encryption': self._encryption(params), 'Parts': {}}
+        return {'UploadId': upload_id}
+
+    def _UploadPart(self, params):
+        self._aws.uploads[params['UploadId']]['Parts'][params['PartNumber']] = bytes(params['Body'])
+        return {'ETag': uuid.uuid4().hex}
+
+    def _CompleteMultipartUpload(self, params):
+        upload = self._aws.uploads.pop(params['UploadId'])
+        self._aws.objects[(params['Bucket'], params['Key'])] = {
+            'Body': b''.join(upload['Parts'][number] for number in sorted(upload['Parts'])),
+            'Metadata': upload['Metadata'],
+            'Encryption': upload['Encryption']
+        }
+        return {'ETag': uuid.uuid4().hex}
+
+    def _AbortMultipartUpload(self, params):
+        self._aws.uploads.pop(params['UploadId'], None)
+        return {}
+
+
+class FakeLambda(FakeClient):
+    service_name = 'lambda'
+
+    def get_paginator(self, operation_name):
+        if operation_name == 'list_functions':
+            return _Paginator(self, 'ListFunctions', 50)
+        if operation_name == 'list_layer_versions':
+            return _Paginator(self, 'ListLayerVersions', 50)
+        raise NotImplementedError(operation_name)
+
+    def list_functions(self, **kwargs):
+        return self._call('ListFunctions', kwargs, 50)
+
+    def get_function_configuration(self, **kwargs):
+        return self._call('GetFunctionConfiguration', kwargs)
+
+    def create_function(self, **kwargs):
+        return self._call('CreateFunction', kwargs)
+
+    def update_function_code(self, **kwargs):
+        return self._call('UpdateFunctionCode', kwargs)
+
+    def update_function_configuration(self, **kwargs):
+        return self._call('UpdateFunctionConfiguration', kwargs)
+
+    def publish_version(self, **kwargs):
+        return self._call('PublishVersion', kwargs)
+
+    def publish_layer_version(self, **kwargs):
+        return self._call('PublishLayerVersion', kwargs)
+
+    def get_policy(self, **kwargs):
+        return self._call('GetPolicy', kwargs)
+
+    def add_permission(self, **kwargs):
+        return self._call('AddPermission', kwargs)
+
+    def remove_permission(self, **kwargs):
+        return self._call('RemovePermission', kwargs)
+
+    def _function(self, name, operation):
+        function = self._aws.functions.get(name.split(':')[-1])
+        if function is None:
+            raise self._error('ResourceNotFoundException', operation, 'Function not found: {}'.format(name))
+        if self._aws.ready_at.get(function['FunctionName'], 0) <= time.time():
+            function['State'] = 'Active'
+            function['LastUpdateStatus'] = 'Successful'
+        return function
+
+    def _writable_function(self, name, operation, update=True):
+        """The function, if Lambda isn't still creating or updating it, starting another update"""
+        function = self._function(name, operation)
+        if function['State'] == 'Pending' or function['LastUpdateStatus'] == 'InProgress':
+            raise self._error('ResourceConflictException', operation,
+                              'The operation cannot be performed at this time. An update is in progress for '
+                              'resource: {}'.format(function['FunctionArn']))
+        if update:
+            self._updating(function)
+        return function
+
+    def _updating(self, function):
+        if self._aws.update_seconds:
+            function['LastUpdateStatus'] = 'InProgress'
+            self._aws.ready_at[function['FunctionName']] = time.time() + self._aws.update_seconds
+
+    def _code_sha256(self, code):
+        if 'ZipFile' in code:
+            body = code['ZipFile']
+        else:
+            body = self._aws.objects[(code['S3Bucket'], code['S3Key'])]['Body']
+        return base64.b64encode(hashlib.sha256(body).digest()).decode('ascii')
+
+    def _ListFunctions(self, params, page_size):
+        functions = [dict(self._function(name, 'ListFunctions')) for name in sorted(self._aws.functions)]
+        page, marker = self._page(functions, params.get('Marker'), page_size)
+        result = {'Functions': page}
+        if marker:
+            result['NextMarker'] = marker
+        return result
+
+    def _GetFunctionConfiguration(self, params):
+        return dict(self._function(params['FunctionName'], 'GetFunctionConfiguration'))
+
+    def _CreateFunction(self, params):
+        if params['FunctionName'] in self._aws.functions:
+            raise self._error('ResourceConflictException', 'CreateFunction', 'Function already exist')
+        function = dict((key, value) for key, value in params.items() if key not in ('Code', 'Publish', 'Tags'))
+        function.update({
+            'FunctionArn': 'arn:aws:lambda:{}:{}:function:{}'.format(self._region, ACCOUNT_ID,
+                                                                     params['FunctionName']),
+            'CodeSha256': self._code_sha256(params['Code']),
+            'Version': '$LATEST',
+            'State': 'Active',
+            'LastUpdateStatus': 'Successful'
+        })
+        self._aws.functions[params['FunctionName']] = function
+        self._updating(function)
+        if self._aws.update_seconds:
+            function['State'] = 'Pending'
+            function['LastUpdateStatus'] = 'Successful'
+        return dict(function)
+
+    def _UpdateFunctionCode(self, params):
+        function = self._writable_function(params['FunctionName'], 'UpdateFunctionCode')
+        function['CodeSha256'] = self._code_sha256(params)
+        return dict(function)
+
+    def _UpdateFunctionConfiguration(self, params):
+        function = self._writable_function(params['FunctionName'], 'UpdateFunctionConfiguration')
+        function.update((key, value) for key, value in params.items() if key != 'FunctionName')
+        return dict(function)
+
+    def _PublishVersion(self, params):
+        function = self._writable_function(params['FunctionName'], 'PublishVersion', update=False)
+        function['PublishedVersions'] = function.get('PublishedVersions', 0) + 1
+        return dict(function, Version=str(function['PublishedVersions']))
+
+    def _ListLayerVersions(self, params, page_size):
+        versions = list(reversed(self._aws.layers.get(params['LayerName'], [])))
+        page, marker = self._page(versions, params.get('Marker'), page_size)
+        result = {'LayerVersions': page}
+        if marker:
+            result['NextMarker'] = marker
+        return result
+
+    def _PublishLayerVersion(self, params):
+        versions = self._aws.layers.setdefault(params['LayerName'], [])
+        version = {
+            'LayerVersionArn': 'arn:aws:lambda:{}:{}:layer:{}:{}'.format(self._region, ACCOUNT_ID,
+                                                                        params['LayerName'], len(versions) + 1),
+            'Version': len(versions) + 1,
+            'Description': params.get('Description', '')
+        }
+        versions.append(version)
+        return dict(version)
+
+    def _GetPolicy(self, params):
+        self._function(params['FunctionName'], 'GetPolicy')
+        statements = self._aws.policies.get(params['FunctionName'].split(':')[-1])
+        if not statements:
+            raise self._error('ResourceNotFoundException', 'GetPolicy', 'No policy is associated')
+        return {'Policy': json.dumps({'Version': '2012-10-17', 'Statement': list(statements.values())})}
+
+    def _AddPermission(self, params):
+        name = params['FunctionName'].split(':')[-1]
+        function = self._function(name, 'AddPermission')
+        if function['State'] == 'Pending':
+            raise self._error('ResourceConflictException', 'AddPermission', 'The function is being created')
+        statements = self._aws.policies.setdefault(name, {})
+        if params['StatementId'] in statements:
+            raise self._error('ResourceConflictException', 'AddPermission', 'The statement id already exists')
+        statements[params['StatementId']] = {
+            'Sid': params['StatementId'],
+            'Effect': 'Allow',
+            'Principal': {'Service': params['Principal']},
+            'Action': params['Action'],
+            'Resource': function['FunctionArn'],
+            'Condition': {'ArnLike': {'AWS:SourceArn': params.get('SourceArn')}}
+        }
+        return {'Statement': statements[params['StatementId']]}
+
+    def _RemovePermission(self, params):
+        name = params['FunctionName'].split(':')[-1]
+        statements = self._aws.policies.get(name, {})
+        if params['StatementId'] not in statements:
+            raise self._error('ResourceNotFoundException', 'RemovePermission', 'Statement not found')
+        del statements[params['StatementId']]
+        return {}
+
+
+class FakeAPIGateway(FakeClient):
+    service_name = 'apigateway'
+
+    def get_paginator(self, operation_name):
+        if operation_name == 'get_rest_apis':
+            return _Paginator(self, 'GetRestApis', 25)
+        raise NotImplementedError(operation_name)
+
+    def import_rest_api(self, **kwargs):
+        return self._call('ImportRestApi', kwargs)
+
+    def put_rest_api(self, **kwargs):
+        return self._call('PutRestApi', kwargs)
+
+    def get_rest_api(self, **kwargs):
+        return self._call('GetRestApi', kwargs)
+
+    def create_deployment(self, **kwargs):
+        return self._call('CreateDeployment', kwargs)
+
+    def get_stage(self, **kwargs):
+        return self._call('GetStage', kwargs)
+
+    def get_deployment(self, **kwargs):
+        return self._call('GetDeployment', kwargs)
+
+    def tag_resource(self, **kwargs):
+        return self._call('TagResource', kwargs)
+
+    def _api(self, rest_api_id, operation):
+        api = self._aws.apis.get(rest_api_id)
+        if api is None:
+            raise self._error('NotFoundException', operation, 'Invalid API identifier specified')
+        return api
+
+    def _summary(self, api):
+        return dict((key, value) for key, value in api.items() if key not in ('body', 'stages', 'deployments'))
+
+    def _GetRestApis(self, params, page_size):
+        apis = [self._summary(self._aws.apis[rest_api_id]) for rest_api_id in sorted(self._aws.apis)]
+        page, position = self._page(apis, params.get('position') or params.get('Marker'), page_size)
+        result = {'items': page}
+        if position:
+            result['position'] = position
+            result['NextMarker'] = position
+        return result
+
+    def _ImportRestApi(self, params):
+        body = json.loads(params['body'])
+        rest_api_id = uuid.uuid4().hex[:10]
+        self._aws.apis[rest_api_id] = {
+            'id': rest_api_id,
+            'name': body.get('info', {}).get('title', rest_api_id),
+            'createdDate': time.time(),
+            'tags': {},
+            'body': params['body'],
+            'stages': {},
+            'deployments': {}
+        }
+        return self._summary(self._aws.apis[rest_api_id])
+
+    def _PutRestApi(self, params):
+        api = self._api(params['restApiId'], 'PutRestApi')
+        if params.get('mode') == 'merge':
+            body = json.loads(api['body'])
+            update = json.loads(params['body'])
+            body.setdefault('paths', {}).update(update.get('paths', {}))
+            body.setdefault('definitions', {}).update(update.get('definitions', {}))
+            api['body'] = json.dumps(body)
+        else:
+            api['body'] = params['body']
+        return self._summary(api)
+
+    def _GetRestApi(self, params):
+        return self._summary(self._api(params['restApiId'], 'GetRestApi'))
+
+    def _CreateDeployment(self, params):
+        api = self._api(params['restApiId'], 'CreateDeployment')
+        deployment_id = uuid.uuid4().hex[:6]
+        api['deployments'][deployment_id] = {'id': deployment_id, 'description': params.get('description', ''),
+                                             'body': api['body']}
+        if params.get('stageName'):
+            api['stages'][params['stageName']] = {'stageName': params['stageName'], 'deploymentId': deployment_id}
+        self._aws.deployments.append((params['restApiId'], params.get('stageName'), deployment_id))
+        return {'id': deployment_id}
+
+    def _GetStage(self, params):
+        stage = self._api(params['restApiId'], 'GetStage')['stages'].get(params['stageName'])
+        if stage is None:
+            raise self._error('NotFoundException', 'GetStage', 'Invalid Stage identifier specified')
+        return dict(stage)
+
+    def _GetDeployment(self, params):
+        deployment = self._api(params['restApiId'], 'GetDeployment')['deployments'].get(params['deploymentId'])
+        if deployment is None:
+            raise self._error('NotFoundException', 'GetDeployment', 'Invalid Deployment identifier specified')
+        return dict((key, value) for key, value in deployment.items() if key != 'body')
+
+    def _TagResource(self, params):
+        rest_api_id = params['resourceArn'].rsplit('/', 1)[-1]
+        self._api(rest_api_id, 'TagResource')['tags'].update(params['tags'])
+        return {}
+
+
+class FakeAWS(object):
+    """
+    The state shared by all the fake clients, the latency of every call in seconds, and how long a
+    function stays Pending or InProgress after a write
+    """
+
+    clients = {
+        'iam': FakeIAM,
+        'sts': FakeSTS,
+        's3': FakeS3,
+        'lambda': FakeLambda,
+        'apigateway': FakeAPIGateway
+    }
+
+    def __init__(self, latency=0.05, update_seconds=0.0):
+        self.latency = latency
+        # How long Lambda is busy with a function after creating or updating it, as it is in AWS
+        self.update_seconds = update_seconds
+        self.ready_at = {}
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        self.functions = {}
+        self.layers = {}
+        self.policies = {}
+        self.apis = {}
+        self.deployments = []
+
+
+class FakeClientFactory(object):
+    """A lambda_setuptools.clients.ClientFactory look-alike handing out FakeAWS clients"""
+
+    def __init__(self, aws, metrics=None):
+        self._aws = aws
+        self._metrics = metrics
+        self._clients = {}
+
+    def reserve_connections(self, count):
+        pass
+
+    def client(self, service_name, region=None):
+        key = (service_name, region)
+        if key not in self._clients:
+            client = FakeAWS.clients[service_name](self._aws, region)
+            if self._metrics is not None:
+                self._metrics.instrument_client(client)
+            self._clients[key] = client
+        return self._clients[key]
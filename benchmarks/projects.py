@@ -0,0 +1,146 @@
+"""
+Synthetic projects for the benchmarks: a package of generated modules plus a handlers module
+with one handler per lambda_function entry, and a swagger specification mapping operations to
+the handlers. Everything is derived from a seed so the same parameters give the same project.
+"""
+import os
+import random
+
+import yaml
+
+PACKAGE = 'benchapp'
+MODULES_PER_PACKAGE = 100
+
+SETUP_TEMPLATE = '''from setuptools import setup, find_packages
+
+setup(
+    name={name!r},
+    version='1.0.0',
+    package_dir={{'': 'src'}},
+    packages=find_packages('src'),
+    lambda_function={lambda_functions!r},
+    lambda_config={{
+        'Runtime': 'python3.6',
+        'Timeout': 60,
+        'MemorySize': 128,
+        'Publish': True
+    }}
+)
+'''
+
+HANDLER_TEMPLATE = '''
+
+def handler_{index}(event, context):
+    return {{'statusCode': 200, 'body': {index!r}}}
+'''
+
+WORDS = ('lambda', 'setup', 'tools', 'deploy', 'build', 'zip', 'layer', 'function', 'handler', 'event',
+         'context', 'region', 'bucket', 'stage', 'gateway', 'swagger', 'operation', 'version', 'role', 'policy')
+
+
+class Project(object):
+    """A generated project, and what ldist will call its lambda functions"""
+
+    def __init__(self, root, name, files, size, functions, paths):
+        self.root = root
+        self.name = name
+        self.files = files
+        self.size = size
+        self.functions = functions
+        self.paths = paths
+        self.swagger_path = os.path.join(root, 'swagger.yaml')
+        self.function_module = '{}_function'.format(name.replace('-', '_').replace('.', '_'))
+        self.lambda_function_targets = dict(
+            ('operation_{}'.format(i), ('{}.handlers'.format(PACKAGE), 'handler_{}'.format(i)))
+            for i in range(functions)
+        )
+        self.lambda_function_names = dict(
+            (name, '{}.{}'.format(self.function_module, function))
+            for name, (_, function) in self.lambda_function_targets.items()
+        )
+        self._revision = 0
+
+    @property
+    def dist_path(self):
+        return os.path.join(self.root, 'dist', '{}-1.0.0.zip'.format(self.name))
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.root, 'dist', '{}-1.0.0.manifest.json'.format(self.name))
+
+    def touch(self):
+        """Change one source file, as an edit between two builds would"""
+        self._revision += 1
+        with open(os.path.join(self.root, 'src', PACKAGE, '__init__.py'), 'w') as f:
+            f.write('REVISION = {}\n'.format(self._revision))
+
+
+def _module_source(rng, size):
+    lines = ['"""Generated module."""', '', 'DATA = (']
+    length = sum(len(line) + 1 for line in lines) + 2
+    while length < size:
+        line = '    {!r},'.format(' '.join(rng.choice(WORDS) for _ in range(8)))
+        lines.append(line)
+        length += len(line) + 1
+    lines.append(')')
+    return '\n'.join(lines) + '\n'
+
+
+def _swagger(project):
+    paths = {}
+    for i in range(project.paths):
+        operation = {
+            'operationId': 'operation_{}'.format(i),
+            'produces': ['application/json'],
+            'responses': {'200': {'description': 'OK'}}
+        }
+        if i < project.functions:
+            operation['x-amazon-apigateway-integration'] = {
+                'type': 'aws_proxy',
+                'httpMethod': 'POST',
+                'uri': 'arn:aws:apigateway:us-east-1:lambda:path/2015-03-31/functions/operation_{}/invocations'.format(i)
+            }
+        paths['/resource_{}'.format(i)] = {'get': operation}
+    return {
+        'swagger': '2.0',
+        'info': {'title': project.name, 'version': '1.0.0'},
+        'paths': paths
+    }
+
+
+def generate_project(root, name, files, size, functions, paths, seed=0):
+    """
+    Write a project of about files source files and size bytes, with functions lambda_function
+    entries and a swagger specification of paths operations, into root
+    """
+    project = Project(root, name, files, size, functions, paths)
+    rng = random.Random(seed)
+    package_dir = os.path.join(root, 'src', PACKAGE)
+    os.makedirs(package_dir)
+
+    with open(os.path.join(root, 'setup.py'), 'w') as f:
+        f.write(SETUP_TEMPLATE.format(
+            name=name,
+            lambda_functions=['{}.{}:{}'.format(module, function, name)
+                              for name, (module, function) in sorted(project.lambda_function_targets.items())]
+        ))
+    project.touch()
+    with open(os.path.join(package_dir, 'handlers.py'), 'w') as f:
+        f.write('"""Generated handlers."""\n')
+        for i in range(functions):
+            f.write(HANDLER_TEMPLATE.format(index=i))
+
+    # __init__.py and handlers.py count towards files
+    module_count = max(files - 2, 0)
+    module_size = size // max(module_count, 1)
+    for i in range(module_count):
+        subpackage_dir = os.path.join(package_dir, 'modules_{}'.format(i // MODULES_PER_PACKAGE))
+        if not os.path.isdir(subpackage_dir):
+            os.makedirs(subpackage_dir)
+            open(os.path.join(subpackage_dir, '__init__.py'), 'w').close()
+        with open(os.path.join(subpackage_dir, 'module_{}.py'.format(i)), 'w') as f:
+            f.write(_module_source(rng, module_size))
+
+    with open(project.swagger_path, 'w') as f:
+        yaml.safe_dump(_swagger(project), f, default_flow_style=False)
+    return project
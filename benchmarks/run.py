@@ -0,0 +1,230 @@
+"""
+Benchmark ldist and ldeploy on synthetic projects and write the results as JSON.
+
+ldist runs end to end in a subprocess: with an empty build cache, with a warm cache and
+nothing changed, and with a warm cache after a source file changed. ldeploy runs in process
+against an in-memory AWS stand-in with a fixed latency per API call, where functions stay busy
+for --update-ms after every write as they do in Lambda: creating every function,
+redeploying the unchanged build, and deploying the changed build.
+
+lambda_setuptools must be installed (pip install -e .) for setup.py to know its commands;
+the code benchmarked is always the code in this checkout.
+
+    python benchmarks/run.py --scenario small --scenario medium --output results.json
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(os.path.dirname(HERE), 'src')
+sys.path.insert(0, SRC)
+
+from setuptools.dist import Distribution  # noqa: E402
+
+from lambda_setuptools.clients import set_client_factory  # noqa: E402
+from lambda_setuptools.ldeploy import LDeploy, validate_lambda_config  # noqa: E402
+from lambda_setuptools.ldist import LDist  # noqa: E402
+from lambda_setuptools.lupload import LUpload  # noqa: E402
+from lambda_setuptools.metrics import get_metrics  # noqa: E402
+
+from fakeaws import FakeAWS, FakeClientFactory  # noqa: E402
+from projects import generate_project  # noqa: E402
+
+MiB = 1024 * 1024
+
+# name: (source files, total source bytes, lambda_function entries, swagger paths)
+SCENARIOS = collections.OrderedDict([
+    ('small', (100, 1 * MiB, 2, 10)),
+    ('medium', (5000, 20 * MiB, 20, 100)),
+    ('large', (50000, 100 * MiB, 50, 500)),
+])
+
+
+def _summary(samples):
+    ordered = sorted(samples)
+    return {
+        'samples': samples,
+        'min': ordered[0],
+        'median': ordered[len(ordered) // 2]
+    }
+
+
+def run_ldist(project, wheelhouse, report_path, no_build_cache=False):
+    """Run setup.py ldist in project, returning its wall time and metrics report"""
+    args = [sys.executable, 'setup.py', '-q', 'ldist', '--reproducible', '--wheelhouse', wheelhouse,
+            '--metrics-report', report_path]
+    if no_build_cache:
+        args.append('--no-build-cache')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [SRC, env.get('PYTHONPATH')]))
+    start = time.time()
+    process = subprocess.Popen(args, cwd=project.root, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    seconds = time.time() - start
+    if process.returncode != 0:
+        raise RuntimeError('ldist failed in {}:\n{}\n{}'.format(project.root, stdout.decode(), stderr.decode()))
+    with open(report_path) as f:
+        return seconds, json.load(f)
+
+
+def keep_artifact(project, directory, name):
+    """Copy the dist ldist just built out of the way of the next build, returning its path and CodeSha256"""
+    path = os.path.join(directory, name)
+    shutil.copy(project.dist_path, path)
+    with open(project.manifest_path) as f:
+        return path, json.load(f)['CodeSha256']
+
+
+def run_ldeploy(project, aws, artifact, code_sha256, deploy_workers):
+    """Deploy artifact to aws with ldeploy, returning its wall time and metrics report"""
+    dist = Distribution({
+        'name': project.name,
+        'version': '1.0.0',
+        # Nothing to build, keeps setuptools from looking for packages in the working directory
+        'packages': [],
+        'cmdclass': {'ldist': LDist, 'lupload': LUpload, 'ldeploy': LDeploy}
+    })
+    validate_lambda_config(dist, 'lambda_config', {'Runtime': 'python3.6', 'Timeout': 60, 'MemorySize': 128,
+                                                   'Publish': True})
+    set_client_factory(dist, FakeClientFactory(aws, get_metrics(dist)))
+
+    # ldist already ran in its own process, hand its results to ldeploy
+    ldist_cmd = dist.get_command_obj('ldist')
+    ldist_cmd.ensure_finalized()
+    ldist_cmd.dist_path = artifact
+    ldist_cmd.dist_name = os.path.basename(project.dist_path)
+    ldist_cmd.dist_sha256 = code_sha256
+    ldist_cmd.lambda_function_names = dict(project.lambda_function_names)
+    ldist_cmd.lambda_function_targets = dict(project.lambda_function_targets)
+    dist.have_run['ldist'] = 1
+
+    ldeploy_cmd = dist.get_command_obj('ldeploy')
+    ldeploy_cmd.access_key = 'benchmark'
+    ldeploy_cmd.secret_access_key = 'benchmark'
+    ldeploy_cmd.region = 'us-east-1'
+    ldeploy_cmd.role = 'benchmark'
+    ldeploy_cmd.swagger_path = project.swagger_path
+    ldeploy_cmd.deploy_stage = 'benchmark'
+    ldeploy_cmd.deploy_workers = deploy_workers
+    ldeploy_cmd.ensure_finalized()
+    start = time.time()
+    ldeploy_cmd.run()
+    return time.time() - start, get_metrics(dist).report()
+
+
+def run_scenario(name, files, size, functions, paths, repeat, latency, update_seconds, deploy_workers, work_dir):
+    project = generate_project(os.path.join(work_dir, name), 'bench-{}'.format(name), files, size, functions, paths)
+    wheelhouse = os.path.join(work_dir, name + '-wheelhouse')
+    report_path = os.path.join(work_dir, name + '-metrics.json')
+    result = {
+        'files': files,
+        'bytes': size,
+        'functions': functions,
+        'paths': paths,
+        'ldist': {},
+        'ldeploy': {}
+    }
+
+    def measure_ldist(label, before=None, no_build_cache=False):
+        samples = []
+        for _ in range(repeat):
+            if before is not None:
+                before()
+            seconds, report = run_ldist(project, wheelhouse, report_path, no_build_cache)
+            samples.append(seconds)
+        result['ldist'][label] = dict(_summary(samples), phases=report['phases'], counters=report['counters'])
+        print('{} ldist {}: {:.2f}s'.format(name, label, result['ldist'][label]['median']), file=sys.stderr)
+
+    measure_ldist('cold', no_build_cache=True)
+    result['dist_bytes'] = os.path.getsize(project.dist_path)
+    first = keep_artifact(project, work_dir, name + '-1.zip')
+    measure_ldist('warm')
+    measure_ldist('changed', before=project.touch)
+    second = keep_artifact(project, work_dir, name + '-2.zip')
+
+    deploys = collections.OrderedDict([('create', []), ('unchanged', []), ('update', [])])
+    reports = {}
+    for _ in range(repeat):
+        aws = FakeAWS(latency, update_seconds)
+        for label, (artifact, code_sha256) in zip(deploys, (first, first, second)):
+            seconds, reports[label] = run_ldeploy(project, aws, artifact, code_sha256, deploy_workers)
+            deploys[label].append(seconds)
+    for label, samples in deploys.items():
+        result['ldeploy'][label] = dict(_summary(samples), phases=reports[label]['phases'],
+                                        counters=reports[label]['counters'], api_calls=reports[label]['api_calls'])
+        print('{} ldeploy {}: {:.2f}s'.format(name, label, result['ldeploy'][label]['median']), file=sys.stderr)
+    return result
+
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.PIPE).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark ldist and ldeploy on synthetic projects')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                        help='Scenario to run, may be repeated (defaults to small and medium)')
+    parser.add_argument('--files', type=int, help='Run a custom scenario with this many source files')
+    parser.add_argument('--size', type=int, default=10 * MiB, help='Total source bytes of the custom scenario')
+    parser.add_argument('--functions', type=int, default=10, help='lambda_function entries of the custom scenario')
+    parser.add_argument('--paths', type=int, default=50, help='Swagger paths of the custom scenario')
+    parser.add_argument('--repeat', type=int, default=3, help='Times each measurement is repeated')
+    parser.add_argument('--latency-ms', type=float, default=50, help='Latency of every fake AWS API call')
+    parser.add_argument('--update-ms', type=float, default=0,
+                        help='How long a fake lambda function stays busy after being created or updated')
+    parser.add_argument('--deploy-workers', type=int, default=4, help='ldeploy --deploy-workers')
+    parser.add_argument('--output', help='Write the results to this file instead of stdout')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated projects')
+    args = parser.parse_args(argv)
+
+    scenarios = collections.OrderedDict()
+    for name in args.scenario or ([] if args.files else ['small', 'medium']):
+        scenarios[name] = SCENARIOS[name]
+    if args.files:
+        scenarios['custom'] = (args.files, args.size, args.functions, args.paths)
+
+    work_dir = tempfile.mkdtemp(prefix='lambda-setuptools-bench-')
+    results = {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'repeat': args.repeat,
+        'latency_ms': args.latency_ms,
+        'update_ms': args.update_ms,
+        'deploy_workers': args.deploy_workers,
+        'scenarios': collections.OrderedDict()
+    }
+    try:
+        for name, (files, size, functions, paths) in scenarios.items():
+            results['scenarios'][name] = run_scenario(name, files, size, functions, paths, args.repeat,
+                                                      args.latency_ms / 1000.0, args.update_ms / 1000.0,
+                                                      args.deploy_workers, work_dir)
+    finally:
+        if args.keep:
+            print('projects kept in {}'.format(work_dir), file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -46,12 +46,15 @@ setup(
             'ldist = lambda_setuptools.ldist:LDist',
             'lupload = lambda_setuptools.lupload:LUpload',
             'ldeploy = lambda_setuptools.ldeploy:LDeploy',
+            'lprofile = lambda_setuptools.lprofile:LProfile',
+            'lload = lambda_setuptools.lload:LLoad',
         ],
         'distutils.setup_keywords': [
             'lambda_function = lambda_setuptools.ldist:validate_lambda_function',
             'lambda_module = lambda_setuptools.ldist:add_lambda_module_to_py_modules',
             'lambda_package = lambda_setuptools.ldist:validate_lambda_package',
-            'lambda_config = lambda_setuptools.ldeploy:validate_lambda_config'
+            'lambda_config = lambda_setuptools.ldeploy:validate_lambda_config',
+            'lambda_telemetry = lambda_setuptools.ldist:validate_lambda_telemetry'
         ]
     }
 )
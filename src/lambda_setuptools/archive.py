@@ -0,0 +1,204 @@
+import base64
+import binascii
+import collections
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from distutils import log
+
+from lambda_setuptools.cache import file_sha256
+
+# Payloads that are already compressed (or that deflate barely shrinks) are stored as is
+DEFAULT_STORE_EXTENSIONS = ('.so', '.pyd', '.zip', '.whl', '.egg', '.jar', '.gz', '.tgz', '.bz2', '.xz',
+                            '.lzma', '.7z', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.ico', '.mp3', '.mp4')
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_END_RECORD = struct.Struct('<IHHHHIIH')
+_ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+_ZIP64_END_LOCATOR = struct.Struct('<IIQI')
+_ZIP_MAX = 0xFFFFFFFF
+_ZIP_MAX_ENTRIES = 0xFFFF
+# Sizes and offsets from this one on, and entry counts above the other, need ZIP64 records
+_ZIP64_LIMIT = _ZIP_MAX
+_ZIP64_ENTRIES_LIMIT = _ZIP_MAX_ENTRIES
+
+ZipMember = collections.namedtuple('ZipMember', ['path', 'arcname'])
+ZipEntry = collections.namedtuple('ZipEntry', ['arcname', 'compress_type', 'crc', 'file_size', 'compress_size',
+                                               'date_time', 'mode', 'offset', 'sha256'])
+
+
+def code_sha256(path):
+    """Return the SHA-256 of the file at path base64 encoded, the way Lambda reports CodeSha256"""
+    return base64.b64encode(binascii.unhexlify(file_sha256(path))).decode('ascii')
+
+
+def reproducible_timestamp():
+    """The timestamp given to every member of a reproducible archive, honouring SOURCE_DATE_EPOCH"""
+    source_date_epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if source_date_epoch:
+        return time.gmtime(int(source_date_epoch))[:6]
+    return 1980, 1, 1, 0, 0, 0
+
+
+def write_manifest(manifest_path, dist_name, dist_path, entries, reproducible):
+    """Write the sidecar manifest for the archive at dist_path, returning its contents"""
+    manifest = {
+        'dist_name': dist_name,
+        'size': os.path.getsize(dist_path),
+        'sha256': file_sha256(dist_path),
+        'CodeSha256': code_sha256(dist_path),
+        'reproducible': reproducible,
+        'files': dict((entry.arcname.replace(os.sep, '/'), entry.sha256) for entry in entries)
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, sort_keys=True, indent=2)
+    return manifest
+
+
+def compression_policy(arcname, compress_level, store_extensions):
+    """Return the (compress_type, level) to use for arcname"""
+    if compress_level == 0 or os.path.splitext(arcname)[1].lower() in store_extensions:
+        return ZIP_STORED, 0
+    return ZIP_DEFLATED, compress_level
+
+
+def _dos_date_time(date_time):
+    if date_time[0] < 1980:
+        date_time = (1980, 1, 1, 0, 0, 0)
+    dos_date = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+    dos_time = date_time[3] << 11 | date_time[4] << 5 | date_time[5] // 2
+    return dos_date, dos_time
+
+
+def _compress_member(member, compress_level, store_extensions, date_time, normalize_permissions):
+    """Read and compress a single member, this is what runs on the worker pool"""
+    st = os.stat(member.path)
+    with open(member.path, 'rb') as f:
+        data = f.read()
+    crc = zlib.crc32(data) & 0xFFFFFFFF
+    sha256 = hashlib.sha256(data).hexdigest()
+    mode = st.st_mode & 0o777
+    if normalize_permissions:
+        mode = 0o755 if mode & 0o111 else 0o644
+    compress_type, level = compression_policy(member.arcname, compress_level, store_extensions)
+    payload = data
+    if compress_type == ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        payload = compressor.compress(data) + compressor.flush()
+        if len(payload) >= len(data):
+            # Deflate didn't buy us anything, so don't make Lambda inflate it
+            compress_type, payload = ZIP_STORED, data
+    if date_time is None:
+        date_time = time.localtime(st.st_mtime)[:6]
+    return member.arcname, compress_type, crc, len(data), payload, _dos_date_time(date_time), mode, sha256
+
+
+def _zip64_extra(values):
+    """The ZIP64 extended information extra field holding values, or nothing if there are none"""
+    if not values:
+        return b''
+    return struct.pack('<HH', 0x0001, 8 * len(values)) + struct.pack('<' + 'Q' * len(values), *values)
+
+
+def _ordered_results(executor, fn, items, window):
+    """Like executor.map, but with at most window items in flight so memory use stays bounded"""
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def write_zip(zip_path, members, compress_level=6, store_extensions=DEFAULT_STORE_EXTENSIONS, workers=None,
+              date_time=None, normalize_permissions=False):
+    """
+    Write members (a sequence of ZipMember) to zip_path, compressing them in parallel.
+
+    Members are compressed on a thread pool (zlib releases the GIL) and written to the
+    archive in the order they were given, so the output doesn't depend on scheduling.
+    date_time, if given, replaces every member's mtime and normalize_permissions reduces
+    modes to 0644/0755. Returns the ZipEntry of every member written.
+    """
+    workers = workers or os.cpu_count() or 1
+    store_extensions = tuple(ext.lower() for ext in store_extensions)
+    entries = []
+
+    def compress(member):
+        return _compress_member(member, compress_level, store_extensions, date_time, normalize_permissions)
+
+    with open(zip_path, 'wb') as zf, ThreadPoolExecutor(max_workers=workers) as executor:
+        offset = 0
+        for arcname, compress_type, crc, file_size, payload, dos_date_time, mode, sha256 in \
+                _ordered_results(executor, compress, members, workers * 4):
+            log.debug('zipping {} ({})'.format(arcname, 'deflated' if compress_type == ZIP_DEFLATED else 'stored'))
+            name = arcname.replace(os.sep, '/').encode('utf-8')
+            flags = 0x800 if any(c > 0x7F for c in bytearray(name)) else 0
+            dos_date, dos_time = dos_date_time
+            sizes = (len(payload), file_size)
+            extra = b''
+            version = 20
+            if max(sizes) >= _ZIP64_LIMIT:
+                # In the local header both sizes move to the extra field, uncompressed first
+                extra = _zip64_extra([file_size, len(payload)])
+                sizes = (_ZIP_MAX, _ZIP_MAX)
+                version = 45
+            zf.write(_LOCAL_HEADER.pack(0x04034b50, version, flags, compress_type, dos_time, dos_date,
+                                        crc, sizes[0], sizes[1], len(name), len(extra)))
+            zf.write(name)
+            zf.write(extra)
+            zf.write(payload)
+            entries.append(ZipEntry(arcname, compress_type, crc, file_size, len(payload), dos_date_time, mode,
+                                    offset, sha256))
+            offset += _LOCAL_HEADER.size + len(name) + len(extra) + len(payload)
+
+        central_directory_offset = offset
+        for entry in entries:
+            name = entry.arcname.replace(os.sep, '/').encode('utf-8')
+            flags = 0x800 if any(c > 0x7F for c in bytearray(name)) else 0
+            dos_date, dos_time = entry.date_time
+            # Only the values that don't fit go to the extra field, in this order
+            zip64_values = []
+            file_size, compress_size, header_offset = entry.file_size, entry.compress_size, entry.offset
+            if file_size >= _ZIP64_LIMIT:
+                zip64_values.append(file_size)
+                file_size = _ZIP_MAX
+            if compress_size >= _ZIP64_LIMIT:
+                zip64_values.append(compress_size)
+                compress_size = _ZIP_MAX
+            if header_offset >= _ZIP64_LIMIT:
+                zip64_values.append(header_offset)
+                header_offset = _ZIP_MAX
+            extra = _zip64_extra(zip64_values)
+            version = 45 if zip64_values else 20
+            # Made by on Unix, so that the permissions in external_attr are honoured
+            zf.write(_CENTRAL_HEADER.pack(0x02014b50, 3 << 8 | version, version, flags, entry.compress_type,
+                                          dos_time, dos_date, entry.crc, compress_size, file_size, len(name),
+                                          len(extra), 0, 0, 0, (0o100000 | entry.mode) << 16, header_offset))
+            zf.write(name)
+            zf.write(extra)
+            offset += _CENTRAL_HEADER.size + len(name) + len(extra)
+
+        central_directory_size = offset - central_directory_offset
+        count = len(entries)
+        if count > _ZIP64_ENTRIES_LIMIT or central_directory_size >= _ZIP64_LIMIT or \
+                central_directory_offset >= _ZIP64_LIMIT:
+            zf.write(_ZIP64_END_RECORD.pack(0x06064b50, _ZIP64_END_RECORD.size - 12, 3 << 8 | 45, 45, 0, 0,
+                                            count, count, central_directory_size, central_directory_offset))
+            zf.write(_ZIP64_END_LOCATOR.pack(0x07064b50, 0, offset, 1))
+            count = min(count, _ZIP_MAX_ENTRIES)
+            central_directory_size = min(central_directory_size, _ZIP_MAX)
+            central_directory_offset = min(central_directory_offset, _ZIP_MAX)
+        zf.write(_END_RECORD.pack(0x06054b50, 0, 0, count, count, central_directory_size,
+                                  central_directory_offset, 0))
+    return entries
@@ -0,0 +1,169 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import zipfile
+
+from distutils import log
+from email.parser import Parser
+
+
+def file_sha256(path, block_size=1 << 20):
+    """Return the hex SHA-256 digest of the file at path"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def find_wheel(dist_dir, wheel_dist_name):
+    """Return the most recently built wheel for wheel_dist_name in dist_dir"""
+    wheels = glob.glob(os.path.join(dist_dir, '{}-*.whl'.format(wheel_dist_name)))
+    if not wheels:
+        return None
+    return max(wheels, key=os.path.getmtime)
+
+
+def wheel_requirements(wheel_path):
+    """Return the dependency related metadata headers of a wheel as a sorted list"""
+    with zipfile.ZipFile(wheel_path) as whl:
+        metadata_names = [n for n in whl.namelist()
+                          if n.count('/') == 1 and n.endswith('.dist-info/METADATA')]
+        if not metadata_names:
+            return []
+        metadata = Parser().parsestr(whl.read(metadata_names[0]).decode('utf-8'))
+    requirements = []
+    for header in ('Requires-Python', 'Requires-Dist', 'Provides-Extra'):
+        for value in metadata.get_all(header) or []:
+            requirements.append('{}: {}'.format(header, value.strip()))
+    return sorted(requirements)
+
+
+def dependency_cache_key(wheel_path, dist_dir):
+    """
+    Hash everything that can change the result of installing the dependencies of wheel_path:
+    the wheel's declared requirements and any other wheel that pip may pick up from dist_dir
+    """
+    wheel_name = os.path.basename(wheel_path).split('-')[0]
+    find_links = []
+    for path in sorted(glob.glob(os.path.join(dist_dir, '*.whl'))):
+        if os.path.basename(path).split('-')[0] == wheel_name:
+            continue
+        find_links.append([os.path.basename(path), file_sha256(path)])
+    key = {
+        'requirements': wheel_requirements(wheel_path),
+        'find_links': find_links
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def installed_distributions(build_dir):
+    """Return the sorted names of the *.dist-info directories installed in build_dir"""
+    return sorted(name for name in os.listdir(build_dir)
+                  if name.endswith('.dist-info') and os.path.isdir(os.path.join(build_dir, name)))
+
+
+def wheel_target_path(name):
+    """
+    Map a wheel member to the path pip install -t would give it, or None
+    if pip would not install it into the root of the target directory
+    """
+    parts = name.split('/')
+    if parts[0].endswith('.data'):
+        if len(parts) > 2 and parts[1] in ('purelib', 'platlib'):
+            return '/'.join(parts[2:])
+        return None
+    return name
+
+
+def wheel_files(wheel_path):
+    """Return the paths extract_wheel would install wheel_path's files to"""
+    with zipfile.ZipFile(wheel_path) as whl:
+        return [relpath for relpath in (wheel_target_path(name) for name in whl.namelist() if not name.endswith('/'))
+                if relpath is not None]
+
+
+def extract_wheel(wheel_path, target_dir, exclude=(), only=None):
+    """
+    Unpack wheel_path into target_dir like pip install -t, returning the installed paths.
+    Paths in exclude, or not in only if it is given, are left out.
+    """
+    installed = []
+    abs_target = os.path.abspath(target_dir)
+    with zipfile.ZipFile(wheel_path) as whl:
+        for info in whl.infolist():
+            if info.filename.endswith('/'):
+                continue
+            relpath = wheel_target_path(info.filename)
+            if relpath is None:
+                log.debug('skipping {} from {}'.format(info.filename, wheel_path))
+                continue
+            if relpath in exclude or only is not None and relpath not in only:
+                continue
+            destination = os.path.abspath(os.path.join(target_dir, relpath))
+            if not destination.startswith(abs_target + os.sep):
+                raise ValueError('{} escapes {}'.format(info.filename, target_dir))
+            parent = os.path.dirname(destination)
+            if not os.path.isdir(parent):
+                try:
+                    os.makedirs(parent)
+                except OSError:
+                    if not os.path.isdir(parent):
+                        raise
+            with whl.open(info) as src, open(destination, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            mode = (info.external_attr >> 16) & 0o777
+            if mode & 0o111:
+                os.chmod(destination, mode | 0o644)
+            installed.append(relpath)
+    return installed
+
+
+def remove_files(build_dir, relpaths):
+    """Remove relpaths from build_dir, along with any directories left empty"""
+    directories = set()
+    for relpath in relpaths:
+        # pip adds its own files (INSTALLER, REQUESTED, ...) to the metadata directory
+        top_level = relpath.split('/')[0]
+        if top_level.endswith('.dist-info') and os.path.isdir(os.path.join(build_dir, top_level)):
+            shutil.rmtree(os.path.join(build_dir, top_level))
+            continue
+        path = os.path.join(build_dir, relpath)
+        if os.path.isfile(path) or os.path.islink(path):
+            os.remove(path)
+        # Byte code compiled without source checks would outlive its source, or a new version of it
+        if relpath.endswith('.py'):
+            pycache = os.path.join(build_dir, os.path.dirname(relpath), '__pycache__')
+            for pyc in glob.glob(os.path.join(pycache, os.path.basename(relpath)[:-3] + '.*.pyc')):
+                os.remove(pyc)
+        directory = os.path.dirname(relpath)
+        while directory:
+            directories.add(directory)
+            directory = os.path.dirname(directory)
+    # Deepest first, so that parents are empty by the time we get to them
+    for directory in sorted(directories, key=lambda d: d.count('/'), reverse=True):
+        path = os.path.join(build_dir, directory)
+        pycache = os.path.join(path, '__pycache__')
+        if os.path.isdir(pycache):
+            shutil.rmtree(pycache)
+        if os.path.isdir(path) and not os.listdir(path):
+            os.rmdir(path)
+
+
+def load_build_cache(path):
+    """Return the build cache state stored at path, or None if there isn't a usable one"""
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        log.warn('ignoring corrupt ldist build cache {}'.format(path))
+        return None
+
+
+def save_build_cache(path, state):
+    with open(path, 'w') as f:
+        json.dump(state, f, sort_keys=True, indent=2)
@@ -0,0 +1,112 @@
+import threading
+
+import boto3
+from botocore.client import Config
+from distutils import log
+
+from lambda_setuptools.metrics import get_metrics
+
+# Every client retries with the same policy: botocore's adaptive mode, which backs off
+# exponentially and rate limits the client itself once AWS starts throttling
+RETRY_POLICY = {'mode': 'adaptive', 'max_attempts': 10}
+
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+
+def default_session():
+    """Return the boto3 session built from the environment, creating it only once"""
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = boto3.Session()
+        return _default_session
+
+
+class ClientFactory(object):
+    """
+    Creates boto3 clients for one set of credentials, at most once per service and region.
+    All clients share the retry policy and a connection pool sized for the largest
+    concurrency any command asked for.
+    """
+
+    def __init__(self, access_key=None, secret_access_key=None, endpoint_url=None, metrics=None):
+        session = default_session()
+        credentials = session.get_credentials()
+        if (access_key is None and secret_access_key is None) or \
+                (credentials is not None and credentials.access_key == access_key and
+                 credentials.secret_key == secret_access_key):
+            # Reusing the default session also keeps any session token that came with it
+            self._session = session
+        else:
+            self._session = boto3.Session(aws_access_key_id=access_key, aws_secret_access_key=secret_access_key)
+        self._endpoint_url = endpoint_url
+        self._metrics = metrics
+        self._max_pool_connections = DEFAULT_MAX_POOL_CONNECTIONS
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def reserve_connections(self, count):
+        """
+        Make sure clients get at least count pooled connections. Clients created with a smaller
+        pool are replaced the next time they are asked for.
+        """
+        with self._lock:
+            if count <= self._max_pool_connections:
+                return
+            if self._clients:
+                log.debug('clients {} will be recreated with {} pooled connections instead of {}'.format(
+                    sorted(self._clients), count, self._max_pool_connections))
+            self._max_pool_connections = count
+
+    def client(self, service_name, region=None):
+        key = (service_name, region)
+        with self._lock:
+            if key not in self._clients or \
+                    self._clients[key].meta.config.max_pool_connections < self._max_pool_connections:
+                config = Config(retries=RETRY_POLICY, max_pool_connections=self._max_pool_connections)
+                if service_name == 's3':
+                    config = config.merge(Config(signature_version='s3v4'))
+                log.debug('creating {} client for {}'.format(service_name, region or 'the default region'))
+                client = self._session.client(
+                    service_name,
+                    region_name=region,
+                    endpoint_url=self._endpoint_url,
+                    config=config
+                )
+                if self._metrics is not None:
+                    self._metrics.instrument_client(client)
+                self._clients[key] = client
+            return self._clients[key]
+
+
+def set_client_factory(dist, factory):
+    """
+    Make every command of dist get its clients from factory, whatever their credentials, e.g.
+    an AWS stand-in for benchmarks. factory needs the client and reserve_connections methods.
+    """
+    setattr(dist, '_lambda_client_factory_override', factory)
+
+
+def get_client_factory(dist, access_key=None, secret_access_key=None, endpoint_url=None, max_pool_connections=None):
+    """
+    Return the ClientFactory shared by every command of dist that uses the same credentials
+    and endpoint, so that lupload and ldeploy never build the same client twice
+    """
+    override = getattr(dist, '_lambda_client_factory_override', None)
+    if override is not None:
+        if max_pool_connections:
+            override.reserve_connections(max_pool_connections)
+        return override
+    factories = getattr(dist, '_lambda_client_factories', None)
+    if factories is None:
+        factories = {}
+        setattr(dist, '_lambda_client_factories', factories)
+    key = (access_key, secret_access_key, endpoint_url)
+    if key not in factories:
+        factories[key] = ClientFactory(access_key, secret_access_key, endpoint_url, metrics=get_metrics(dist))
+    if max_pool_connections:
+        factories[key].reserve_connections(max_pool_connections)
+    return factories[key]
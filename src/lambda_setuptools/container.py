@@ -0,0 +1,115 @@
+"""
+The container half of lload: imports a handler built by ldist and invokes it with events, the
+way a Lambda container would. lload runs this file as a script in a fresh interpreter for every
+container, so it must only use the standard library, and import as little of it as it can, for
+the init time and memory of the handler not to include lambda_setuptools.
+
+    python container.py < job.json
+"""
+import importlib
+import json
+import sys
+import time
+import uuid
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Shows up in the ARN of the fake context, there being no real account to take it from
+ACCOUNT_ID = '123456789012'
+
+
+class FakeContext(object):
+    """The context object Lambda passes to handlers, close enough for handlers to run unmodified"""
+
+    def __init__(self, function_name, memory_limit_in_mb=128, timeout=60, region='us-east-1'):
+        self.function_name = function_name
+        self.function_version = '$LATEST'
+        self.invoked_function_arn = 'arn:aws:lambda:{}:{}:function:{}'.format(region, ACCOUNT_ID,
+                                                                              function_name)
+        self.memory_limit_in_mb = memory_limit_in_mb
+        self.aws_request_id = str(uuid.uuid4())
+        self.log_group_name = '/aws/lambda/{}'.format(function_name)
+        self.log_stream_name = time.strftime('%Y/%m/%d') + '/[$LATEST]' + uuid.uuid4().hex
+        self.identity = None
+        self.client_context = None
+        self._deadline = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(int((self._deadline - time.time()) * 1000), 0)
+
+
+def max_rss_kib():
+    """The peak RSS of this process in KiB"""
+    # On Linux ru_maxrss survives exec, a container would report the peak of the process that started it
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss // 1024 if sys.platform == 'darwin' else max_rss
+
+
+def load_handler(build_dir, entry_module, module, function_name):
+    """Import the handler as the first invocation of a container would, returning it and the time taken"""
+    if build_dir not in sys.path:
+        sys.path.insert(0, build_dir)
+    start = time.time()
+    importlib.import_module(module)
+    handler = getattr(importlib.import_module(entry_module), function_name)
+    return handler, time.time() - start
+
+
+def invoke_all(handler, events, context_settings):
+    """Invoke handler with every (name, event) of events, returning the latencies in ms and the errors"""
+    latencies = []
+    errors = []
+    for name, event in events:
+        context = FakeContext(**context_settings)
+        start = time.time()
+        try:
+            handler(event, context)
+        except Exception as e:
+            errors.append('{}: {}: {}'.format(name, type(e).__name__, e))
+        latencies.append((time.time() - start) * 1000)
+    return latencies, errors
+
+
+def run_container(build_dir, entry_module, module, function_name, events, context_settings):
+    """A warm container in its own process: import the handler once, then invoke it with events"""
+    handler, init_seconds = load_handler(build_dir, entry_module, module, function_name)
+    start = time.time()
+    latencies, errors = invoke_all(handler, events, context_settings)
+    return {
+        'init_ms': init_seconds * 1000,
+        'latencies': latencies,
+        'errors': errors,
+        'max_rss_kib': max_rss_kib(),
+        'start': start,
+        'end': time.time()
+    }
+
+
+def main():
+    """Run the run_container job read from stdin, writing its results to stdout"""
+    job = json.load(sys.stdin)
+    stdout = sys.stdout
+    # Whatever the handler prints must not get mixed up with the results
+    sys.stdout = sys.stderr
+    results = run_container(**job)
+    stdout.write(json.dumps(results))
+    stdout.flush()
+
+
+if __name__ == '__main__':
+    # Run as a script, this directory is first on the path, where its modules would shadow the handler's
+    if sys.path and sys.path[0] and __file__.startswith(sys.path[0]):
+        del sys.path[0]
+    main()
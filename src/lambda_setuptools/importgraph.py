@@ -0,0 +1,86 @@
+import modulefinder
+import os
+
+from distutils import log
+
+
+class _ModuleFinder(modulefinder.ModuleFinder):
+    def find_module(self, name, path, parent=None):
+        try:
+            return modulefinder.ModuleFinder.find_module(self, name, path, parent)
+        except AttributeError:
+            # Namespace packages have no loader, which modulefinder doesn't expect
+            raise ImportError('No module named {}'.format(name))
+
+
+def distribution_top_levels(build_dir):
+    """
+    Map every top level entry of build_dir that belongs to an installed distribution to all the
+    top level entries of that distribution (its packages, its *.dist-info, vendored *.libs, ...).
+    It is read from the RECORD files, so it must be taken before pruning removes them.
+    """
+    owners = {}
+    for name in os.listdir(build_dir):
+        if not name.endswith('.dist-info'):
+            continue
+        entries = set([name])
+        record = os.path.join(build_dir, name, 'RECORD')
+        top_level = os.path.join(build_dir, name, 'top_level.txt')
+        if os.path.isfile(record):
+            with open(record) as f:
+                for line in f:
+                    path = line.split(',')[0].strip()
+                    if path and not path.startswith('..'):
+                        entries.add(path.split('/')[0])
+        elif os.path.isfile(top_level):
+            with open(top_level) as f:
+                entries.update(line.strip() for line in f if line.strip())
+        for entry in entries:
+            for candidate in (entry, entry + '.py'):
+                owners.setdefault(candidate, set()).update(entries)
+    return owners
+
+
+def _top_level_entries(build_dir, top_level_name):
+    """Return the entries of build_dir (package directory, module, extension module) named top_level_name"""
+    entries = []
+    for name in os.listdir(build_dir):
+        if name == top_level_name or (name.split('.')[0] == top_level_name and
+                                      not os.path.isdir(os.path.join(build_dir, name))):
+            entries.append(name)
+    return entries
+
+
+def required_top_levels(build_dir, module_names, include_modules=(), owners=None):
+    """
+    Statically follow the imports of module_names (plus the allow-listed include_modules, for
+    anything imported dynamically) inside build_dir and return the top level entries of
+    build_dir needed to run them. Pruning is done at the granularity of top level packages and
+    their distributions, so package data, extension modules and vendored libraries come along.
+    owners is the distribution_top_levels of build_dir, taken from build_dir itself if not given.
+    """
+    finder = _ModuleFinder(path=[os.path.abspath(build_dir)])
+    for module_name in module_names:
+        finder.import_hook(module_name)
+    top_level_names = set(name.split('.')[0] for name in include_modules)
+    for module_name in include_modules:
+        try:
+            finder.import_hook(module_name)
+        except ImportError as e:
+            log.debug('cannot follow the imports of {}: {}'.format(module_name, e))
+
+    top_level_names.update(name.split('.')[0] for name in finder.modules)
+    # modulefinder can't see into namespace packages or modules it fails to parse; be
+    # conservative and keep anything it couldn't resolve that is actually in the build
+    for name in finder.badmodules:
+        top_level_names.add(name.split('.')[0])
+
+    if owners is None:
+        owners = distribution_top_levels(build_dir)
+    required = set()
+    for top_level_name in top_level_names:
+        for entry in _top_level_entries(build_dir, top_level_name):
+            required.add(entry)
+            required.update(owners.get(entry, ()))
+    log.debug('{} need {}'.format(', '.join(module_names), ', '.join(sorted(required))))
+    return required
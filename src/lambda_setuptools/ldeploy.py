@@ -1,17 +1,29 @@
+import hashlib
+import json
 import os
+import re
 from copy import copy
 
-import boto3
+from botocore.exceptions import ClientError
 from distutils import log
 
 import logging
-import yaml
 from distutils.errors import DistutilsArgError, DistutilsOptionError, DistutilsSetupError, DistutilsExecError
-from jsonschema import ValidationError
 from setuptools import Command
-from swagger_spec_validator import SwaggerValidationError
-from swagger_spec_validator.validator20 import validate_spec
-from yaml.scanner import ScannerError
+
+from lambda_setuptools.clients import default_session, get_client_factory
+from lambda_setuptools.metrics import get_metrics
+from lambda_setuptools.scheduler import DeployScheduler, DeployState, Stage
+from lambda_setuptools.swagger import load_swagger, with_integration_uris
+
+# Tags the REST API with the SHA-256 of the specification last put, so an unchanged one isn't put again
+SPEC_TAG = 'lambda-setuptools:spec-sha256'
+
+# The statement ids of the permissions ldeploy gives API gateway, which it may remove again
+PERMISSION_SID_PREFIX = 'api-gateway-execute'
+
+# Describes deployments by the SHA-256 of the specification deployed, so an unchanged stage isn't redeployed
+DEPLOYMENT_DESCRIPTION = 'lambda-setuptools spec {}'
 
 
 def validate_lambda_config(dist, attr, value):
@@ -28,30 +40,116 @@ def validate_lambda_config(dist, attr, value):
     setattr(dist, attr, config)
 
 
-def validate_and_set_swagger_dict(dist, attr, value):
-    """Validate swagger specification and set dist swagger_dict attribute"""
+def validate_and_set_swagger_dict(dist, attr, value, cache_dir=None):
+    """
+    Validate swagger specification and set dist swagger_dict attribute, and swagger_index to the
+    (path, method) of every operationId
+    """
     if value is None:
         setattr(dist, 'swagger_dict', None)
+        setattr(dist, 'swagger_index', None)
         return
 
-    swagger_dict = value
-    if isinstance(value, dict):
-        swagger_dict = value
-    elif isinstance(value, str):
-        contents = value
-        if os.path.exists(value):
-            contents = open(value, 'r').read()
-        from json import JSONDecodeError
-        try:
-            swagger_dict = yaml.load(contents)
-        except (ScannerError, JSONDecodeError, ValueError):
-            raise DistutilsSetupError('Not a valid swagger definition or file path.')
-    try:
-        validate_spec(swagger_dict)
-    except (SwaggerValidationError, ValidationError, JSONDecodeError) as e:
-        raise DistutilsSetupError('Not a valid swagger definition. {}'.format(e))
-
+    swagger_dict, swagger_index = load_swagger(value, cache_dir)
     setattr(dist, 'swagger_dict', swagger_dict)
+    setattr(dist, 'swagger_index', swagger_index)
+
+
+def _normalize_lambda_setting(key, value):
+    """Put a function setting into a form that compares equal however AWS chose to return it"""
+    if key == "VpcConfig":
+        value = value or {}
+        return {
+            "SubnetIds": sorted(value.get("SubnetIds") or []),
+            "SecurityGroupIds": sorted(value.get("SecurityGroupIds") or [])
+        }
+    if key == "Environment":
+        return {"Variables": (value or {}).get("Variables") or {}}
+    if key == "Layers":
+        return [layer.get("Arn") if isinstance(layer, dict) else layer for layer in value or []]
+    return value
+
+
+def lambda_config_changes(config, current):
+    """Return {setting: (current, desired)} for every setting in config that differs from current"""
+    changes = {}
+    for key, value in config.items():
+        # Code is compared by hash, the rest are only used on create
+        if key in ("FunctionName", "Code", "Publish", "Tags"):
+            continue
+        desired = _normalize_lambda_setting(key, value)
+        deployed = _normalize_lambda_setting(key, current.get(key))
+        if desired != deployed:
+            changes[key] = (deployed, desired)
+    return changes
+
+
+def plan_lambda_function(config, current, code_sha256):
+    """
+    Decide what deploying config means for a function whose deployed configuration is
+    current (None if it doesn't exist). The code only counts as changed when the hashes
+    differ or the local hash is unknown.
+    """
+    if current is None:
+        return {"FunctionName": config["FunctionName"], "action": "create", "current": None,
+                "code": True, "configuration": {}}
+    code_changed = code_sha256 is None or current.get("CodeSha256") != code_sha256
+    configuration = lambda_config_changes(config, current)
+    return {
+        "FunctionName": config["FunctionName"],
+        "action": "update" if code_changed or configuration else "unchanged",
+        "current": current,
+        "code": code_changed,
+        "configuration": configuration
+    }
+
+
+def describe_plan(plan):
+    """A one line, human readable summary of a plan_lambda_function result"""
+    if plan["action"] != "update":
+        return "{}: {}".format(plan["FunctionName"], plan["action"])
+    changes = []
+    if plan["code"]:
+        changes.append("code")
+    for key in sorted(plan["configuration"]):
+        deployed, desired = plan["configuration"][key]
+        changes.append("{} {} -> {}".format(key, json.dumps(deployed, sort_keys=True, default=str),
+                                            json.dumps(desired, sort_keys=True, default=str)))
+    return "{}: update {}".format(plan["FunctionName"], ", ".join(changes))
+
+
+def permission_statement_id(source_arn):
+    """The statement id of the permission for source_arn, the same on every deploy"""
+    return '{}-{}'.format(PERMISSION_SID_PREFIX, hashlib.sha256(source_arn.encode('utf-8')).hexdigest()[:32])
+
+
+def _source_arn_stage(source_arn):
+    """The stage of an arn:aws:execute-api:<region>:<account>:<rest api id>/<stage>/... source ARN"""
+    resource = source_arn.split(':', 5)[-1].split('/')
+    return resource[1] if len(resource) > 1 else None
+
+
+def plan_permissions(statements, source_arn):
+    """
+    Decide what the resource policy statements of a function need for the API gateway at
+    source_arn to invoke it: whether its statement must be added, and the statement ids ldeploy
+    added for earlier APIs or paths of the same stage that must be removed. Statements for other
+    stages, or not added by ldeploy, are left alone.
+    """
+    sid = permission_statement_id(source_arn)
+    stage = _source_arn_stage(source_arn)
+    add = True
+    remove = []
+    for statement in statements:
+        statement_sid = statement.get('Sid', '')
+        if statement_sid != PERMISSION_SID_PREFIX and not statement_sid.startswith(PERMISSION_SID_PREFIX + '-'):
+            continue
+        statement_arn = (statement.get('Condition') or {}).get('ArnLike', {}).get('AWS:SourceArn') or ''
+        if statement_sid == sid and statement_arn == source_arn:
+            add = False
+        elif _source_arn_stage(statement_arn) == stage:
+            remove.append(statement_sid)
+    return add, sorted(remove)
 
 
 class LDeploy(Command):
@@ -70,12 +168,36 @@ class LDeploy(Command):
         ('vpc-security-groups=', None, 'VPC Configuration list of security group ids separated by a comma'),
         ('role=', None, 'AWS Gateway role to use when creating API gateway'),
         ('region=', None,
-         'AWS region to use. If not provided, default region set in environment variables will be use if set, otherwise will fail.')
+         'AWS region to use. If not provided, default region set in environment variables will be use if set, otherwise will fail.'),
+        ('deploy-workers=', None, 'Number of lambda functions to create or update at the same time (optional, defaults to 4)'),
+        ('s3-bucket=', None,
+         'Upload the dist to this bucket once (using lupload) and create the lambda functions from it instead of '
+         'sending the ZIP file with every function (optional, must be in the same region)'),
+        ('s3-prefix=', None, 'The prefix to use when uploading the dist to s3-bucket (optional)'),
+        ('kms-key-id=', None, 'The KMS key to use when uploading the dist to s3-bucket (optional)'),
+        ('endpoint-url=', None, 'Use this endpoint for every AWS service instead of AWS, e.g. a local stand-in (optional)'),
+        ('layer-name=', None,
+         'Name of the lambda layer for the dependencies built by ldist --layer (optional, defaults to <name>-dependencies)'),
+        ('metrics-report=', None,
+         'Write phase timings, sizes and per function AWS API latencies and retries to this JSON file (optional)'),
+        ('wait-timeout=', None,
+         'Seconds to wait for a lambda function to finish being created or updated before giving up on it '
+         '(optional, defaults to 600)'),
+        ('state-file=', None,
+         'Where the progress of every function is kept so that a failed deploy can be resumed (optional, defaults '
+         'to build/ldeploy-<name>.state.json)'),
+        ('restart', None, 'Ignore the progress of the last, failed, deploy'),
+        ('rest-api-id=', None,
+         'Id of the REST API to update (optional, defaults to the REST API named after the title of the swagger '
+         'specification, which is created if there is none)'),
+        ('api-mode=', None, 'How a changed swagger specification is put: overwrite or merge (optional, defaults to '
+                            'overwrite)')
     ]
+    boolean_options = ['restart']
 
     def initialize_options(self):
         """Set default values for options."""
-        session = boto3.Session()
+        session = default_session()
 
         default_access_key = None
         default_secret_access_key = None
@@ -98,6 +220,18 @@ class LDeploy(Command):
         setattr(self, 'vpc_security_groups', None)
         setattr(self, 'role', None)
         setattr(self, 'region', default_region)
+        setattr(self, 'deploy_workers', 4)
+        setattr(self, 's3_bucket', None)
+        setattr(self, 's3_prefix', None)
+        setattr(self, 'kms_key_id', None)
+        setattr(self, 'endpoint_url', None)
+        setattr(self, 'layer_name', None)
+        setattr(self, 'metrics_report', None)
+        setattr(self, 'wait_timeout', 600)
+        setattr(self, 'state_file', None)
+        setattr(self, 'restart', False)
+        setattr(self, 'rest_api_id', None)
+        setattr(self, 'api_mode', 'overwrite')
 
     def finalize_options(self):
         """Post-process options."""
@@ -108,6 +242,21 @@ class LDeploy(Command):
         if getattr(self, 'region') is None:
             raise DistutilsSetupError(
                 'region must either be provided or default value need to be setup by running `aws configure`')
+        try:
+            setattr(self, 'deploy_workers', int(getattr(self, 'deploy_workers')))
+        except ValueError:
+            raise DistutilsOptionError('deploy-workers must be an integer')
+        if getattr(self, 'deploy_workers') < 1:
+            raise DistutilsOptionError('deploy-workers must be at least 1')
+        try:
+            setattr(self, 'wait_timeout', float(getattr(self, 'wait_timeout')))
+        except ValueError:
+            raise DistutilsOptionError('wait-timeout must be a number of seconds')
+        if getattr(self, 'api_mode') not in ('overwrite', 'merge'):
+            raise DistutilsOptionError('api-mode must be overwrite or merge')
+        if getattr(self, 'state_file') is None:
+            setattr(self, 'state_file', os.path.join('build', 'ldeploy-{}.state.json'.format(
+                re.sub('[^a-zA-Z0-9_-]', '-', self.distribution.get_name()))))
 
     def run(self):
         """Run command."""
@@ -116,36 +265,42 @@ class LDeploy(Command):
         dist_path = getattr(ldist_cmd, 'dist_path', None)
         dist_name = getattr(ldist_cmd, 'dist_name', None)
         swagger_path = getattr(self, 'swagger_path')
-        validate_and_set_swagger_dict(self, 'swagger_path', swagger_path)
+        with get_metrics(self.distribution).phase('ldeploy', 'swagger'):
+            validate_and_set_swagger_dict(self, 'swagger_path', swagger_path,
+                                          cache_dir=os.path.join('build', 'ldeploy-swagger'))
         if dist_path is None or dist_name is None:
             raise DistutilsArgError('\'ldist\' missing attributes')
 
-        gw_lambda_mapping = self._create_or_update_lambda_functions(ldist_cmd)
+        metrics = get_metrics(self.distribution)
+        if getattr(self, 'restart') and os.path.exists(getattr(self, 'state_file')):
+            os.remove(getattr(self, 'state_file'))
+        state_dir = os.path.dirname(getattr(self, 'state_file'))
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        setattr(self, 'deploy_state', DeployState(getattr(self, 'state_file')))
+        try:
+            gw_lambda_mapping = self._create_or_update_lambda_functions(ldist_cmd)
 
-        # If swagger_dict is not defined, do not create API Gateway
-        if getattr(self, 'swagger_dict') is not None:
-            self._create_and_deploy_api(gw_lambda_mapping)
+            # If swagger_dict is not defined, do not create API Gateway
+            if getattr(self, 'swagger_dict') is not None:
+                with metrics.phase('ldeploy', 'api'):
+                    self._create_and_deploy_api(gw_lambda_mapping)
+        finally:
+            # A failed deploy is when the API statistics matter most
+            if getattr(self, 'metrics_report'):
+                metrics.write(getattr(self, 'metrics_report'))
 
     def _create_swagger_doc(self, lambda_mapping):
         log.info("Creating swagger specification")
-        swagger_dict = copy(getattr(self, 'swagger_dict'))
         region = getattr(self, 'region', None)
-        paths = swagger_dict["paths"]
-
-        for path in paths.keys():
-            path_info = paths[path]
-            for method in path_info.keys():
-                method_info = path_info[method]
-                operation_id = method_info.get("operationId")
-                lambda_info = lambda_mapping.get(operation_id)
-                if lambda_info is not None:
-                    function_arn = lambda_info.get("FunctionArn")
-                    uri = "arn:aws:apigateway:{region}:lambda:path/2015-03-31/functions/{arn}/invocations".format(
-                        arn=function_arn, region=region)
-                    if "x-amazon-apigateway-integration" in method_info:
-                        method_info["x-amazon-apigateway-integration"]["uri"] = uri
-
-        return swagger_dict
+        uris = {}
+        for operation_id, lambda_info in lambda_mapping.items():
+            if lambda_info is not None:
+                uris[operation_id] = \
+                    "arn:aws:apigateway:{region}:lambda:path/2015-03-31/functions/{arn}/invocations".format(
+                        arn=lambda_info.get("FunctionArn"), region=region)
+
+        return with_integration_uris(getattr(self, 'swagger_dict'), getattr(self, 'swagger_index'), uris)
 
     def _create_or_update_lambda_functions(self, ldist_cmd):
         lambda_function_names = getattr(ldist_cmd, 'lambda_function_names', None)
@@ -156,115 +311,402 @@ class LDeploy(Command):
         vpc_subnets = getattr(self, 'vpc_subnets', None)
         vpc_security_groups = getattr(self, 'vpc_security_groups', None)
 
-        iam_client = boto3.client(
-            'iam',
-            aws_access_key_id=getattr(self, 'access_key'),
-            aws_secret_access_key=getattr(self, 'secret_access_key'),
-        )
+        metrics = get_metrics(self.distribution)
 
-        arn_role = iam_client.get_role(RoleName=role)['Role']['Arn']
+        iam_client = self._client('iam')
 
-        lambda_client = boto3.client(
-            'lambda',
-            region_name=region,
-            aws_access_key_id=getattr(self, 'access_key'),
-            aws_secret_access_key=getattr(self, 'secret_access_key'),
-        )
+        with metrics.phase('ldeploy', 'role'):
+            arn_role = iam_client.get_role(RoleName=role)['Role']['Arn']
 
-        lambda_mapping = {}
+        # boto3 clients are thread safe, so all workers share one
+        lambda_client = self._client('lambda', region)
 
         lambda_config = getattr(self.distribution, 'lambda_config', {})
 
-        log.info("Creating lambda functions.")
-        for function_name in lambda_function_names.keys():
-            handler = lambda_function_names.get(function_name)
-
-            try:
-                lambda_client.get_function(FunctionName=function_name)
-                exists = True
-            except Exception:
-                exists = False
-
-            zipfile = open(dist_path, 'rb')
+        function_names = list(lambda_function_names.keys())
 
+        # Functions either share the dist or, with ldist --split-functions, each have their own
+        lambda_function_dists = getattr(ldist_cmd, 'lambda_function_dists', None) or {}
+        artifacts = {}
+        for function_name in function_names:
+            function_dist = lambda_function_dists.get(function_name)
+            if function_dist is not None:
+                artifacts[function_name] = (function_dist['dist_path'], function_dist['dist_name'],
+                                            function_dist['dist_sha256'])
+            else:
+                artifacts[function_name] = (dist_path, getattr(ldist_cmd, 'dist_name'),
+                                            getattr(ldist_cmd, 'dist_sha256', None))
+
+        codes = {}
+        with metrics.phase('ldeploy', 'upload'):
+            for path, name, _ in sorted(set(artifacts.values())):
+                if getattr(self, 's3_bucket'):
+                    codes[path] = self._upload_dist(path, name)
+                else:
+                    with open(path, 'rb') as zipfile:
+                        codes[path] = {'ZipFile': zipfile.read()}
+
+        vpc_config = {}
+
+        if vpc_subnets:
+            vpc_config["SubnetIds"] = [a.strip() for a in vpc_subnets.split(',')]
+        if vpc_security_groups:
+            vpc_config["SecurityGroupIds"] = [a.strip() for a in vpc_security_groups.split(',')]
+
+        layer_arn = None
+        if getattr(ldist_cmd, 'layer_dist_path', None):
+            with metrics.phase('ldeploy', 'layer'):
+                layer_arn = self._publish_layer(lambda_client, ldist_cmd, lambda_config.get("Runtime"))
+
+        configs = {}
+        for function_name in lambda_function_names.keys():
             config = copy(lambda_config)
             config["FunctionName"] = function_name
             config["Role"] = arn_role
-            config["Handler"] = handler
-            config["Code"] = {'ZipFile': zipfile.read()}
-
-            vpc_config = {}
-
-            if vpc_subnets:
-                vpc_config["SubnetIds"] = [a.strip() for a in vpc_subnets.split(',')]
-            if vpc_security_groups:
-                vpc_config["SecurityGroupIds"] = [a.strip() for a in vpc_security_groups.split(',')]
-
-            if len(vpc_config) is not 0:
+            config["Handler"] = lambda_function_names.get(function_name)
+            config["Code"] = dict(codes[artifacts[function_name][0]])
+            if layer_arn is not None:
+                # Replace whatever version of our layer the function had with the current one
+                config["Layers"] = [layer_arn] + [
+                    arn for arn in lambda_config.get("Layers", [])
+                    if arn.rsplit(':', 1)[0] != layer_arn.rsplit(':', 1)[0]
+                ]
+
+            if len(vpc_config) != 0:
                 config["VpcConfig"] = vpc_config
+            configs[function_name] = config
+
+        log.info("Comparing lambda functions with what is deployed.")
+        with metrics.phase('ldeploy', 'inventory'):
+            inventory = self._lambda_inventory(lambda_client)
+        plans = {}
+        for function_name in function_names:
+            plans[function_name] = plan_lambda_function(configs[function_name], inventory.get(function_name),
+                                                        artifacts[function_name][2])
+            metrics.count('ldeploy.functions_{}'.format(plans[function_name]["action"]))
+        log.info("Lambda function plan:")
+        for function_name in function_names:
+            log.info("\t{}".format(describe_plan(plans[function_name])))
 
-            if exists:
-                log.info("Updating lambda function '{}' with new configuration.".format(function_name))
-                code_config = {
-                    "FunctionName": function_name,
-                    "ZipFile": config.pop("Code").pop("ZipFile"),
-                    "Publish": config.pop("Publish")
-                }
-                try:
-                    lambda_client.update_function_code(**code_config)
-                    r = lambda_client.update_function_configuration(**config)
-                    arn = r.get("FunctionArn", "")
-                    log.info("\tsuccessfully updated: {}".format(arn))
+        log.info("Creating lambda functions.")
+        jobs = []
+        for function_name in function_names:
+            key = self._deploy_key(configs[function_name], artifacts[function_name][2])
+            stages = self._lambda_plan_stages(lambda_client, configs[function_name], plans[function_name],
+                                              getattr(self, 'deploy_state').pending('deploy', function_name, key))
+            jobs.append((function_name, key, stages, plans[function_name]["current"]))
+        with metrics.phase('ldeploy', 'deploy'):
+            results = self._run_scheduled("deploy", lambda_client, jobs)
+
+        # Keep the order of lambda_function_names, whatever order the functions finished in
+        lambda_mapping = {}
+        for function_name in function_names:
+            lambda_mapping[function_name] = results[function_name]
+        return lambda_mapping
 
-                except Exception as e:
-                    raise DistutilsExecError("Failed to update lambda function: {}".format(e))
-            else:
-                log.info("Creating lambda function '{}'.".format(function_name))
+    def _deploy_key(self, config, code_sha256):
+        """What deploying config means, for recognising the same deploy when resuming it"""
+        settings = dict((key, value) for key, value in config.items() if key != "Code")
+        settings["CodeSha256"] = code_sha256
+        return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _run_scheduled(self, description, lambda_client, jobs):
+        """
+        Move every function of jobs through its stages with the deploy scheduler, returning the
+        results by function name. Every function is attempted, the failures are raised together at
+        the end, and what did succeed is resumed from by the next run.
+        """
+        scheduler = DeployScheduler(
+            lambda_client,
+            workers=getattr(self, 'deploy_workers'),
+            state=getattr(self, 'deploy_state'),
+            timeout=getattr(self, 'wait_timeout'),
+            metrics=get_metrics(self.distribution)
+        )
+        results, errors = scheduler.run(description, jobs)
+        if errors:
+            function_names = [job[0] for job in jobs]
+            raise DistutilsExecError("Failed to {} {} of {} lambda functions, rerun to resume:\n{}".format(
+                description,
+                len(errors),
+                len(function_names),
+                "\n".join("\t{}: {}".format(name, errors[name]) for name in function_names if name in errors)
+            ))
+        return results
+
+    def _client(self, service_name, region=None):
+        """Return the shared client for service_name, sized for the deploy workers"""
+        return get_client_factory(
+            self.distribution,
+            access_key=getattr(self, 'access_key'),
+            secret_access_key=getattr(self, 'secret_access_key'),
+            endpoint_url=getattr(self, 'endpoint_url'),
+            max_pool_connections=getattr(self, 'deploy_workers')
+        ).client(service_name, region)
+
+    def _publish_layer(self, lambda_client, ldist_cmd, runtime):
+        """
+        Return the ARN of the layer version holding ldist's dependency layer, publishing a new
+        version only if none of the existing ones holds the same files for the same runtime
+        """
+        layer_name = getattr(self, 'layer_name') or '{}-dependencies'.format(
+            re.sub('[^a-zA-Z0-9_-]', '-', self.distribution.get_name()))
+        description = 'lambda-setuptools dependencies {}'.format(getattr(ldist_cmd, 'layer_hash'))
+        try:
+            for page in lambda_client.get_paginator('list_layer_versions').paginate(LayerName=layer_name):
+                for version in page.get('LayerVersions', []):
+                    if version.get('Description') == description:
+                        log.info("Layer {} is up to date: {}".format(layer_name, version['LayerVersionArn']))
+                        return version['LayerVersionArn']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'ResourceNotFoundException':
+                raise DistutilsExecError("Failed to list versions of layer {}: {}".format(layer_name, e))
+
+        layer_dist_path = getattr(ldist_cmd, 'layer_dist_path')
+        if getattr(self, 's3_bucket'):
+            content = self._upload_dist(layer_dist_path, getattr(ldist_cmd, 'layer_dist_name'))
+        else:
+            with open(layer_dist_path, 'rb') as zipfile:
+                content = {'ZipFile': zipfile.read()}
+        layer = {
+            'LayerName': layer_name,
+            'Description': description,
+            'Content': content
+        }
+        if runtime:
+            layer['CompatibleRuntimes'] = [runtime]
+        log.info("Publishing a new version of layer {}".format(layer_name))
+        try:
+            r = lambda_client.publish_layer_version(**layer)
+        except ClientError as e:
+            raise DistutilsExecError("Failed to publish layer {}: {}".format(layer_name, e))
+        log.info("\tsuccessfully published: {}".format(r['LayerVersionArn']))
+        return r['LayerVersionArn']
+
+    def _upload_dist(self, dist_path, dist_name):
+        """Upload the dist with lupload and return the Code to create lambda functions from"""
+        lupload_cmd = self.distribution.get_command_obj('lupload')
+        for option in ('access_key', 'secret_access_key', 's3_bucket', 's3_prefix', 'kms_key_id', 'endpoint_url',
+                       'region'):
+            if getattr(self, option) is not None and not getattr(lupload_cmd, option, None):
+                setattr(lupload_cmd, option, getattr(self, option))
+        lupload_cmd.ensure_finalized()
+
+        key = getattr(lupload_cmd, 's3_prefix') + dist_name
+        response = lupload_cmd.upload(dist_path, key)
+        code = {
+            'S3Bucket': getattr(lupload_cmd, 's3_bucket'),
+            'S3Key': key
+        }
+        if response.get('VersionId'):
+            code['S3ObjectVersion'] = response['VersionId']
+        log.info("Deploying s3://{}/{}".format(code['S3Bucket'], key))
+        return code
+
+    def _lambda_inventory(self, lambda_client):
+        """
+        List every function in the region once, returning their configurations by name.
+        Failing to list (throttling, missing permissions, ...) is an error rather than a
+        reason to think the functions don't exist.
+        """
+        inventory = {}
+        try:
+            for page in lambda_client.get_paginator('list_functions').paginate():
+                for function in page.get('Functions', []):
+                    inventory[function['FunctionName']] = function
+        except ClientError as e:
+            raise DistutilsExecError("Failed to list lambda functions: {}".format(e))
+        log.info("Found {} deployed lambda functions in {}".format(len(inventory), getattr(self, 'region')))
+        setattr(self, 'lambda_inventory', inventory)
+        return inventory
+
+    def _lambda_plan_stages(self, lambda_client, config, plan, pending):
+        """
+        The stages deploying plan takes, plus those of pending, left over from the last failed
+        deploy, that the plan can't tell are still needed
+        """
+        function_name = config["FunctionName"]
+        config = copy(config)
+        code = config.pop("Code")
+        publish = config.pop("Publish", False)
+        if "ZipFile" in code and plan["code"]:
+            get_metrics(self.distribution).count('ldeploy.inline_bytes', len(code["ZipFile"]))
+
+        def create():
+            log.info("Creating lambda function '{}'.".format(function_name))
+            r = lambda_client.create_function(Code=code, Publish=publish, **config)
+            log.info("\tsuccessfully created: {}".format(r.get("FunctionArn", "")))
+            return r
+
+        def update_code():
+            code_config = {
+                "FunctionName": function_name,
+                "Publish": publish and not plan["configuration"]
+            }
+            code_config.update(code)
+            return lambda_client.update_function_code(**code_config)
+
+        def update_configuration():
+            # Only the settings update_function_configuration knows about
+            settings = dict((key, value) for key, value in config.items() if key != "Tags")
+            return lambda_client.update_function_configuration(**settings)
+
+        def publish_version():
+            r = lambda_client.publish_version(FunctionName=function_name)
+            log.info("\tpublished version {}".format(r.get("Version", "")))
+            # The published version's ARN is qualified, the API needs the function's
+
+        if plan["action"] == "create":
+            return [Stage("create", create, wait=False)]
+
+        stages = []
+        if plan["code"]:
+            stages.append(Stage("code", update_code))
+        if plan["configuration"]:
+            stages.append(Stage("config", update_configuration))
+        if publish and plan["configuration"] or "publish" in pending:
+            stages.append(Stage("publish", publish_version))
+        if stages and plan["action"] == "unchanged":
+            log.info("\t{}: resuming {}".format(function_name, ", ".join(stage.name for stage in stages)))
+        return stages
+
+    def _permission_updater(self, lambda_client, region, account_id, function_name, source_arn):
+        """
+        Return the permissions stage letting the API gateway at source_arn invoke function_name.
+        The policy is read once and only what differs is written, the new statement being added
+        before the stale ones are removed so that there is no moment without one.
+        """
+        def update_permission():
+            try:
+                policy = json.loads(lambda_client.get_policy(FunctionName=function_name)['Policy'])
+                statements = policy.get('Statement', [])
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'ResourceNotFoundException':
+                    raise
+                statements = []
+            add, remove = plan_permissions(statements, source_arn)
+            metrics = get_metrics(self.distribution)
+            if not add and not remove:
+                log.info("\tPermissions of {} are up to date".format(function_name))
+                return
+
+            if add:
+                log.info("\tAllowing {} to invoke {}".format(source_arn, function_name))
+                lambda_client.add_permission(
+                    FunctionName='arn:aws:lambda:{region}:{account_id}:function:{function_name}'.format(
+                        region=region, account_id=account_id, function_name=function_name),
+                    StatementId=permission_statement_id(source_arn),
+                    Action='lambda:InvokeFunction',
+                    Principal='apigateway.amazonaws.com',
+                    SourceArn=source_arn
+                )
+                metrics.count('ldeploy.permissions_added')
+            for statement_id in remove:
+                log.info("\tRemoving stale permission {} of {}".format(statement_id, function_name))
                 try:
-                    r = lambda_client.create_function(**config)
-                    log.info("successfully created: {}".format(r.get("FunctionArn", "")))
-
-                except Exception as e:
-                    raise DistutilsExecError("Failed to create lambda function: {}".format(e))
-
-            zipfile.close()
-
-            lambda_mapping[function_name] = r
-        return lambda_mapping
+                    lambda_client.remove_permission(FunctionName=function_name, StatementId=statement_id)
+                except ClientError as e:
+                    # Already gone is as good as removed
+                    if e.response.get('Error', {}).get('Code') != 'ResourceNotFoundException':
+                        raise
+                metrics.count('ldeploy.permissions_removed')
+
+        return update_permission
+
+    def _find_rest_api(self, gateway_client, title):
+        """
+        Return the REST API given by rest-api-id, or else the one named title, preferring the ones
+        ldeploy manages and then the newest. None if there is no such API.
+        """
+        rest_api_id = getattr(self, 'rest_api_id')
+        if rest_api_id:
+            try:
+                return gateway_client.get_rest_api(restApiId=rest_api_id)
+            except ClientError as e:
+                raise DistutilsExecError("Failed to get REST API {}: {}".format(rest_api_id, e))
+
+        candidates = []
+        for page in gateway_client.get_paginator('get_rest_apis').paginate():
+            candidates.extend(api for api in page.get('items', []) if api.get('name') == title)
+        if not candidates:
+            return None
+        managed = [api for api in candidates if SPEC_TAG in (api.get('tags') or {})]
+        candidates = sorted(managed or candidates, key=lambda api: str(api.get('createdDate', '')))
+        if len(candidates) > 1:
+            log.warn("{} REST APIs are named {}, updating the newest, {}. Use --rest-api-id to pick another".format(
+                len(candidates), title, candidates[-1]['id']))
+        return candidates[-1]
+
+    def _put_rest_api(self, gateway_client, swagger_doc):
+        """
+        Create or update the REST API of swagger_doc, returning its id and the SHA-256 of the
+        specification. An API that already has this specification is left alone.
+        """
+        region = getattr(self, 'region', None)
+        body = json.dumps(swagger_doc, sort_keys=True)
+        spec_sha256 = hashlib.sha256(body.encode('utf-8')).hexdigest()
+        metrics = get_metrics(self.distribution)
+
+        api = self._find_rest_api(gateway_client, swagger_doc.get("info", {}).get("title"))
+        if api is None:
+            log.info("Creating API gateway from swagger specification")
+            rest_id = gateway_client.import_rest_api(failOnWarnings=True, body=body)['id']
+            metrics.count('ldeploy.api_created')
+        else:
+            rest_id = api['id']
+            if (api.get('tags') or {}).get(SPEC_TAG) == spec_sha256:
+                log.info("API gateway {} is up to date".format(rest_id))
+                metrics.count('ldeploy.api_unchanged')
+                return rest_id, spec_sha256
+            # An API without the tag is put once, API gateway normalizes its exports so they can't be compared
+            log.info("Updating API gateway {} from swagger specification ({})".format(
+                rest_id, getattr(self, 'api_mode')))
+            gateway_client.put_rest_api(restApiId=rest_id, mode=getattr(self, 'api_mode'), failOnWarnings=True,
+                                        body=body)
+            metrics.count('ldeploy.api_updated')
+        gateway_client.tag_resource(resourceArn='arn:aws:apigateway:{}::/restapis/{}'.format(region, rest_id),
+                                    tags={SPEC_TAG: spec_sha256})
+        return rest_id, spec_sha256
+
+    def _stage_deployed(self, gateway_client, rest_id, deploy_stage, spec_sha256):
+        """Whether deploy_stage already has a deployment of the specification with spec_sha256"""
+        try:
+            stage = gateway_client.get_stage(restApiId=rest_id, stageName=deploy_stage)
+            deployment = gateway_client.get_deployment(restApiId=rest_id, deploymentId=stage['deploymentId'])
+        except ClientError:
+            return False
+        return deployment.get('description') == DEPLOYMENT_DESCRIPTION.format(spec_sha256)
 
     def _create_and_deploy_api(self, gw_lambda_mapping):
         swagger_doc = self._create_swagger_doc(gw_lambda_mapping)
-        log.info("Creating API gateway from swagger specification")
 
         region = getattr(self, 'region', None)
 
-        gateway_client = boto3.client('apigateway', region_name=region, aws_access_key_id=getattr(self, 'access_key'),
-                                      aws_secret_access_key=getattr(self, 'secret_access_key'))
+        gateway_client = self._client('apigateway', region)
         deploy_stage = getattr(self, 'deploy_stage')
 
         try:
-            import json
-            resp = gateway_client.import_rest_api(failOnWarnings=True, body=json.dumps(swagger_doc))
+            rest_id, spec_sha256 = self._put_rest_api(gateway_client, swagger_doc)
+            setattr(self, 'rest_api_id', rest_id)
+            log.info("REST API id: {}".format(rest_id))
             if deploy_stage is not None:
-                rest_id = resp.get('id')
-
                 try:
-                    log.info("Creating stage {} and deploying API.".format(deploy_stage))
-                    gateway_client.create_deployment(
-                        restApiId=rest_id,
-                        stageName=deploy_stage)
+                    if self._stage_deployed(gateway_client, rest_id, deploy_stage, spec_sha256):
+                        log.info("Stage {} is up to date.".format(deploy_stage))
+                    else:
+                        log.info("Creating stage {} and deploying API.".format(deploy_stage))
+                        gateway_client.create_deployment(
+                            restApiId=rest_id,
+                            stageName=deploy_stage,
+                            description=DEPLOYMENT_DESCRIPTION.format(spec_sha256))
+                        get_metrics(self.distribution).count('ldeploy.api_deployments')
 
                     log.info("Updating permission")
 
-                    account_id = boto3.client('sts', aws_access_key_id=getattr(self, 'access_key'),
-                                              aws_secret_access_key=getattr(self,
-                                                                            'secret_access_key')).get_caller_identity().get(
-                        'Account')
+                    account_id = self._client('sts').get_caller_identity().get('Account')
+                    lambda_client = self._client('lambda', region)
+                    jobs = []
                     for function_name in gw_lambda_mapping.keys():
-                        log.info("\tUpdating permissions for function {}".format(function_name))
-                        lambda_client = boto3.client('lambda', region_name=region,
-                                                     aws_access_key_id=getattr(self, 'access_key'),
-                                                     aws_secret_access_key=getattr(self, 'secret_access_key'))
                         source_arn = "arn:aws:execute-api:{region}:{account_id}:{rest_id}/{deploy_stage}/ANY/{function_name}".format(
                             deploy_stage=deploy_stage,
                             region=region,
@@ -276,29 +718,19 @@ class LDeploy(Command):
                         #     region=region,
                         #     account_id=account_id,
                         #     rest_id=rest_id)
-                        log.info(source_arn)
-
-                        try:
-                            lambda_client.remove_permission(
-                                FunctionName=function_name,
-                                StatementId='api-gateway-execute'
-                            )
-                        except Exception:
-                            pass
-
-                        lambda_client.add_permission(
-                            FunctionName='arn:aws:lambda:{region}:{account_id}:function:{function_name}'.format(
-                                region=region, account_id=account_id, function_name=function_name),
-                            StatementId='api-gateway-execute',
-                            Action='lambda:InvokeFunction',
-                            Principal='apigateway.amazonaws.com',
-                            SourceArn=source_arn
-                        )
+                        # Permissions can be changed while Lambda updates a function, conflicts are retried
+                        stage = Stage("permissions", self._permission_updater(lambda_client, region, account_id,
+                                                                              function_name, source_arn),
+                                      wait=False)
+                        jobs.append((function_name, source_arn, [stage], None))
+                    self._run_scheduled("update permissions of", lambda_client, jobs)
 
                 except Exception as e:
                     log.error("Failed to deploy API: {}".format(e))
+                    raise DistutilsExecError("Failed to deploy API: {}".format(e))
 
-
+        except DistutilsExecError:
+            raise
         except Exception as e:
             log.error(e)
             raise DistutilsSetupError("Failed to import swagger specification")
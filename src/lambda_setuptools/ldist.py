@@ -1,14 +1,67 @@
+import collections
 import errno
+import hashlib
+import json
 import os
 import re
 import shutil
-import zipfile
+import sys
+import tempfile
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from distutils import log
-from distutils.errors import DistutilsPlatformError, DistutilsInternalError, DistutilsSetupError
+from distutils.errors import DistutilsPlatformError, DistutilsInternalError, DistutilsOptionError, \
+    DistutilsSetupError
 from setuptools import Command
 from subprocess import Popen, PIPE
 
+from lambda_setuptools.archive import DEFAULT_STORE_EXTENSIONS, ZipMember, reproducible_timestamp, write_manifest, \
+    write_zip
+from lambda_setuptools.cache import dependency_cache_key, extract_wheel, file_sha256, find_wheel, \
+    installed_distributions, load_build_cache, remove_files, save_build_cache, wheel_files
+from lambda_setuptools.importgraph import distribution_top_levels, required_top_levels
+from lambda_setuptools.metrics import get_metrics
+from lambda_setuptools import telemetry as telemetry_module
+from lambda_setuptools.slim import DEFAULT_PRUNE_RULES, compile_bytecode, prune, python_version, runtime_version, \
+    strip_shared_objects
+
+
+# The <package_name>_function.py module created for lambda_function
+LAMBDA_FUNCTION_HEADER = '''import importlib
+
+_handlers = {}
+
+
+def _resolve(module, function):
+    handler = _handlers.get((module, function))
+    if handler is None:
+        handler = getattr(importlib.import_module(module), function)
+        _handlers[(module, function)] = handler
+    return handler
+'''
+
+LAMBDA_FUNCTION_TEMPLATE = '''
+
+def {function}(event, context):
+    return _resolve('{module}', '{function}')(event, context)
+'''
+
+# With lambda_telemetry, the runtime half of lambda_setuptools.telemetry is copied next to the
+# generated module and every handler reports its metrics through it
+TELEMETRY_MODULE = '_lambda_setuptools_telemetry'
+
+TELEMETRY_HEADER = '''
+import {telemetry_module} as _telemetry
+
+_telemetry.configure(namespace={namespace!r}, payload_sizes={payload_sizes!r})
+'''
+
+TELEMETRY_FUNCTION_TEMPLATE = '''
+
+{function} = _telemetry.instrument('{name}', lambda: _resolve('{module}', '{function}'))
+'''
+
 
 def validate_lambda_function(dist, attr, value):
     if not isinstance(value, (list, tuple)):
@@ -20,6 +73,21 @@ def validate_lambda_function(dist, attr, value):
                 '{} must be in the form of \'my_package.some_module:some_function:api_gateway_mapping\''.format(attr))
 
 
+def validate_lambda_telemetry(dist, attr, value):
+    if value is None or value is False:
+        setattr(dist, attr, None)
+        return
+    telemetry = {'namespace': telemetry_module.DEFAULT_NAMESPACE, 'payload_sizes': True}
+    if isinstance(value, dict):
+        unknown = set(value) - set(telemetry)
+        if unknown:
+            raise DistutilsSetupError('{} does not know {}'.format(attr, ', '.join(sorted(unknown))))
+        telemetry.update(value)
+    elif value is not True:
+        raise DistutilsSetupError('{} must be True or a dict of {}'.format(attr, ', '.join(sorted(telemetry))))
+    setattr(dist, attr, telemetry)
+
+
 def add_lambda_module_to_py_modules(dist, attr, value):
     py_modules = getattr(dist, 'py_modules', None)
     if not py_modules:
@@ -37,50 +105,302 @@ def validate_lambda_package(dist, attr, value):
 
 class LDist(Command):
     description = 'build a AWS Lambda compatible distribution'
-    user_options = []
+    user_options = [
+        # The format is (long option, short option, description).
+        ('no-build-cache', None, 'Always reinstall all dependencies instead of reusing the ldist build cache'),
+        ('build-cache-expiry=', None, 'Hours after which the dependencies are resolved and installed again, to pick '
+                                      'up new releases of unpinned requirements (optional, defaults to 24, 0 keeps '
+                                      'the build cache until the requirements change)'),
+        ('compress-level=', None, 'Deflate level from 0 (store everything) to 9 (optional, defaults to 6)'),
+        ('store-extensions=', None,
+         'Comma separated file extensions to store without compression (optional, defaults to already '
+         'compressed formats such as .so, .zip, .whl and images)'),
+        ('zip-workers=', None, 'Number of threads used to compress the lambda package, and to unpack the '
+                               'wheels of wheelhouse (optional, defaults to the number of CPUs)'),
+        ('reproducible', None, 'Build a byte for byte reproducible lambda package: sorted entries, fixed '
+                               'timestamps (SOURCE_DATE_EPOCH if set) and normalized permissions'),
+        ('split-functions', None, 'Also build one package per lambda_function, containing only the top level '
+                                  'packages its module imports'),
+        ('function-includes=', None, 'Comma separated modules to add to every split-functions package, for '
+                                     'imports that cannot be found statically (optional)'),
+        ('wheelhouse=', None, 'Persistent directory of wheels to install the dependencies from, filled from the '
+                              'package index only when a requirement is missing (optional)'),
+        ('no-prune', None, 'Keep the files ldist removes by default: byte code from the build host, test suites, '
+                           'dist-info records and C headers'),
+        ('exclude=', None, 'Comma separated globs of files to remove from the lambda package, relative to its '
+                           'root (optional)'),
+        ('strip', None, 'Strip the symbols from shared objects (needs a strip that understands the target '
+                        'architecture)'),
+        ('compile-pyc', None, 'Byte-compile the lambda package, so cold starts skip compilation'),
+        ('python=', None, 'Interpreter used by compile-pyc, must match the Runtime of lambda_config (optional, '
+                          'defaults to the current interpreter)'),
+        ('layer', None, 'Put the dependencies in a separate lambda layer package, versioned by the hash of the '
+                        'installed files and the runtime, and only the project in the lambda package'),
+        ('metrics-report=', None, 'Write phase timings and package sizes to this JSON file (optional)')
+    ]
+    boolean_options = ['no-build-cache', 'reproducible', 'split-functions', 'no-prune', 'strip', 'compile-pyc',
+                       'layer']
 
     def initialize_options(self):
-        pass
+        """Set default values for options."""
+        setattr(self, 'no_build_cache', False)
+        setattr(self, 'build_cache_expiry', 24)
+        setattr(self, 'compress_level', 6)
+        setattr(self, 'store_extensions', None)
+        setattr(self, 'zip_workers', None)
+        setattr(self, 'reproducible', False)
+        setattr(self, 'split_functions', False)
+        setattr(self, 'function_includes', None)
+        setattr(self, 'layer', False)
+        setattr(self, 'wheelhouse', None)
+        setattr(self, 'no_prune', False)
+        setattr(self, 'exclude', None)
+        setattr(self, 'strip', False)
+        setattr(self, 'compile_pyc', False)
+        setattr(self, 'python', None)
+        setattr(self, 'metrics_report', None)
 
     def finalize_options(self):
-        pass
+        """Post-process options."""
+        try:
+            setattr(self, 'compress_level', int(getattr(self, 'compress_level')))
+            if getattr(self, 'zip_workers') is not None:
+                setattr(self, 'zip_workers', int(getattr(self, 'zip_workers')))
+        except ValueError:
+            raise DistutilsOptionError('compress-level and zip-workers must be integers')
+        try:
+            setattr(self, 'build_cache_expiry', float(getattr(self, 'build_cache_expiry')))
+        except ValueError:
+            raise DistutilsOptionError('build-cache-expiry must be a number of hours')
+        if not 0 <= getattr(self, 'compress_level') <= 9:
+            raise DistutilsOptionError('compress-level must be between 0 and 9')
+        function_includes = getattr(self, 'function_includes') or []
+        if not isinstance(function_includes, (list, tuple)):
+            function_includes = [module.strip() for module in function_includes.split(',') if module.strip()]
+        setattr(self, 'function_includes', function_includes)
+        exclude = getattr(self, 'exclude') or []
+        if not isinstance(exclude, (list, tuple)):
+            exclude = [pattern.strip() for pattern in exclude.split(',') if pattern.strip()]
+        setattr(self, 'exclude', exclude)
+        store_extensions = getattr(self, 'store_extensions')
+        if store_extensions is None:
+            setattr(self, 'store_extensions', DEFAULT_STORE_EXTENSIONS)
+        elif not isinstance(store_extensions, (list, tuple)):
+            setattr(self, 'store_extensions', tuple(
+                '.' + ext.strip().lstrip('.') for ext in store_extensions.split(',') if ext.strip()))
 
     def run(self):
         # We must create a distribution to install first
         # This is a short-cut to working with the actual build
         # directory, or to using the 'install' command, which
         # will generally only install a zipped egg
-        self.run_command('bdist_wheel')
-        setattr(self, '_dist_dir', self.get_finalized_command('bdist_wheel').dist_dir)
+        metrics = get_metrics(self.distribution)
+        with metrics.phase('ldist', 'bdist_wheel'):
+            self.run_command('bdist_wheel')
+        bdist_wheel_cmd = self.get_finalized_command('bdist_wheel')
+        setattr(self, '_dist_dir', bdist_wheel_cmd.dist_dir)
+        setattr(self, '_wheel_path', find_wheel(bdist_wheel_cmd.dist_dir, bdist_wheel_cmd.wheel_dist_name))
 
         # Install the package built by bdist_wheel
         # (or bdist, or bdist_wheel, depending on how the user called setup.py
-        self._install_dist_package()
+        with metrics.phase('ldist', 'install'):
+            self._install_dist_package()
+        setattr(self, 'lambda_build_dir', self._lambda_build_dir)
 
         # Use zero (if none specified) or more of the lambda_function, lambda_module or
         # lambda_package attributes to create the lambda entry point function
-        self._create_lambda_entry_point()
+        with metrics.phase('ldist', 'entry point'):
+            self._create_lambda_entry_point()
+
+        self._project_files = set(self._build_cache['project_files'] + self._build_cache['generated_files'])
+
+        # Pruning removes the RECORD files that tell which distribution vendored directories such as
+        # foo.libs belong to, and a cached build directory was pruned by an earlier run
+        owners = distribution_top_levels(self._lambda_build_dir)
+        for entry, entries in self._build_cache.get('owners', {}).items():
+            owners.setdefault(entry, set()).update(entries)
+        self._build_cache['owners'] = dict((entry, sorted(entries)) for entry, entries in owners.items())
+
+        # Trim what Lambda doesn't need and byte-compile what it does
+        with metrics.phase('ldist', 'slim'):
+            self._slim_lambda_package()
+
+        # Now build the lambda package, and the dependency layer if asked for
+        with metrics.phase('ldist', 'zip'):
+            self._build_lambda_package()
+        if getattr(self, 'layer'):
+            with metrics.phase('ldist', 'layer'):
+                self._build_layer_package()
+
+        # And, if asked for, one smaller package per lambda function
+        if getattr(self, 'split_functions'):
+            with metrics.phase('ldist', 'split functions'):
+                self._build_function_packages()
 
-        # Now build the lambda package
-        self._build_lambda_package()
+        # Remember what is installed so the next build can skip pip
+        save_build_cache(self._build_cache_path, self._build_cache)
+
+        if getattr(self, 'metrics_report'):
+            metrics.write(getattr(self, 'metrics_report'))
 
     def _build_lambda_package(self):
         dist_name = '{}-{}.zip'.format(self.distribution.get_name(), self.distribution.get_version())
+        dist_path, manifest_path, manifest = self._write_lambda_package(dist_name, self._lambda_package_members())
+        # Set the resulting distribution file path for downstream command use
+        setattr(self, 'dist_name', dist_name)
+        setattr(self, 'dist_path', dist_path)
+        setattr(self, 'dist_sha256', manifest['CodeSha256'])
+        setattr(self, 'dist_manifest_path', manifest_path)
+        setattr(self, 'dist_manifest', manifest)
+
+    def _build_function_packages(self):
+        targets = getattr(self, 'lambda_function_targets', None)
+        if not targets:
+            log.warn('split-functions needs lambda_function entries with a function name, nothing to split')
+            return
+        always_included = set(self._build_cache['generated_files'])
+        lambda_function_dists = {}
+        for function_name in sorted(targets):
+            module, _ = targets[function_name]
+            try:
+                required = required_top_levels(self._lambda_build_dir, [module], getattr(self, 'function_includes'),
+                                               owners=self._build_cache['owners'])
+            except ImportError as e:
+                raise DistutilsSetupError('Cannot analyze the imports of {}: {}'.format(function_name, e))
+            required.update(always_included)
+            members = [member for member in self._lambda_package_members()
+                       if member.arcname.replace(os.sep, '/').split('/')[0] in required]
+            dist_name = '{}-{}-{}.zip'.format(self.distribution.get_name(), self.distribution.get_version(),
+                                              function_name)
+            dist_path, manifest_path, manifest = self._write_lambda_package(dist_name, members)
+            lambda_function_dists[function_name] = {
+                'dist_name': dist_name,
+                'dist_path': dist_path,
+                'dist_sha256': manifest['CodeSha256'],
+                'dist_manifest_path': manifest_path
+            }
+        setattr(self, 'lambda_function_dists', lambda_function_dists)
+
+    def _slim_lambda_package(self):
+        # Everything that decides what slimming does to the (cached) dependencies
+        self._build_cache['prune'] = self._prune_settings()
+        rules = [] if getattr(self, 'no_prune') else list(DEFAULT_PRUNE_RULES)
+        removed = prune(self._lambda_build_dir, rules, keep=self._project_files)
+        user_rules = [('exclude {}'.format(pattern), (pattern,)) for pattern in getattr(self, 'exclude')]
+        removed.update(prune(self._lambda_build_dir, user_rules))
+        if getattr(self, 'strip'):
+            removed['strip shared objects'] = strip_shared_objects(self._lambda_build_dir)
+        for rule, (files, size) in removed.items():
+            log.info('{}: removed {} bytes from {} files'.format(rule, size, files))
+
+        if getattr(self, 'compile_pyc'):
+            runtime = (getattr(self.distribution, 'lambda_config', None) or {}).get('Runtime', 'python3.6')
+            target_version = runtime_version(runtime)
+            python = getattr(self, 'python') or sys.executable
+            version = python_version(python)
+            if target_version is None or version != target_version:
+                log.warn('not byte-compiling: {} is Python {}, but the runtime is {}. Use --python to point at a '
+                         'Python {} interpreter'.format(python, version, runtime, target_version))
+                return
+            log.info('byte-compiling {} with Python {}'.format(self._lambda_build_dir, version))
+            if not compile_bytecode(self._lambda_build_dir, python, version):
+                log.warn('some files in {} could not be byte-compiled'.format(self._lambda_build_dir))
+
+    def _prune_settings(self):
+        # Byte code is compiled without source checks, so it must never outlive a build that asked for it
+        return {
+            'prune': not getattr(self, 'no_prune'),
+            'exclude': list(getattr(self, 'exclude')),
+            'strip': bool(getattr(self, 'strip')),
+            'compile': (getattr(self, 'python') or sys.executable) if getattr(self, 'compile_pyc') else None
+        }
+
+    def _layer_hash(self, members):
+        """
+        Hash what the layer is: the digest and executable bit of every file going into it, after
+        slimming, and the runtime ldeploy publishes it for
+        """
+        runtime = (getattr(self.distribution, 'lambda_config', None) or {}).get('Runtime')
+        digest = hashlib.sha256(json.dumps({'CompatibleRuntimes': [runtime] if runtime else []}).encode('utf-8'))
+        for member in sorted(members, key=lambda member: member.arcname.replace(os.sep, '/')):
+            digest.update('{}\0{}\0{}\n'.format(member.arcname.replace(os.sep, '/'), file_sha256(member.path),
+                                                 bool(os.stat(member.path).st_mode & 0o111)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _build_layer_package(self):
+        # Lambda puts layers in /opt, and /opt/python is on the path
+        members = [ZipMember(member.path, os.path.join('python', member.arcname))
+                   for member in self._build_dir_members() if not self._is_project_file(member.arcname)]
+        # The layer only changes when what is installed, or the runtime it is for, does
+        layer_hash = self._layer_hash(members)
+        dist_name = '{}-layer-{}.zip'.format(self.distribution.get_name(), layer_hash[:12])
+        dist_path = os.path.join(self._dist_dir, dist_name)
+        manifest_path = os.path.splitext(dist_path)[0] + '.manifest.json'
+        manifest = load_build_cache(manifest_path) if os.path.exists(dist_path) else None
+        if manifest is not None and manifest.get('sha256') == file_sha256(dist_path):
+            log.info('dependencies are unchanged, reusing {}'.format(dist_path))
+        else:
+            dist_path, manifest_path, manifest = self._write_lambda_package(dist_name, members)
+        setattr(self, 'layer_dist_name', dist_name)
+        setattr(self, 'layer_dist_path', dist_path)
+        setattr(self, 'layer_hash', layer_hash)
+        setattr(self, 'layer_sha256', manifest['CodeSha256'])
+
+    def _is_project_file(self, relpath):
+        """Whether relpath (relative to the build dir) comes from our own wheel or from ldist itself"""
+        relpath = relpath.replace(os.sep, '/')
+        directory, filename = os.path.split(relpath)
+        if os.path.basename(directory) == '__pycache__':
+            # Byte code belongs with its source
+            relpath = '/'.join(filter(None, [os.path.dirname(directory), filename.split('.')[0] + '.py']))
+        return relpath in self._project_files
+
+    def _build_dir_members(self):
+        members = []
+        abs_src = os.path.abspath(self._lambda_build_dir)
+        for root, _, files in os.walk(self._lambda_build_dir):
+            for filename in files:
+                absname = os.path.abspath(os.path.join(root, filename))
+                members.append(ZipMember(absname, absname[len(abs_src) + 1:]))
+        if getattr(self, 'reproducible'):
+            members.sort(key=lambda member: member.arcname.replace(os.sep, '/'))
+        return members
+
+    def _lambda_package_members(self):
+        members = self._build_dir_members()
+        if getattr(self, 'layer'):
+            # The dependencies are in the layer
+            members = [member for member in members if self._is_project_file(member.arcname)]
+        return members
+
+    def _write_lambda_package(self, dist_name, members):
         dist_path = os.path.join(self._dist_dir, dist_name)
         if os.path.exists(dist_path):
             os.remove(dist_path)
         log.info('creating {}'.format(dist_path))
-        with zipfile.ZipFile(dist_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-            abs_src = os.path.abspath(self._lambda_build_dir)
-            for root, _, files in os.walk(self._lambda_build_dir):
-                for filename in files:
-                    absname = os.path.abspath(os.path.join(root, filename))
-                    arcname = absname[len(abs_src) + 1:]
-                    log.debug('zipping {} as {}'.format(os.path.join(root, filename), arcname))
-                    zf.write(absname, arcname)
-        # Set the resulting distribution file path for downstream command use
-        setattr(self, 'dist_name', dist_name)
-        setattr(self, 'dist_path', dist_path)
+        reproducible = bool(getattr(self, 'reproducible'))
+        entries = write_zip(dist_path, members,
+                            compress_level=getattr(self, 'compress_level'),
+                            store_extensions=getattr(self, 'store_extensions'),
+                            workers=getattr(self, 'zip_workers'),
+                            date_time=reproducible_timestamp() if reproducible else None,
+                            normalize_permissions=reproducible)
+        bytes_read = sum(entry.file_size for entry in entries)
+        log.info('zipped {} files ({} bytes) into {} ({} bytes)'.format(
+            len(entries),
+            bytes_read,
+            dist_path,
+            os.path.getsize(dist_path)
+        ))
+        metrics = get_metrics(self.distribution)
+        metrics.count('ldist.files_zipped', len(entries))
+        metrics.count('ldist.bytes_read', bytes_read)
+        metrics.count('ldist.bytes_written', os.path.getsize(dist_path))
+        manifest_path = os.path.splitext(dist_path)[0] + '.manifest.json'
+        manifest = write_manifest(manifest_path, dist_name, dist_path, entries, reproducible)
+        log.info('{} CodeSha256 is {}, manifest written to {}'.format(dist_name, manifest['CodeSha256'],
+                                                                      manifest_path))
+        return dist_path, manifest_path, manifest
 
     def _create_lambda_entry_point(self):
         self._create_lambda_function()
@@ -98,30 +418,43 @@ class LDist(Command):
 
         function_file_name = '{}_function.py'.format(package_name)
         function_path = os.path.join(self._lambda_build_dir, function_file_name)
-        function_lines = []
-        modules = []
+        function_lines = [LAMBDA_FUNCTION_HEADER]
+        telemetry = getattr(self.distribution, 'lambda_telemetry', None)
+        if telemetry is not None:
+            self._copy_telemetry_module()
+            function_lines.append(TELEMETRY_HEADER.format(telemetry_module=TELEMETRY_MODULE,
+                                                          namespace=telemetry['namespace'],
+                                                          payload_sizes=bool(telemetry['payload_sizes'])))
+        lambda_function_targets = {}
         for lf in lambda_functions:
-            components = lf.split('.')
-            module = components[0]
-            modules.append('import {}\n'.format(module))
-            function = components[1].split(":")[0]
-            function_lines.append(
-                '{function} = {module}.{function}\n'.format(module=module, function=function)
-            )
-
-            if len(components[1].split(":")) == 2:
-                lambda_function_names[components[1].split(":")[1]] = "{}.{}".format(function_file_name.split(".")[0],
-                                                                               function)
-
-        setattr(self, 'lambda_function_names', lambda_function_names)
+            target, _, function_name = lf.partition(':')
+            module, _, function = target.rpartition('.')
+            # Handlers only import their module the first time they are invoked, so a cold
+            # start pays for the import graph of the handler being called and nothing else
+            if telemetry is not None:
+                function_lines.append(TELEMETRY_FUNCTION_TEMPLATE.format(name=function_name or function,
+                                                                         module=module, function=function))
+            else:
+                function_lines.append(LAMBDA_FUNCTION_TEMPLATE.format(module=module, function=function))
 
-        modules = list(set(modules))
+            if function_name:
+                lambda_function_names[function_name] = "{}.{}".format(function_file_name.split(".")[0], function)
+                lambda_function_targets[function_name] = (module, function)
 
-        function_lines = modules + function_lines
+        setattr(self, 'lambda_function_names', lambda_function_names)
+        setattr(self, 'lambda_function_targets', lambda_function_targets)
 
         log.info('creating {}'.format(function_path))
         with open(function_path, 'w') as py:
             py.writelines(function_lines)
+        self._build_cache['generated_files'].append(function_file_name)
+
+    def _copy_telemetry_module(self):
+        filename = TELEMETRY_MODULE + '.py'
+        source = os.path.splitext(telemetry_module.__file__)[0] + '.py'
+        log.info('copying {} to {}'.format(source, os.path.join(self._lambda_build_dir, filename)))
+        shutil.copy(source, os.path.join(self._lambda_build_dir, filename))
+        self._build_cache['generated_files'].append(filename)
 
     def _copy_lambda_package(self):
         lambda_package = getattr(self.distribution, 'lambda_package', None)
@@ -134,6 +467,7 @@ class LDist(Command):
                 continue
             log.info('copying {} to {}'.format(filepath, self._lambda_build_dir))
             shutil.copy(filepath, self._lambda_build_dir)
+            self._build_cache['generated_files'].append(filename)
 
     def _install_dist_package(self):
         # Get the name of the package that we just built
@@ -141,6 +475,31 @@ class LDist(Command):
         # Get the dist directory that bdist_wheel put the package in
         # Create the lambda build dir
         self._lambda_build_dir = os.path.join('build', 'ldist-' + package_name)
+        self._build_cache_path = self._lambda_build_dir + '.cache.json'
+
+        if self._wheel_path is None:
+            raise DistutilsInternalError('bdist_wheel did not produce a wheel in {}'.format(self._dist_dir))
+        cache_key = dependency_cache_key(self._wheel_path, self._dist_dir)
+        wheel_sha256 = file_sha256(self._wheel_path)
+
+        state = None if getattr(self, 'no_build_cache') else load_build_cache(self._build_cache_path)
+        if state is not None and self._build_cache_valid(state, cache_key):
+            log.info('ldist build cache hit for {}, reusing installed dependencies in {}'.format(
+                package_name, self._lambda_build_dir))
+            # Files from the last run's lambda_function and lambda_package are recreated
+            remove_files(self._lambda_build_dir, state['generated_files'])
+            state['generated_files'] = []
+            if state['wheel_sha256'] == wheel_sha256:
+                log.info('{} is unchanged since the last build'.format(self._wheel_path))
+            else:
+                log.info('syncing {} into {}'.format(self._wheel_path, self._lambda_build_dir))
+                remove_files(self._lambda_build_dir, state['project_files'])
+                state['project_files'] = extract_wheel(self._wheel_path, self._lambda_build_dir)
+                state['wheel_sha256'] = wheel_sha256
+            self._build_cache = state
+            return
+
+        log.info('ldist build cache miss for {}, installing all dependencies'.format(package_name))
         try:
             if os.path.exists(self._lambda_build_dir):
                 shutil.rmtree(self._lambda_build_dir)
@@ -151,16 +510,112 @@ class LDist(Command):
                 pass
             else:
                 raise DistutilsInternalError('{} already exists and is not a directory'.format(self._lambda_build_dir))
-        log.info('installing package {} from {} into {}'.format(package_name,
-                                                                self._dist_dir,
-                                                                self._lambda_build_dir))
-        pip = Popen(['pip', 'install',
-                     '-f', self._dist_dir,
-                     '-t', self._lambda_build_dir, package_name],
-                    stdout=PIPE, stderr=PIPE)
+        if getattr(self, 'wheelhouse'):
+            self._install_from_wheelhouse(package_name)
+        else:
+            log.info('installing package {} from {} into {}'.format(package_name,
+                                                                    self._dist_dir,
+                                                                    self._lambda_build_dir))
+            if not self._pip('install', '-f', self._dist_dir, '-t', self._lambda_build_dir, package_name):
+                raise DistutilsPlatformError('pip returned unsuccessfully')
+
+        # The files of our own wheel are replaced in place on a cache hit, everything else is reused.
+        # pip rewrites the RECORD (and adds INSTALLER, ...) of what it installs, so our own wheel is
+        # unpacked as a cache hit would, for the package not to depend on whether the cache was used
+        project_files = wheel_files(self._wheel_path)
+        remove_files(self._lambda_build_dir, project_files)
+        extract_wheel(self._wheel_path, self._lambda_build_dir)
+        project_dirs = set(name.split('/')[0] for name in project_files)
+        self._build_cache = {
+            'key': cache_key,
+            'dependencies': [name for name in installed_distributions(self._lambda_build_dir)
+                             if name not in project_dirs],
+            'wheel_sha256': wheel_sha256,
+            'project_files': project_files,
+            'generated_files': [],
+            'resolved_at': time.time()
+        }
+        if state is not None:
+            previous, current = set(state.get('dependencies', [])), set(self._build_cache['dependencies'])
+            if previous != current:
+                log.info('resolved dependencies changed: {}'.format(', '.join(
+                    ['-' + name for name in sorted(previous - current)] +
+                    ['+' + name for name in sorted(current - previous)])))
+
+    def _pip(self, *args):
+        pip = Popen(['pip'] + list(args), stdout=PIPE, stderr=PIPE)
         stdout, stderr = pip.communicate()
         log.debug("pip stdout: {}".format(stdout))
         log.debug("pip stderr: {}".format(stderr))
+        return pip.returncode == 0
+
+    def _install_from_wheelhouse(self, package_name):
+        wheelhouse = getattr(self, 'wheelhouse')
+        if not os.path.isdir(wheelhouse):
+            os.makedirs(wheelhouse)
+        # pip wheel copies every wheel the install needs into the staging directory,
+        # which gives us the resolved set without installing anything
+        staging_dir = tempfile.mkdtemp(prefix='ldist-wheels-')
+        try:
+            start = time.time()
+            log.info('resolving {} from {} and {}'.format(package_name, self._dist_dir, wheelhouse))
+            resolved = self._pip('wheel', '--no-index', '-f', self._dist_dir, '-f', wheelhouse,
+                                 '-w', staging_dir, package_name)
+            resolve_time = time.time() - start
+
+            start = time.time()
+            if not resolved:
+                log.info('{} is missing requirements of {}, fetching them'.format(wheelhouse, package_name))
+                if not self._pip('wheel', '-f', self._dist_dir, '-f', wheelhouse, '-w', staging_dir, package_name):
+                    raise DistutilsPlatformError('pip returned unsuccessfully')
+            wheels = sorted(os.path.join(staging_dir, name) for name in os.listdir(staging_dir)
+                            if name.endswith('.whl'))
+            project_wheel_name = os.path.basename(self._wheel_path).split('-')[0]
+            for wheel in wheels:
+                destination = os.path.join(wheelhouse, os.path.basename(wheel))
+                if os.path.basename(wheel).split('-')[0] != project_wheel_name and not os.path.exists(destination):
+                    log.info('adding {} to {}'.format(os.path.basename(wheel), wheelhouse))
+                    shutil.copy(wheel, destination)
+            fetch_time = time.time() - start
+
+            # Wheels are unpacked at once, except for the files several of them have (the __init__.py of
+            # namespace packages such as google). Those are written one wheel at a time, in order, after
+            # the rest, so the same wheel always wins
+            start = time.time()
+            log.info('unpacking {} wheels into {}'.format(len(wheels), self._lambda_build_dir))
+            files = dict((wheel, set(wheel_files(wheel))) for wheel in wheels)
+            counts = collections.Counter(relpath for wheel in wheels for relpath in files[wheel])
+            shared = set(relpath for relpath, count in counts.items() if count > 1)
+            with ThreadPoolExecutor(max_workers=getattr(self, 'zip_workers') or os.cpu_count() or 1) as executor:
+                list(executor.map(lambda wheel: extract_wheel(wheel, self._lambda_build_dir, exclude=shared),
+                                  wheels))
+            for wheel in wheels:
+                if files[wheel] & shared:
+                    extract_wheel(wheel, self._lambda_build_dir, only=shared)
+            unpack_time = time.time() - start
+        finally:
+            shutil.rmtree(staging_dir)
+        log.info('installed {} from {}: resolve {:.2f}s, fetch {:.2f}s, unpack {:.2f}s'.format(
+            package_name, wheelhouse, resolve_time, fetch_time, unpack_time))
+        metrics = get_metrics(self.distribution)
+        metrics.add_phase('ldist', 'wheelhouse resolve', resolve_time)
+        metrics.add_phase('ldist', 'wheelhouse fetch', fetch_time)
+        metrics.add_phase('ldist', 'wheelhouse unpack', unpack_time)
 
-        if pip.returncode is not 0:
-            raise DistutilsPlatformError('pip returned unsuccessfully')
+    def _build_cache_valid(self, state, cache_key):
+        if state.get('key') != cache_key or not os.path.isdir(self._lambda_build_dir):
+            return False
+        # Caches from before the distribution owners were recorded may have lost them to pruning
+        if 'owners' not in state:
+            return False
+        # The key only covers the declared requirements, what they resolve to changes with new releases
+        expiry = getattr(self, 'build_cache_expiry')
+        if 'resolved_at' not in state or expiry and time.time() - state['resolved_at'] > expiry * 3600:
+            log.info('ldist build cache is older than {:g} hours, resolving the dependencies again'.format(expiry))
+            return False
+        # Files pruned from the cached tree can only be brought back by reinstalling
+        if state.get('prune', self._prune_settings()) != self._prune_settings():
+            return False
+        # Make sure nobody has been removing things from the build directory behind our back
+        installed = set(installed_distributions(self._lambda_build_dir))
+        return all(name in installed for name in state.get('dependencies', []))
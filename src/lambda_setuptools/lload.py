@@ -0,0 +1,200 @@
+import json
+import math
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from distutils import log
+from distutils.errors import DistutilsArgError, DistutilsExecError, DistutilsOptionError
+from setuptools import Command
+from subprocess import Popen, PIPE
+
+from lambda_setuptools import container as container_module
+
+
+def percentile(ordered, fraction):
+    """The nearest rank percentile of the sorted list ordered"""
+    if not ordered:
+        return None
+    index = int(math.ceil(fraction * len(ordered))) - 1
+    return ordered[min(max(index, 0), len(ordered) - 1)]
+
+
+def load_events(events_dir):
+    """Return [(file name, event)] for every *.json file in events_dir, in name order"""
+    events = []
+    for filename in sorted(os.listdir(events_dir)):
+        if not filename.endswith('.json'):
+            continue
+        with open(os.path.join(events_dir, filename)) as f:
+            try:
+                events.append((filename, json.load(f)))
+            except ValueError as e:
+                raise DistutilsOptionError('{} is not a JSON event: {}'.format(filename, e))
+    return events
+
+
+class LLoad(Command):
+    description = 'replay recorded events against a lambda function built by ldist, concurrently, and ' \
+                  'report its latency, throughput and memory'
+    user_options = [
+        # The format is (long option, short option, description).
+        ('function=', None, 'Name of the lambda function to load (optional if there is only one)'),
+        ('events=', None, 'Directory of recorded events, one JSON file each'),
+        ('concurrency=', None, 'Number of concurrent invocations (optional, defaults to 4)'),
+        ('mode=', None, 'processes, each a warm container of its own, or threads sharing one container '
+                        '(optional, defaults to processes)'),
+        ('repeat=', None, 'Number of times the events are replayed (optional, defaults to 1)'),
+        ('python=', None, 'Interpreter of the processes, should match the Runtime of lambda_config (optional, '
+                          'defaults to the current interpreter)'),
+        ('report=', None, 'Write the results to this JSON file (optional)')
+    ]
+
+    def initialize_options(self):
+        """Set default values for options."""
+        setattr(self, 'function', None)
+        setattr(self, 'events', None)
+        setattr(self, 'concurrency', 4)
+        setattr(self, 'mode', 'processes')
+        setattr(self, 'repeat', 1)
+        setattr(self, 'python', None)
+        setattr(self, 'report', None)
+
+    def finalize_options(self):
+        """Post-process options."""
+        if getattr(self, 'events') is None or not os.path.isdir(getattr(self, 'events')):
+            raise DistutilsOptionError('events must be a directory of JSON events')
+        try:
+            setattr(self, 'concurrency', int(getattr(self, 'concurrency')))
+            setattr(self, 'repeat', int(getattr(self, 'repeat')))
+        except ValueError:
+            raise DistutilsOptionError('concurrency and repeat must be integers')
+        if getattr(self, 'concurrency') < 1 or getattr(self, 'repeat') < 1:
+            raise DistutilsOptionError('concurrency and repeat must be at least 1')
+        if getattr(self, 'mode') not in ('processes', 'threads'):
+            raise DistutilsOptionError('mode must be processes or threads')
+
+    def run(self):
+        """Run command."""
+        self.run_command('ldist')
+        ldist_cmd = self.get_finalized_command('ldist')
+        build_dir = getattr(ldist_cmd, 'lambda_build_dir', None)
+        lambda_function_names = getattr(ldist_cmd, 'lambda_function_names', None)
+        targets = getattr(ldist_cmd, 'lambda_function_targets', None)
+        if build_dir is None or not lambda_function_names:
+            raise DistutilsArgError('\'ldist\' missing attributes, lload needs lambda_function entries')
+        function_name = getattr(self, 'function')
+        if function_name is None:
+            if len(lambda_function_names) != 1:
+                raise DistutilsOptionError('function is required, one of {}'.format(
+                    ', '.join(sorted(lambda_function_names))))
+            function_name = list(lambda_function_names)[0]
+        if function_name not in lambda_function_names:
+            raise DistutilsOptionError('{} is not one of {}'.format(function_name,
+                                                                   ', '.join(sorted(lambda_function_names))))
+        entry_module, handler_name = lambda_function_names[function_name].rsplit('.', 1)
+        module = targets[function_name][0]
+
+        events = load_events(getattr(self, 'events')) * getattr(self, 'repeat')
+        if not events:
+            raise DistutilsOptionError('{} has no *.json events'.format(getattr(self, 'events')))
+        lambda_config = getattr(self.distribution, 'lambda_config', None) or {}
+        context_settings = {
+            'function_name': function_name,
+            'memory_limit_in_mb': lambda_config.get('MemorySize', 128),
+            'timeout': lambda_config.get('Timeout', 60)
+        }
+        concurrency = min(getattr(self, 'concurrency'), len(events))
+        # Every worker gets its share of the events, in order
+        shares = [events[i::concurrency] for i in range(concurrency)]
+        build_dir = os.path.abspath(build_dir)
+
+        log.info('invoking {} {} times, {} at a time in {}'.format(function_name, len(events), concurrency,
+                                                                 getattr(self, 'mode')))
+        if getattr(self, 'mode') == 'processes':
+            containers = self._run_containers([{
+                'build_dir': build_dir,
+                'entry_module': entry_module,
+                'module': module,
+                'function_name': handler_name,
+                'events': share,
+                'context_settings': context_settings
+            } for share in shares])
+        else:
+            max_rss_before = container_module.max_rss_kib()
+            handler, init_seconds = container_module.load_handler(build_dir, entry_module, module, handler_name)
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(executor.map(
+                    lambda share: container_module.invoke_all(handler, share, context_settings), shares))
+            max_rss = container_module.max_rss_kib()
+            containers = [{
+                'init_ms': init_seconds * 1000,
+                'latencies': [latency for latencies, _ in results for latency in latencies],
+                'errors': [error for _, errors in results for error in errors],
+                # The growth of this process, which also runs setup.py
+                'max_rss_kib': max_rss - max_rss_before if max_rss is not None else None,
+                'start': start,
+                'end': time.time()
+            }]
+
+        # Throughput only counts the invocations, not starting the containers
+        seconds = max(container['end'] for container in containers) - \
+            min(container['start'] for container in containers)
+        report = self._report(function_name, concurrency, containers, seconds)
+        log.info('{invocations} invocations, {errors} errors in {seconds:.2f}s: {throughput:.1f}/s'.format(**report))
+        log.info('latency p50 {p50_ms:.2f}ms, p95 {p95_ms:.2f}ms, p99 {p99_ms:.2f}ms, max {max_ms:.2f}ms'.format(
+            **report))
+        log.info('init {:.1f}ms (slowest container), peak RSS {} KiB (largest container)'.format(
+            report['init_ms'], report['max_rss_kib']))
+        for error in report['error_samples']:
+            log.warn('\t{}'.format(error))
+        if getattr(self, 'report'):
+            with open(getattr(self, 'report'), 'w') as f:
+                json.dump(report, f, sort_keys=True, indent=2)
+            log.info('results written to {}'.format(getattr(self, 'report')))
+        if report['errors'] == report['invocations']:
+            raise DistutilsExecError('every invocation of {} failed'.format(function_name))
+
+    def _run_containers(self, jobs):
+        """
+        Run every job in a fresh interpreter of its own, as cold as a new Lambda container. The
+        interpreter runs the container module as a script, so it needs nothing but the standard
+        library and the handler's package.
+        """
+        python = getattr(self, 'python') or sys.executable
+        script = os.path.abspath(container_module.__file__)
+
+        def run_container(job):
+            process = Popen([python, script], stdin=PIPE, stdout=PIPE)
+            stdout, _ = process.communicate(json.dumps(job).encode('utf-8'))
+            if process.returncode != 0:
+                raise DistutilsExecError('a container of {}.{} failed, see its output above'.format(
+                    job['module'], job['function_name']))
+            return json.loads(stdout.decode('utf-8'))
+
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            return list(executor.map(run_container, jobs))
+
+    def _report(self, function_name, concurrency, containers, seconds):
+        latencies = sorted(latency for container in containers for latency in container['latencies'])
+        errors = [error for container in containers for error in container['errors']]
+        max_rss = [container['max_rss_kib'] for container in containers if container['max_rss_kib'] is not None]
+        return {
+            'function': function_name,
+            'mode': getattr(self, 'mode'),
+            'concurrency': concurrency,
+            'invocations': len(latencies),
+            'errors': len(errors),
+            'error_samples': errors[:5],
+            'seconds': seconds,
+            'throughput': len(latencies) / seconds if seconds else 0.0,
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'max_ms': latencies[-1],
+            'init_ms': max(container['init_ms'] for container in containers),
+            'max_rss_kib': max(max_rss) if max_rss else None
+        }
+
@@ -0,0 +1,225 @@
+import json
+import os
+import re
+import sys
+import zipfile
+
+from distutils import log
+from distutils.errors import DistutilsArgError, DistutilsExecError, DistutilsOptionError
+from setuptools import Command
+from subprocess import Popen, PIPE
+
+from lambda_setuptools.slim import python_version
+
+# Separates the imports of interpreter start up from those of the handler in -X importtime's output
+START_MARKER = 'lprofile: importing handler'
+
+# Run in a fresh interpreter from the build directory: what the first invocation of a handler
+# imports, timed, followed by the peak RSS of the process in KiB
+PROFILE_SCRIPT = '''import importlib, json, resource, sys, time
+sys.path.insert(0, {build_dir!r})
+sys.stderr.write({marker!r} + '\\n')
+sys.stderr.flush()
+start = time.time()
+importlib.import_module({entry_module!r})
+getattr(importlib.import_module({module!r}), {function!r})
+seconds = time.time() - start
+max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+    max_rss //= 1024
+sys.stdout.write(json.dumps({{'seconds': seconds, 'max_rss_kib': max_rss}}))
+'''
+
+# import time: self [us] | cumulative | imported package
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)\s*$')
+
+
+def parse_importtime(stderr):
+    """Return [(module, self us, cumulative us, depth)] of the handler from the -X importtime output in stderr"""
+    modules = []
+    lines = stderr.splitlines()
+    if START_MARKER in lines:
+        lines = lines[lines.index(START_MARKER) + 1:]
+    for line in lines:
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            modules.append((match.group(4), int(match.group(1)), int(match.group(2)),
+                            (len(match.group(3)) - 1) // 2))
+    return modules
+
+
+def top_level_sizes(dist_path, prefix=''):
+    """Return {top level entry: [uncompressed bytes, compressed bytes]} of the ZIP file at dist_path"""
+    sizes = {}
+    with zipfile.ZipFile(dist_path) as dist:
+        for info in dist.infolist():
+            name = info.filename
+            if prefix:
+                if not name.startswith(prefix):
+                    continue
+                name = name[len(prefix):]
+            top_level = name.split('/')[0]
+            if not top_level.endswith('.dist-info'):
+                # foo/, foo.py and foo.cpython-36m-x86_64-linux-gnu.so all are foo
+                top_level = top_level.split('.')[0]
+            size = sizes.setdefault(top_level, [0, 0])
+            size[0] += info.file_size
+            size[1] += info.compress_size
+    return sizes
+
+
+def rank_top_levels(profiles, sizes):
+    """
+    Rank every top level package by the time all the profiled functions spent importing it,
+    then by its size in the lambda package
+    """
+    import_ms = {}
+    for profile in profiles.values():
+        for module in profile['modules']:
+            top_level = module['module'].split('.')[0]
+            import_ms[top_level] = import_ms.get(top_level, 0.0) + module['self_ms']
+    ranked = []
+    for top_level in set(import_ms) | set(sizes):
+        size, compressed = sizes.get(top_level, (0, 0))
+        ranked.append({'top_level': top_level, 'import_ms': import_ms.get(top_level, 0.0), 'bytes': size,
+                       'compressed_bytes': compressed})
+    ranked.sort(key=lambda offender: (offender['import_ms'], offender['bytes']), reverse=True)
+    return ranked
+
+
+class LProfile(Command):
+    description = 'measure the cold start import cost of every lambda function built by ldist'
+    user_options = [
+        # The format is (long option, short option, description).
+        ('budget-ms=', None, 'Fail if importing any lambda function takes longer than this many milliseconds '
+                             '(optional)'),
+        ('python=', None, 'Interpreter to import the functions with, should match the Runtime of lambda_config '
+                          '(optional, defaults to the current interpreter)'),
+        ('repeat=', None, 'Number of fresh interpreters each function is imported in, the median is kept '
+                          '(optional, defaults to 3)'),
+        ('top=', None, 'Number of modules and packages listed as the worst offenders (optional, defaults to 10)'),
+        ('site-packages', None, 'Let the functions import from the site-packages of the interpreter too, e.g. for '
+                                'the boto3 provided by the Lambda runtime'),
+        ('report=', None, 'Write the profile to this JSON file (optional)')
+    ]
+    boolean_options = ['site-packages']
+
+    def initialize_options(self):
+        """Set default values for options."""
+        setattr(self, 'budget_ms', None)
+        setattr(self, 'python', None)
+        setattr(self, 'repeat', 3)
+        setattr(self, 'top', 10)
+        setattr(self, 'site_packages', False)
+        setattr(self, 'report', None)
+
+    def finalize_options(self):
+        """Post-process options."""
+        try:
+            if getattr(self, 'budget_ms') is not None:
+                setattr(self, 'budget_ms', float(getattr(self, 'budget_ms')))
+            setattr(self, 'repeat', int(getattr(self, 'repeat')))
+            setattr(self, 'top', int(getattr(self, 'top')))
+        except ValueError:
+            raise DistutilsOptionError('budget-ms, repeat and top must be numbers')
+        if getattr(self, 'repeat') < 1:
+            raise DistutilsOptionError('repeat must be at least 1')
+
+    def run(self):
+        """Run command."""
+        self.run_command('ldist')
+        ldist_cmd = self.get_finalized_command('ldist')
+        build_dir = getattr(ldist_cmd, 'lambda_build_dir', None)
+        dist_path = getattr(ldist_cmd, 'dist_path', None)
+        if build_dir is None or dist_path is None:
+            raise DistutilsArgError('\'ldist\' missing attributes')
+        lambda_function_names = getattr(ldist_cmd, 'lambda_function_names', None) or {}
+        targets = getattr(ldist_cmd, 'lambda_function_targets', None) or {}
+        if not targets:
+            log.warn('lprofile needs lambda_function entries with a function name, nothing to profile')
+            return
+
+        sizes = top_level_sizes(dist_path)
+        if getattr(ldist_cmd, 'layer_dist_path', None):
+            for top_level, (size, compressed) in top_level_sizes(ldist_cmd.layer_dist_path, 'python/').items():
+                totals = sizes.setdefault(top_level, [0, 0])
+                totals[0] += size
+                totals[1] += compressed
+
+        python = getattr(self, 'python') or sys.executable
+        version = python_version(python)
+        if version is None:
+            raise DistutilsExecError('Cannot run {}'.format(python))
+        # Older interpreters ignore -X importtime without a word
+        importtime = tuple(int(v) for v in version.split('.')) >= (3, 7)
+        if not importtime:
+            log.warn('{} is Python {}, which has no -X importtime (3.7 and later): only the total import time and '
+                     'peak RSS are measured, there is no per module breakdown'.format(python, version))
+
+        profiles = {}
+        for function_name in sorted(targets):
+            entry_module = lambda_function_names[function_name].rsplit('.', 1)[0]
+            module, function = targets[function_name]
+            profiles[function_name] = self._profile(python, importtime, os.path.abspath(build_dir), entry_module,
+                                                    module, function)
+            log.info('{}: imported in {:.1f}ms, peak RSS {} KiB'.format(
+                function_name, profiles[function_name]['import_ms'], profiles[function_name]['max_rss_kib']))
+
+        self._log_offenders(profiles, sizes)
+        if getattr(self, 'report'):
+            with open(getattr(self, 'report'), 'w') as f:
+                json.dump({'functions': profiles, 'sizes': sizes, 'offenders': rank_top_levels(profiles, sizes)},
+                          f, sort_keys=True, indent=2)
+            log.info('profile written to {}'.format(getattr(self, 'report')))
+
+        budget_ms = getattr(self, 'budget_ms')
+        if budget_ms is not None:
+            over = sorted(name for name, profile in profiles.items() if profile['import_ms'] > budget_ms)
+            if over:
+                raise DistutilsExecError('{} of {} lambda functions exceed the cold start budget of {}ms:\n{}'.format(
+                    len(over), len(profiles), budget_ms,
+                    '\n'.join('\t{}: {:.1f}ms'.format(name, profiles[name]['import_ms']) for name in over)))
+            log.info('every lambda function imports within {}ms'.format(budget_ms))
+
+    def _profile(self, python, importtime, build_dir, entry_module, module, function):
+        """Import function in repeat fresh interpreters, returning the run with the median import time"""
+        args = [python] + (['-X', 'importtime'] if importtime else []) + ['-E', '-s']
+        if not getattr(self, 'site_packages'):
+            args.append('-S')
+        script = PROFILE_SCRIPT.format(build_dir=build_dir, marker=START_MARKER, entry_module=entry_module, module=module,
+                                       function=function)
+        runs = []
+        for _ in range(getattr(self, 'repeat')):
+            process = Popen(args + ['-c', script], cwd=build_dir, stdout=PIPE, stderr=PIPE)
+            stdout, stderr = process.communicate()
+            stderr = stderr.decode('utf-8', 'replace')
+            if process.returncode != 0:
+                raise DistutilsExecError('Cannot import {}.{} from {}:\n{}'.format(
+                    module, function, build_dir,
+                    '\n'.join(line for line in stderr.splitlines()
+                              if line != START_MARKER and not line.startswith('import time:'))))
+            result = json.loads(stdout.decode('utf-8'))
+            runs.append((result['seconds'], result['max_rss_kib'], parse_importtime(stderr)))
+        runs.sort(key=lambda run: run[0])
+        seconds, max_rss_kib, modules = runs[len(runs) // 2]
+        return {
+            'import_ms': seconds * 1000,
+            'max_rss_kib': max_rss_kib,
+            'modules': [{'module': name, 'self_ms': self_us / 1000.0, 'cumulative_ms': cumulative_us / 1000.0,
+                         'depth': depth}
+                        for name, self_us, cumulative_us, depth in modules]
+        }
+
+    def _log_offenders(self, profiles, sizes):
+        top = getattr(self, 'top')
+        for function_name in sorted(profiles):
+            modules = sorted(profiles[function_name]['modules'], key=lambda m: m['self_ms'], reverse=True)
+            log.info('{}: slowest imports'.format(function_name))
+            for module in modules[:top]:
+                log.info('\t{:>9.1f}ms self {:>9.1f}ms cumulative  {}'.format(
+                    module['self_ms'], module['cumulative_ms'], module['module']))
+
+        log.info('worst top level packages:')
+        for offender in rank_top_levels(profiles, sizes)[:top]:
+            log.info('\t{:>9.1f}ms import {:>12} bytes {:>12} compressed  {}'.format(
+                offender['import_ms'], offender['bytes'], offender['compressed_bytes'], offender['top_level']))
@@ -1,11 +1,19 @@
-import boto3
 import json
+import os
 
-from botocore.client import Config
+from botocore.exceptions import ClientError
 from distutils import log
 from distutils.errors import DistutilsArgError, DistutilsOptionError
 from setuptools import Command
 
+from lambda_setuptools.cache import file_sha256
+from lambda_setuptools.clients import get_client_factory
+from lambda_setuptools.metrics import get_metrics
+from lambda_setuptools.multipart import MIN_PART_SIZE, upload_file
+
+# Object metadata holding the SHA-256 of the uploaded dist, used to skip identical uploads
+SHA256_METADATA_KEY = 'sha256'
+
 
 class LUpload(Command):
     description = 'upload the result of the ldist command to S3'
@@ -15,8 +23,17 @@ class LUpload(Command):
         ('s3-prefix=', None, 'The prefix to use when uploading the dist (optional)'),
         ('kms-key-id=', None, 'The KMS key to use on upload (optional, but recommended)'),
         ('secret-access-key=', None, 'The secret access to use to upload'),
-        ('s3-bucket=', None, 'The bucket to upload to')
+        ('s3-bucket=', None, 'The bucket to upload to'),
+        ('part-size=', None, 'Size in MiB of each part of a multipart upload (optional, defaults to 8, minimum 5)'),
+        ('max-concurrency=', None, 'Number of parts to upload at the same time (optional, defaults to 4)'),
+        ('part-retries=', None, 'Number of times to retry a part failing with a transient error (optional, '
+                                'defaults to 3)'),
+        ('endpoint-url=', None, 'Use this endpoint instead of AWS, e.g. a local S3 stand-in (optional)'),
+        ('region=', None, 'The region of the bucket (optional, defaults to the region set in the environment)'),
+        ('force', None, 'Upload even if the object in S3 already has the same content (optional)'),
+        ('metrics-report=', None, 'Write phase timings, sizes and AWS API statistics to this JSON file (optional)')
     ]
+    boolean_options = ['force']
 
     def initialize_options(self):
         """Set default values for options."""
@@ -26,6 +43,13 @@ class LUpload(Command):
         setattr(self, 's3_prefix', '')
         setattr(self, 'secret_access_key', None)
         setattr(self, 's3_bucket', None)
+        setattr(self, 'part_size', 8)
+        setattr(self, 'max_concurrency', 4)
+        setattr(self, 'part_retries', 3)
+        setattr(self, 'endpoint_url', None)
+        setattr(self, 'region', None)
+        setattr(self, 'force', False)
+        setattr(self, 'metrics_report', None)
 
     def finalize_options(self):
         """Post-process options."""
@@ -33,6 +57,16 @@ class LUpload(Command):
                         getattr(self, 'secret_access_key') is None or \
                         getattr(self, 's3_bucket') is None:
             raise DistutilsOptionError('access-key, secret-access-key, s3-bucket are required')
+        try:
+            setattr(self, 'part_size', int(getattr(self, 'part_size')))
+            setattr(self, 'max_concurrency', int(getattr(self, 'max_concurrency')))
+            setattr(self, 'part_retries', int(getattr(self, 'part_retries')))
+        except ValueError:
+            raise DistutilsOptionError('part-size, max-concurrency and part-retries must be integers')
+        if getattr(self, 'part_size') * 1024 * 1024 < MIN_PART_SIZE:
+            raise DistutilsOptionError('part-size must be at least 5 (MiB)')
+        if getattr(self, 'max_concurrency') < 1:
+            raise DistutilsOptionError('max-concurrency must be at least 1')
 
     def run(self):
         """Run command."""
@@ -42,34 +76,99 @@ class LUpload(Command):
         dist_name = getattr(ldist_cmd, 'dist_name', None)
         if dist_path is None or dist_name is None:
             raise DistutilsArgError('\'ldist\' missing attributes')
-        dist_name = getattr(self, 's3_prefix') + dist_name
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=getattr(self, 'access_key'),
-            aws_secret_access_key=getattr(self, 'secret_access_key'),
-            config=Config(signature_version='s3v4')
+        response = self.upload(dist_path, getattr(self, 's3_prefix') + dist_name)
+        if getattr(self, 'metrics_report'):
+            get_metrics(self.distribution).write(getattr(self, 'metrics_report'))
+        if getattr(self, 'upload_skipped'):
+            return
+        log.info('upload complete:\n{}'.format(
+            json.dumps(response, sort_keys=True, indent=4, separators=(',', ': '), default=str))
         )
+
+    def upload(self, path, key):
+        """
+        Upload the file at path to key in the configured bucket, returning the S3 response.
+        If the object already in S3 has the same SHA-256 the upload is skipped and the
+        response of the HEAD request is returned instead.
+        """
+        s3 = get_client_factory(
+            self.distribution,
+            access_key=getattr(self, 'access_key'),
+            secret_access_key=getattr(self, 'secret_access_key'),
+            endpoint_url=getattr(self, 'endpoint_url'),
+            max_pool_connections=getattr(self, 'max_concurrency')
+        ).client('s3', getattr(self, 'region'))
+        metrics = get_metrics(self.distribution)
+        with metrics.phase('lupload', 'hash'):
+            sha256 = file_sha256(path)
+        setattr(self, 's3_key', key)
+        setattr(self, 'upload_skipped', False)
+        if not getattr(self, 'force'):
+            with metrics.phase('lupload', 'head'):
+                existing = self._head_object(s3, key)
+            if existing is not None and existing.get('Metadata', {}).get(SHA256_METADATA_KEY) == sha256 and \
+                    self._encrypted_as_configured(existing):
+                log.info('skipping upload of {}, s3://{}/{} is unchanged (saved {} bytes)'.format(
+                    path, getattr(self, 's3_bucket'), key, os.path.getsize(path)))
+                metrics.count('lupload.bytes_skipped', os.path.getsize(path))
+                setattr(self, 'upload_skipped', True)
+                return existing
+            if existing is not None:
+                log.info('s3://{}/{} has changed, uploading'.format(getattr(self, 's3_bucket'), key))
         log.info('uploading {} to {} using kms key {}'.format(
-            dist_name,
+            key,
             getattr(self, 's3_bucket'),
             getattr(self, 'kms_key_id')
         ))
-        with open(dist_path) as dist:
-            if getattr(self, 'kms_key_id'):
-                response = s3.put_object(
-                    Body=dist,
-                    Bucket=getattr(self, 's3_bucket'),
-                    Key=dist_name,
-                    ServerSideEncryption='aws:kms',
-                    SSEKMSKeyId=getattr(self, 'kms_key_id')
-                )
-            else:
-                response = s3.put_object(
-                    Body=dist,
-                    Bucket=getattr(self, 's3_bucket'),
-                    Key=dist_name,
-                    ServerSideEncryption='AES256'
-                )
-        log.info('upload complete:\n{}'.format(
-            json.dumps(response, sort_keys=True, indent=4, separators=(',', ': ')))
-        )
+        extra_args = self._encryption_args()
+        extra_args['Metadata'] = {SHA256_METADATA_KEY: sha256}
+        with metrics.phase('lupload', 'upload'):
+            response = upload_file(
+                s3,
+                path,
+                getattr(self, 's3_bucket'),
+                key,
+                extra_args=extra_args,
+                part_size=getattr(self, 'part_size') * 1024 * 1024,
+                max_concurrency=getattr(self, 'max_concurrency'),
+                retries=getattr(self, 'part_retries')
+            )
+        metrics.count('lupload.bytes_uploaded', os.path.getsize(path))
+        return response
+
+    def _encryption_args(self):
+        if getattr(self, 'kms_key_id'):
+            return {
+                'ServerSideEncryption': 'aws:kms',
+                'SSEKMSKeyId': getattr(self, 'kms_key_id')
+            }
+        return {
+            'ServerSideEncryption': 'AES256'
+        }
+
+    def _encrypted_as_configured(self, head):
+        """Whether the object of the HEAD response head is encrypted the way an upload would encrypt it"""
+        expected = self._encryption_args()
+        if head.get('ServerSideEncryption') != expected['ServerSideEncryption']:
+            return False
+        if 'SSEKMSKeyId' not in expected:
+            return True
+        # S3 reports the ARN of the key, kms-key-id may be the ARN or the key id
+        key_id = head.get('SSEKMSKeyId') or ''
+        return key_id == expected['SSEKMSKeyId'] or key_id.endswith(':key/' + expected['SSEKMSKeyId'])
+
+    def _head_object(self, s3, key):
+        """Return the HEAD response for key, or None if it doesn't exist or can't be read"""
+        try:
+            return s3.head_object(Bucket=getattr(self, 's3_bucket'), Key=key)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code in ('404', 'NoSuchKey', 'NotFound'):
+                log.info('s3://{}/{} does not exist, uploading'.format(getattr(self, 's3_bucket'), key))
+                return None
+            # Without s3:GetObject (or s3:ListBucket, for missing keys) S3 answers HEAD with 403
+            if code in ('403', 'AccessDenied', 'Forbidden'):
+                log.warn('cannot check whether s3://{}/{} is unchanged ({}), uploading'.format(
+                    getattr(self, 's3_bucket'), key, e))
+                return None
+            raise
@@ -0,0 +1,107 @@
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+from distutils import log
+
+
+class Metrics(object):
+    """
+    Timings, sizes and AWS API statistics collected by ldist, lupload and ldeploy during one
+    setup.py run, written out as a JSON report by whichever command has metrics-report set
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases = []
+        self._counters = {}
+        self._api_calls = {}
+        self._functions = {}
+
+    @contextmanager
+    def phase(self, command, name):
+        """Time the wrapped block as phase name of command"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(command, name, time.time() - start)
+
+    def add_phase(self, command, name, seconds):
+        """Record a phase timed by the caller"""
+        log.debug('{} {} took {:.3f}s'.format(command, name, seconds))
+        with self._lock:
+            self._phases.append({'command': command, 'phase': name, 'seconds': seconds})
+
+    def count(self, name, value=1):
+        """Add value to counter name (files zipped, bytes uploaded, ...)"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def api_call(self, operation, seconds, retries=0, error=None, function_name=None):
+        """Record one AWS API call, operation being e.g. lambda.UpdateFunctionCode"""
+        with self._lock:
+            stats = self._api_calls.setdefault(operation, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                           'retries': 0, 'errors': 0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['retries'] += retries
+            stats['errors'] += 1 if error is not None else 0
+            if function_name is not None:
+                calls = self._functions.setdefault(function_name, [])
+                calls.append({'operation': operation, 'seconds': seconds, 'retries': retries, 'error': error})
+
+    def report(self):
+        with self._lock:
+            return {
+                'phases': list(self._phases),
+                'counters': dict(self._counters),
+                'api_calls': dict((k, dict(v)) for k, v in self._api_calls.items()),
+                'functions': dict((k, list(v)) for k, v in self._functions.items())
+            }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, sort_keys=True, indent=2)
+        log.info('metrics report written to {}'.format(path))
+
+    def instrument_client(self, client):
+        """Record the latency and retries of every call client makes"""
+        service = client.meta.service_model.service_name
+
+        def before_call(params, model, context, **kwargs):
+            context['lambda_setuptools_call'] = (model.name, params.get('FunctionName'), time.time())
+
+        def after_call(context, parsed=None, exception=None, http_response=None, **kwargs):
+            call = context.pop('lambda_setuptools_call', None)
+            if call is None:
+                return
+            operation, function_name, start = call
+            retries = 0
+            error = str(exception) if exception is not None else None
+            if parsed is not None:
+                retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+                # Errors AWS returns (throttling, conflicts, ...) come back parsed, not raised
+                if parsed.get('Error'):
+                    error = '{}: {}'.format(parsed['Error'].get('Code'), parsed['Error'].get('Message'))
+            status_code = getattr(http_response, 'status_code', None)
+            if error is None and status_code is not None and status_code >= 300:
+                error = 'HTTP {}'.format(status_code)
+            self.api_call('{}.{}'.format(service, operation), time.time() - start, retries=retries,
+                          error=error, function_name=function_name)
+
+        # The emitter belongs to this client, so these only see its own calls
+        client.meta.events.register('before-parameter-build', before_call)
+        client.meta.events.register('after-call', after_call)
+        client.meta.events.register('after-call-error', after_call)
+
+
+def get_metrics(dist):
+    """Return the Metrics shared by every command of dist"""
+    metrics = getattr(dist, '_lambda_metrics', None)
+    if metrics is None:
+        metrics = Metrics()
+        setattr(dist, '_lambda_metrics', metrics)
+    return metrics
@@ -0,0 +1,84 @@
+import mmap
+import os
+import time
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+from concurrent.futures import ThreadPoolExecutor
+from distutils import log
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Errors worth another attempt even after the client's own retries gave up on them
+TRANSIENT_ERRORS = ('RequestTimeout', 'SlowDown', 'InternalError', 'ServiceUnavailable', 'Throttling')
+
+
+def _transient(e):
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Code') in TRANSIENT_ERRORS
+    return isinstance(e, (ConnectionError, HTTPClientError))
+
+
+def _retry(description, fn, retries, backoff=0.5):
+    """Call fn, retrying transient errors up to retries times with exponential backoff"""
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= retries or not _transient(e):
+                raise
+            delay = backoff * (2 ** attempt)
+            attempt += 1
+            log.warn('{} failed ({}), retrying in {:.1f}s ({}/{})'.format(description, e, delay, attempt, retries))
+            time.sleep(delay)
+
+
+def upload_file(s3, path, bucket, key, extra_args=None, part_size=8 * 1024 * 1024, max_concurrency=4, retries=3):
+    """
+    Upload the file at path to s3://bucket/key.
+
+    Files no larger than part_size go up with a single put_object. Anything larger is
+    memory-mapped and sent as a multipart upload, max_concurrency parts at a time, with
+    each part retried on its own if it still fails with a transient error after the client's
+    retries. extra_args (encryption settings, metadata, ...) are passed to put_object or
+    create_multipart_upload. Returns the final S3 response.
+    """
+    extra_args = extra_args or {}
+    size = os.path.getsize(path)
+    if size <= part_size:
+        def put_object():
+            with open(path, 'rb') as body:
+                return s3.put_object(Body=body, Bucket=bucket, Key=key, **extra_args)
+        return _retry('upload of {}'.format(key), put_object, retries)
+
+    part_size = max(part_size, MIN_PART_SIZE)
+    part_count = (size + part_size - 1) // part_size
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, **extra_args)['UploadId']
+    log.info('uploading {} ({} bytes) in {} parts of {} bytes'.format(key, size, part_count, part_size))
+    try:
+        with open(path, 'rb') as f:
+            body = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                def upload_part(part_number):
+                    start = (part_number - 1) * part_size
+                    # Slicing the map only pages in (and copies) this part of the file
+                    data = body[start:start + part_size]
+                    response = _retry(
+                        'upload of part {} of {}'.format(part_number, key),
+                        lambda: s3.upload_part(Body=data, Bucket=bucket, Key=key,
+                                               PartNumber=part_number, UploadId=upload_id),
+                        retries
+                    )
+                    log.debug('uploaded part {}/{} of {}'.format(part_number, part_count, key))
+                    return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+                with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                    parts = list(executor.map(upload_part, range(1, part_count + 1)))
+            finally:
+                body.close()
+        return s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                            MultipartUpload={'Parts': parts})
+    except Exception:
+        log.error('aborting multipart upload of {}'.format(key))
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
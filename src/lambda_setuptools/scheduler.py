@@ -0,0 +1,248 @@
+import heapq
+import json
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from distutils import log
+
+# Errors Lambda returns while a function is still being created or updated, or when throttling
+RETRYABLE_ERRORS = ('ResourceConflictException', 'TooManyRequestsException', 'ResourceNotReadyException')
+
+
+class Stage(object):
+    """
+    One step of deploying a function. fn takes no arguments and returns the function's
+    configuration, or None to keep the previous one. Unless wait is False, the function is
+    polled until no create or update is in progress before fn is called.
+    """
+
+    def __init__(self, name, fn, wait=True):
+        self.name = name
+        self.fn = fn
+        self.wait = wait
+
+
+class DeployState(object):
+    """
+    The stages of every function of the last, unfinished, run, kept in a JSON file so that a
+    failed run can be resumed. Stages are remembered with the key of what was being deployed,
+    they only count for a run that deploys the same thing.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._state = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._state = json.load(f)
+            except (IOError, ValueError) as e:
+                log.warn('ignoring unreadable deploy state {}: {}'.format(path, e))
+
+    def pending(self, run, function_name, key):
+        """The stages of function_name that run didn't finish last time, if it was deploying key"""
+        entry = self._state.get(run, {}).get(function_name)
+        if entry is None or entry.get('key') != key:
+            return []
+        return [stage for stage in entry['stages'] if stage not in entry['done']]
+
+    def start(self, run, function_name, key, stages):
+        with self._lock:
+            self._state.setdefault(run, {})[function_name] = {'key': key, 'stages': list(stages), 'done': []}
+            self._save()
+
+    def forget(self, run, function_name):
+        """Drop what is remembered of function_name, which run has nothing left to do for"""
+        with self._lock:
+            if function_name not in self._state.get(run, {}):
+                return
+            del self._state[run][function_name]
+            if not self._state[run]:
+                del self._state[run]
+            self._save()
+
+    def done(self, run, function_name, stage):
+        with self._lock:
+            entry = self._state[run][function_name]
+            entry['done'].append(stage)
+            if len(entry['done']) == len(entry['stages']):
+                del self._state[run][function_name]
+                if not self._state[run]:
+                    del self._state[run]
+            self._save()
+
+    def _save(self):
+        if self._path is None:
+            return
+        if not self._state:
+            if os.path.exists(self._path):
+                os.remove(self._path)
+            return
+        with open(self._path + '.tmp', 'w') as f:
+            json.dump(self._state, f, sort_keys=True, indent=2)
+        os.rename(self._path + '.tmp', self._path)
+
+
+class _Function(object):
+    def __init__(self, name, stages, result):
+        self.name = name
+        self.stages = stages
+        self.index = 0
+        self.result = result
+        self.error = None
+        self.delay = None
+        self.retries = 0
+        self.waiting_since = None
+
+
+class DeployScheduler(object):
+    """
+    Moves many lambda functions through their stages at once. Every function goes through its
+    stages in order, waiting (by polling State and LastUpdateStatus with exponential backoff) for
+    Lambda to finish the previous one and retrying when Lambda reports a conflict. Waiting never
+    holds a worker, so a slow function doesn't hold up the others, and a failing function doesn't
+    stop them. Completed stages are recorded in a DeployState.
+    """
+
+    def __init__(self, lambda_client, workers=4, state=None, poll_interval=1.0, max_poll_interval=20.0,
+                 timeout=600.0, retries=8, metrics=None):
+        self._lambda_client = lambda_client
+        self._workers = workers
+        self._state = state if state is not None else DeployState(None)
+        self._poll_interval = poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._timeout = timeout
+        self._retries = retries
+        self._metrics = metrics
+
+    def run(self, run, jobs):
+        """
+        jobs is [(function name, key, [Stage], result)], result being what is returned for a
+        function without stages. Returns ({function name: result}, {function name: error message}).
+        """
+        functions = []
+        for function_name, key, stages, result in jobs:
+            functions.append(_Function(function_name, stages, result))
+            if stages:
+                self._state.start(run, function_name, key, [stage.name for stage in stages])
+            else:
+                self._state.forget(run, function_name)
+
+        queue = []
+        sequence = [0]
+
+        def schedule(function, due, action):
+            sequence[0] += 1
+            heapq.heappush(queue, (due, sequence[0], function, action))
+
+        for function in functions:
+            if function.stages:
+                self._next_stage(function, schedule)
+
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            while queue or in_flight:
+                now = time.time()
+                while queue and queue[0][0] <= now and len(in_flight) < self._workers:
+                    _, _, function, action = heapq.heappop(queue)
+                    if action == 'poll':
+                        future = executor.submit(self._poll, function)
+                    else:
+                        future = executor.submit(function.stages[function.index].fn)
+                    in_flight[future] = (function, action)
+                timeout = max(queue[0][0] - time.time(), 0) if queue and len(in_flight) < self._workers else None
+                if not in_flight:
+                    time.sleep(timeout or 0)
+                    continue
+                done, _ = wait(list(in_flight), timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    function, action = in_flight.pop(future)
+                    if action == 'poll':
+                        self._polled(function, future, schedule)
+                    else:
+                        self._staged(run, function, future, schedule)
+
+        results = dict((function.name, function.result) for function in functions if function.error is None)
+        errors = dict((function.name, function.error) for function in functions if function.error is not None)
+        return results, errors
+
+    def _next_stage(self, function, schedule):
+        function.delay = None
+        function.waiting_since = time.time()
+        stage = function.stages[function.index]
+        schedule(function, time.time(), 'poll' if stage.wait else 'stage')
+
+    def _backoff(self, function):
+        """The next polling delay of function, exponential with jitter"""
+        if function.delay is None:
+            function.delay = self._poll_interval
+        else:
+            function.delay = min(function.delay * 2, self._max_poll_interval)
+        return function.delay * random.uniform(0.8, 1.2)
+
+    def _count(self, name):
+        if self._metrics is not None:
+            self._metrics.count(name)
+
+    def _poll(self, function):
+        self._count('ldeploy.state_polls')
+        return self._lambda_client.get_function_configuration(FunctionName=function.name)
+
+    def _polled(self, function, future, schedule):
+        stage = function.stages[function.index]
+        try:
+            config = future.result()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in RETRYABLE_ERRORS:
+                schedule(function, time.time() + self._backoff(function), 'poll')
+                return
+            self._fail(function, e)
+            return
+        state = config.get('State', 'Active')
+        update_status = config.get('LastUpdateStatus', 'Successful')
+        if state == 'Failed' or update_status == 'Failed':
+            self._fail(function, '{} ({})'.format(
+                'the function is in a failed state' if state == 'Failed' else 'its last update failed',
+                config.get('StateReason') or config.get('LastUpdateStatusReason') or 'no reason given'))
+            return
+        if state == 'Pending' or update_status == 'InProgress':
+            if time.time() - function.waiting_since > self._timeout:
+                self._fail(function, 'gave up waiting {:g}s for the function to be ready'.format(self._timeout))
+                return
+            log.debug('{} is {}, waiting to {}'.format(function.name, state if state == 'Pending' else 'updating',
+                                                        stage.name))
+            schedule(function, time.time() + self._backoff(function), 'poll')
+            return
+        schedule(function, time.time(), 'stage')
+
+    def _fail(self, function, error):
+        function.error = '{} failed: {}'.format(function.stages[function.index].name, error)
+        log.error('\t{}: {}'.format(function.name, function.error))
+
+    def _staged(self, run, function, future, schedule):
+        stage = function.stages[function.index]
+        try:
+            result = future.result()
+        except Exception as e:
+            code = e.response.get('Error', {}).get('Code') if isinstance(e, ClientError) else None
+            if code in RETRYABLE_ERRORS and function.retries < self._retries:
+                function.retries += 1
+                self._count('ldeploy.conflict_retries')
+                log.info('\t{}: {} ({}), retrying {}'.format(function.name, code, stage.name, function.retries))
+                schedule(function, time.time() + self._backoff(function), 'poll' if stage.wait else 'stage')
+                return
+            self._fail(function, e)
+            return
+        if result is not None:
+            function.result = result
+        function.retries = 0
+        self._state.done(run, function.name, stage.name)
+        log.info('\t{}: {} done'.format(function.name, stage.name))
+        function.index += 1
+        if function.index < len(function.stages):
+            self._next_stage(function, schedule)
@@ -0,0 +1,89 @@
+import collections
+import fnmatch
+import os
+import re
+
+from distutils import log
+from subprocess import Popen, PIPE
+
+# (rule name, globs matched against the path of each file relative to the build directory)
+DEFAULT_PRUNE_RULES = (
+    ('bytecode', ('*.pyc', '*.pyo')),
+    ('tests', ('tests/*', 'test/*', '*/tests/*', '*/test/*')),
+    ('dist-info records', ('*.dist-info/RECORD', '*.dist-info/INSTALLER', '*.dist-info/REQUESTED',
+                           '*.dist-info/direct_url.json')),
+    ('headers', ('*.h', '*.hpp', '*.pxd', '*.pyx')),
+)
+
+
+def prune(build_dir, rules, keep=()):
+    """
+    Remove every file of build_dir matching one of rules, except the relative paths in keep.
+    Returns {rule name: [files removed, bytes removed]} in the order of rules.
+    """
+    removed = collections.OrderedDict((name, [0, 0]) for name, _ in rules)
+    keep = set(keep)
+    for root, _, files in os.walk(build_dir):
+        for filename in files:
+            path = os.path.join(root, filename)
+            relpath = os.path.relpath(path, build_dir).replace(os.sep, '/')
+            if relpath in keep:
+                continue
+            for name, patterns in rules:
+                if any(fnmatch.fnmatchcase(relpath, pattern) for pattern in patterns):
+                    removed[name][0] += 1
+                    removed[name][1] += os.path.getsize(path)
+                    os.remove(path)
+                    break
+    # Clean up whatever directories that left empty, deepest first
+    for root, dirs, files in os.walk(build_dir, topdown=False):
+        if root != build_dir and not os.listdir(root):
+            os.rmdir(root)
+    return removed
+
+
+def strip_shared_objects(build_dir, strip='strip'):
+    """Strip the symbols of every shared object in build_dir, returning [files stripped, bytes removed]"""
+    stripped = [0, 0]
+    for root, _, files in os.walk(build_dir):
+        for filename in files:
+            if not (filename.endswith('.so') or '.so.' in filename):
+                continue
+            path = os.path.join(root, filename)
+            size = os.path.getsize(path)
+            process = Popen([strip, '--strip-unneeded', path], stdout=PIPE, stderr=PIPE)
+            _, stderr = process.communicate()
+            if process.returncode != 0:
+                log.warn('could not strip {}: {}'.format(path, stderr.strip()))
+                continue
+            stripped[0] += 1
+            stripped[1] += size - os.path.getsize(path)
+    return stripped
+
+
+def python_version(python):
+    """Return the major.minor version of the interpreter python"""
+    process = Popen([python, '-c', 'import sys; print("%d.%d" % sys.version_info[:2])'], stdout=PIPE, stderr=PIPE)
+    stdout, _ = process.communicate()
+    if process.returncode != 0:
+        return None
+    return stdout.decode('ascii').strip()
+
+
+def runtime_version(runtime):
+    """Return the major.minor Python version of a Lambda runtime name such as python3.6, or None"""
+    match = re.match(r'^python(\d+\.\d+)$', runtime or '')
+    return match.group(1) if match else None
+
+
+def compile_bytecode(build_dir, python, version):
+    """Byte-compile build_dir with python, which must be of the given major.minor version"""
+    args = [python, '-m', 'compileall', '-q']
+    if tuple(int(v) for v in version.split('.')) >= (3, 7):
+        # Parallel, and without source mtimes in the byte code so reproducible builds stay reproducible
+        args += ['-j', '0', '--invalidation-mode', 'unchecked-hash']
+    process = Popen(args + [build_dir], stdout=PIPE, stderr=PIPE)
+    stdout, stderr = process.communicate()
+    log.debug('compileall stdout: {}'.format(stdout))
+    log.debug('compileall stderr: {}'.format(stderr))
+    return process.returncode == 0
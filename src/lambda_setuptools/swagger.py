@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+
+import yaml
+from distutils import log
+from distutils.errors import DistutilsSetupError
+from jsonschema import ValidationError
+from swagger_spec_validator import SwaggerValidationError
+from swagger_spec_validator.validator20 import validate_spec
+
+# Bumped whenever what is cached changes, invalidating every cached specification
+CACHE_VERSION = '1'
+
+# Cached specifications kept, the most recently used ones
+CACHE_SIZE = 8
+
+# The libyaml loader is an order of magnitude faster, when PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+HTTP_METHODS = ('get', 'put', 'post', 'delete', 'options', 'head', 'patch')
+
+
+def parse_swagger(contents):
+    """
+    Parse a swagger specification, as JSON if it looks like JSON and else as YAML. What YAML has
+    and JSON hasn't (numeric response codes, dates, ...) becomes strings, as API Gateway gets JSON.
+    """
+    if contents.lstrip().startswith('{'):
+        try:
+            return json.loads(contents)
+        except ValueError:
+            pass
+    try:
+        swagger_dict = yaml.load(contents, Loader=YAML_LOADER)
+    except yaml.YAMLError:
+        raise DistutilsSetupError('Not a valid swagger definition or file path.')
+    return json.loads(json.dumps(swagger_dict, default=str))
+
+
+def operation_index(swagger_dict):
+    """Return {operationId: [(path, method)]} for every operation of swagger_dict"""
+    index = {}
+    for path, path_info in (swagger_dict.get('paths') or {}).items():
+        for method, method_info in path_info.items():
+            if method in HTTP_METHODS and isinstance(method_info, dict) and method_info.get('operationId'):
+                index.setdefault(method_info['operationId'], []).append((path, method))
+    return index
+
+
+def validate_swagger(swagger_dict):
+    if not isinstance(swagger_dict, dict):
+        raise DistutilsSetupError('Not a valid swagger definition or file path.')
+    try:
+        validate_spec(swagger_dict)
+    except (SwaggerValidationError, ValidationError, ValueError) as e:
+        raise DistutilsSetupError('Not a valid swagger definition. {}'.format(e))
+
+
+def load_swagger(value, cache_dir=None):
+    """
+    Return the validated swagger specification value (a dict, a path or the specification itself)
+    and its operation_index. Specifications read from text are cached in cache_dir by the hash of
+    the text, so an unchanged one is neither parsed as YAML nor validated again.
+    """
+    if isinstance(value, dict):
+        validate_swagger(value)
+        return value, operation_index(value)
+
+    contents = value
+    if os.path.exists(value):
+        with open(value, 'r') as f:
+            contents = f.read()
+    cache_path = None
+    if cache_dir is not None:
+        key = hashlib.sha256((CACHE_VERSION + '\0' + contents).encode('utf-8')).hexdigest()
+        cache_path = os.path.join(cache_dir, key + '.json')
+        try:
+            with open(cache_path, 'r') as f:
+                cached = json.load(f)
+            os.utime(cache_path, None)
+            log.info('swagger specification is unchanged, using the validated copy in {}'.format(cache_path))
+            return cached['spec'], dict((operation_id, [tuple(operation) for operation in operations])
+                                        for operation_id, operations in cached['index'].items())
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    swagger_dict = parse_swagger(contents)
+    validate_swagger(swagger_dict)
+    index = operation_index(swagger_dict)
+    if cache_path is not None:
+        _store(cache_dir, cache_path, {'spec': swagger_dict, 'index': index})
+    return swagger_dict, index
+
+
+def _store(cache_dir, cache_path, entry):
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.rename(cache_path + '.tmp', cache_path)
+    except (IOError, OSError) as e:
+        log.warn('not caching the swagger specification: {}'.format(e))
+        return
+    entries = sorted((os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith('.json')),
+                     key=os.path.getmtime, reverse=True)
+    for path in entries[CACHE_SIZE:]:
+        os.remove(path)
+
+
+def with_integration_uris(swagger_dict, index, uris):
+    """
+    Return a copy of swagger_dict in which the x-amazon-apigateway-integration of every operation
+    whose operationId is in uris has that uri. Only what is changed is copied, swagger_dict itself
+    is left untouched.
+    """
+    swagger_doc = dict(swagger_dict)
+    swagger_doc['paths'] = paths = dict(swagger_dict.get('paths') or {})
+    copied = set()
+    for operation_id, uri in uris.items():
+        for path, method in index.get(operation_id, []):
+            method_info = paths[path][method]
+            if 'x-amazon-apigateway-integration' not in method_info:
+                continue
+            if path not in copied:
+                paths[path] = dict(paths[path])
+                copied.add(path)
+            method_info = paths[path][method] = dict(method_info)
+            method_info['x-amazon-apigateway-integration'] = dict(method_info['x-amazon-apigateway-integration'],
+                                                                  uri=uri)
+    return swagger_doc
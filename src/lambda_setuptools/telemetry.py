@@ -0,0 +1,182 @@
+"""
+Per invocation telemetry for the handlers ldist generates when lambda_telemetry is set. This
+module is copied into the lambda package as is, so it must only use the standard library.
+
+Every invocation prints one line in CloudWatch embedded metric format (EMF), which CloudWatch
+Logs turns into metrics. validate_emf checks such lines locally:
+
+    python -m lambda_setuptools.telemetry < captured-output.log
+"""
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Not on Windows, where the lines are only ever validated
+    resource = None
+
+DEFAULT_NAMESPACE = 'lambda-setuptools'
+
+# The units CloudWatch accepts in EMF
+UNITS = ('Seconds', 'Microseconds', 'Milliseconds', 'Bytes', 'Kilobytes', 'Megabytes', 'Gigabytes', 'Terabytes',
+         'Bits', 'Kilobits', 'Megabits', 'Gigabits', 'Terabits', 'Percent', 'Count', 'Bytes/Second',
+         'Kilobytes/Second', 'Megabytes/Second', 'Gigabytes/Second', 'Terabytes/Second', 'Bits/Second',
+         'Kilobits/Second', 'Megabits/Second', 'Gigabits/Second', 'Terabits/Second', 'Count/Second', 'None')
+
+METRIC_UNITS = {
+    'ColdStart': 'Count',
+    'InitDuration': 'Milliseconds',
+    'Latency': 'Milliseconds',
+    'MaxRSSDelta': 'Kilobytes',
+    'RequestBytes': 'Bytes',
+    'ResponseBytes': 'Bytes',
+    'Errors': 'Count'
+}
+
+_settings = {'namespace': DEFAULT_NAMESPACE, 'payload_sizes': True}
+_cold = [True]
+
+
+def configure(namespace=DEFAULT_NAMESPACE, payload_sizes=True):
+    _settings['namespace'] = namespace
+    _settings['payload_sizes'] = payload_sizes
+
+
+def _max_rss_kib():
+    if resource is None:
+        return 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss // 1024 if sys.platform == 'darwin' else max_rss
+
+
+def _size(payload):
+    try:
+        return len(json.dumps(payload, default=str).encode('utf-8'))
+    except (TypeError, ValueError):
+        return None
+
+
+def emf_line(function_name, request_id, values, units, timestamp=None):
+    """Return values, a {metric: value} dict with the units in units, as one EMF log line"""
+    record = {
+        '_aws': {
+            'Timestamp': int((timestamp if timestamp is not None else time.time()) * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': _settings['namespace'],
+                'Dimensions': [['FunctionName']],
+                'Metrics': [{'Name': name, 'Unit': units[name]} for name in sorted(values)]
+            }]
+        },
+        'FunctionName': function_name
+    }
+    if request_id is not None:
+        record['RequestId'] = request_id
+    record.update(values)
+    return json.dumps(record, sort_keys=True)
+
+
+def instrument(function_name, resolve):
+    """
+    Return a handler that calls the handler returned by resolve, the first call of which imports
+    the handler's module, and prints the metrics of every invocation
+    """
+    def handler(event, context):
+        cold = _cold[0]
+        _cold[0] = False
+        max_rss_before = _max_rss_kib()
+        start = time.time()
+        resolved = None
+        error = True
+        try:
+            target = resolve()
+            resolved = time.time()
+            result = target(event, context)
+            error = False
+            return result
+        finally:
+            end = time.time()
+            if resolved is None:
+                # Importing the handler's module failed
+                resolved = end
+            try:
+                values = {
+                    'ColdStart': 1 if cold else 0,
+                    'Latency': (end - resolved) * 1000,
+                    'MaxRSSDelta': _max_rss_kib() - max_rss_before,
+                    'Errors': 1 if error else 0
+                }
+                if cold:
+                    values['InitDuration'] = (resolved - start) * 1000
+                if _settings['payload_sizes']:
+                    payloads = [('RequestBytes', event)]
+                    if not error:
+                        payloads.append(('ResponseBytes', result))
+                    for name, payload in payloads:
+                        size = _size(payload)
+                        if size is not None:
+                            values[name] = size
+                sys.stdout.write(emf_line(function_name, getattr(context, 'aws_request_id', None), values,
+                                          METRIC_UNITS, end) + '\n')
+            except Exception:
+                # Telemetry must never be the reason an invocation fails
+                pass
+
+    return handler
+
+
+def validate_emf(line):
+    """Return the problems that would keep CloudWatch from extracting metrics from line, if any"""
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        return ['not JSON: {}'.format(e)]
+    if not isinstance(record, dict):
+        return ['not a JSON object']
+    metadata = record.get('_aws')
+    if not isinstance(metadata, dict):
+        return ['no _aws object']
+    errors = []
+    if not isinstance(metadata.get('Timestamp'), int):
+        errors.append('_aws.Timestamp must be milliseconds since the epoch')
+    directives = metadata.get('CloudWatchMetrics')
+    if not isinstance(directives, list) or not directives:
+        return errors + ['_aws.CloudWatchMetrics must be a non empty list']
+    for i, directive in enumerate(directives):
+        where = '_aws.CloudWatchMetrics[{}]'.format(i)
+        if not isinstance(directive.get('Namespace'), str) or not directive['Namespace']:
+            errors.append('{}.Namespace must be a non empty string'.format(where))
+        for dimension_set in directive.get('Dimensions', []):
+            if len(dimension_set) > 30:
+                errors.append('{}.Dimensions has more than 30 dimensions in a set'.format(where))
+            for dimension in dimension_set:
+                if not isinstance(record.get(dimension), str):
+                    errors.append('dimension {} must be a string member of the record'.format(dimension))
+        metrics = directive.get('Metrics')
+        if not isinstance(metrics, list) or len(metrics) > 100:
+            errors.append('{}.Metrics must be a list of at most 100 metrics'.format(where))
+            continue
+        for metric in metrics:
+            name = metric.get('Name')
+            if not isinstance(record.get(name), (int, float)) or isinstance(record.get(name), bool):
+                errors.append('metric {} must be a number member of the record'.format(name))
+            if metric.get('Unit', 'None') not in UNITS:
+                errors.append('metric {} has unknown unit {}'.format(name, metric.get('Unit')))
+    return errors
+
+
+def main(lines):
+    """Validate the EMF lines among lines, returning the number of invalid ones"""
+    invalid = 0
+    for number, line in enumerate(lines, 1):
+        if '"_aws"' not in line:
+            continue
+        errors = validate_emf(line.strip())
+        for error in errors:
+            sys.stderr.write('line {}: {}\n'.format(number, error))
+        invalid += 1 if errors else 0
+    return invalid
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main(sys.stdin) else 0)
@@ -0,0 +1,138 @@
+import base64
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import textwrap
+import zipfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, 'src')
+sys.path.insert(0, SRC)
+# The in-memory AWS stand-in of the benchmarks
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+
+def _record_hash(data):
+    return 'sha256=' + base64.urlsafe_b64encode(hashlib.sha256(data).digest()).rstrip(b'=').decode('ascii')
+
+
+def make_wheel(directory, name, version, files):
+    """Write a pure wheel of name holding files, {path: text}, and return its path"""
+    dist_info = '{}-{}.dist-info'.format(name, version)
+    files = dict(files)
+    files[dist_info + '/METADATA'] = 'Metadata-Version: 2.1\nName: {}\nVersion: {}\n'.format(name, version)
+    files[dist_info + '/WHEEL'] = 'Wheel-Version: 1.0\nGenerator: tests\nRoot-Is-Purelib: true\nTag: py3-none-any\n'
+    record = []
+    path = os.path.join(directory, '{}-{}-py3-none-any.whl'.format(name, version))
+    with zipfile.ZipFile(path, 'w') as whl:
+        for filename in sorted(files):
+            data = files[filename].encode('utf-8')
+            whl.writestr(filename, data)
+            record.append('{},{},{}'.format(filename, _record_hash(data), len(data)))
+        record.append('{}/RECORD,,'.format(dist_info))
+        whl.writestr(dist_info + '/RECORD', '\n'.join(record) + '\n')
+    return path
+
+
+SETUP_TEMPLATE = '''from setuptools import setup
+
+setup(
+    name='demo-proj',
+    version='0.1',
+    packages=['demo'],
+    install_requires={install_requires!r},
+    lambda_function={lambda_functions!r},
+    lambda_config={lambda_config!r}
+)
+'''
+
+
+class Project(object):
+    def __init__(self, root, wheelhouse):
+        self.root = root
+        self.wheelhouse = wheelhouse
+
+    def write_setup(self, install_requires=('foo',), lambda_config=None):
+        self.write('setup.py', SETUP_TEMPLATE.format(install_requires=list(install_requires),
+                                                     lambda_functions=['demo.handler.handle:handler',
+                                                                       'demo.other.other:other'],
+                                                     lambda_config=lambda_config))
+
+    def write(self, relpath, text):
+        path = os.path.join(self.root, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(textwrap.dedent(text))
+
+    def ldist(self, *args, **kwargs):
+        """
+        Run setup.py ldist, from the wheelhouse (with --wheelhouse, unless wheelhouse=False, or
+        else by pip) so nothing is fetched, and return the manifest
+        """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [SRC, env.get('PYTHONPATH')]))
+        env['PIP_NO_INDEX'] = '1'
+        env['PIP_FIND_LINKS'] = self.wheelhouse
+        args = list(args)
+        if kwargs.get('wheelhouse', True):
+            args = ['--wheelhouse', self.wheelhouse] + args
+        process = subprocess.Popen([sys.executable, 'setup.py', '-q', 'ldist'] + args, cwd=self.root, env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, _ = process.communicate()
+        assert process.returncode == 0, output.decode('utf-8', 'replace')
+        with open(os.path.join(self.root, 'dist', 'demo-proj-0.1.manifest.json')) as f:
+            return json.load(f)
+
+    def touch(self, relpath):
+        """Give relpath a new modification time, changing the wheel but not what it holds"""
+        path = os.path.join(self.root, relpath)
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+    def dist(self, name='demo-proj-0.1.zip'):
+        return zipfile.ZipFile(os.path.join(self.root, 'dist', name))
+
+    def layers(self):
+        """The names of the layer packages in dist"""
+        return set(name for name in os.listdir(os.path.join(self.root, 'dist')) if '-layer-' in name and name.endswith('.zip'))
+
+
+@pytest.fixture
+def project(tmpdir):
+    """
+    A project whose demo.handler imports foo, a dependency vendoring a shared library in
+    foo.libs like numpy does, and whose demo.other imports nothing
+    """
+    try:
+        from importlib.metadata import entry_points
+        commands = entry_points(group='distutils.commands')
+    except (ImportError, TypeError):
+        pytest.skip('needs Python 3.10 or later')
+    if 'ldist' not in [command.name for command in commands]:
+        pytest.skip('lambda_setuptools must be installed (pip install -e .) for setup.py to know ldist')
+    root = str(tmpdir.mkdir('project'))
+    wheelhouse = str(tmpdir.mkdir('wheelhouse'))
+    make_wheel(wheelhouse, 'foo', '1.0', {
+        'foo/__init__.py': 'VALUE = 1\n',
+        'foo.libs/libfoo-1a2b3c.so': 'not really a shared library\n'
+    })
+    project = Project(root, wheelhouse)
+    project.write_setup()
+    project.write('demo/__init__.py', '')
+    project.write('demo/handler.py', '''
+        import foo
+
+
+        def handle(event, context):
+            return foo.VALUE
+    ''')
+    project.write('demo/other.py', '''
+        def other(event, context):
+            return 2
+    ''')
+    return project
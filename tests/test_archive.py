@@ -0,0 +1,64 @@
+import os
+import shutil
+import subprocess
+import zipfile
+
+from lambda_setuptools import archive
+from lambda_setuptools.archive import ZIP_DEFLATED, ZIP_STORED, ZipMember, write_zip
+
+
+def _write(directory, name, data, mode):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.chmod(path, mode)
+    return path
+
+
+def _check(zip_path, expected):
+    """Read zip_path back with zipfile, checking every CRC, and compare it to {arcname: (data, mode)}"""
+    with zipfile.ZipFile(zip_path) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == sorted(expected)
+        for info in zf.infolist():
+            data, mode = expected[info.filename]
+            assert zf.read(info) == data
+            assert info.external_attr >> 16 & 0o777 == mode
+    if shutil.which('unzip'):
+        process = subprocess.Popen(['unzip', '-tq', zip_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, _ = process.communicate()
+        assert process.returncode == 0, output.decode('utf-8', 'replace')
+
+
+def test_write_zip_round_trips_through_zipfile(tmpdir):
+    directory = str(tmpdir)
+    expected = {
+        'pkg/module.py': (b'print("hello")\n' * 200, 0o644),
+        'bin/tool': (b'#!/bin/sh\nexit 0\n', 0o755),
+        'pkg/lib.so': (os.urandom(4096), 0o755),
+        u'pkg/déjà.txt': (b'', 0o600),
+    }
+    members = [ZipMember(_write(directory, 'file{}'.format(i), data, mode), arcname)
+               for i, (arcname, (data, mode)) in enumerate(sorted(expected.items()))]
+    zip_path = os.path.join(directory, 'out.zip')
+    entries = write_zip(zip_path, members, workers=2)
+    compress_types = dict((entry.arcname, entry.compress_type) for entry in entries)
+    assert compress_types['pkg/module.py'] == ZIP_DEFLATED
+    assert compress_types['pkg/lib.so'] == ZIP_STORED
+    _check(zip_path, expected)
+
+
+def test_write_zip_writes_zip64_records_past_the_limits(tmpdir, monkeypatch):
+    # Lower the limits rather than writing 4 GiB or 65536 files
+    monkeypatch.setattr(archive, '_ZIP64_LIMIT', 100)
+    monkeypatch.setattr(archive, '_ZIP64_ENTRIES_LIMIT', 3)
+    directory = str(tmpdir)
+    expected = dict(('f{}.txt'.format(i), (('line {}\n'.format(i) * 30).encode('ascii'), 0o644)) for i in range(6))
+    expected['random.bin'] = (os.urandom(500), 0o755)
+    members = [ZipMember(_write(directory, arcname, data, mode), arcname)
+               for arcname, (data, mode) in sorted(expected.items())]
+    zip_path = os.path.join(directory, 'out.zip')
+    write_zip(zip_path, members, workers=1)
+    with open(zip_path, 'rb') as f:
+        assert b'PK\x06\x06' in f.read()
+    _check(zip_path, expected)
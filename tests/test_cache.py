@@ -0,0 +1,21 @@
+import os
+
+from lambda_setuptools.cache import remove_files
+
+
+def _touch(root, relpath):
+    path = os.path.join(root, relpath)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+
+
+def test_remove_files_removes_the_byte_code_of_removed_modules(tmpdir):
+    root = str(tmpdir)
+    for relpath in ('demo_proj_function.py', '__pycache__/demo_proj_function.cpython-311.pyc',
+                    '__pycache__/demo_proj_function.cpython-311.opt-1.pyc', '__pycache__/other.cpython-311.pyc',
+                    'demo/handler.py', 'demo/__pycache__/handler.cpython-311.pyc'):
+        _touch(root, relpath)
+    remove_files(root, ['demo_proj_function.py', 'demo/handler.py'])
+    assert os.listdir(os.path.join(root, '__pycache__')) == ['other.cpython-311.pyc']
+    assert not os.path.exists(os.path.join(root, 'demo'))
@@ -0,0 +1,21 @@
+from lambda_setuptools.clients import DEFAULT_MAX_POOL_CONNECTIONS, ClientFactory
+
+
+def _pool(client):
+    return client.meta.config.max_pool_connections
+
+
+def test_clients_are_recreated_for_a_larger_reservation():
+    factory = ClientFactory('key', 'secret')
+    client = factory.client('lambda', 'us-east-1')
+    assert _pool(client) == DEFAULT_MAX_POOL_CONNECTIONS
+    assert factory.client('lambda', 'us-east-1') is client
+
+    factory.reserve_connections(DEFAULT_MAX_POOL_CONNECTIONS * 4)
+    larger = factory.client('lambda', 'us-east-1')
+    assert larger is not client
+    assert _pool(larger) == DEFAULT_MAX_POOL_CONNECTIONS * 4
+
+    # A smaller reservation keeps the pool there is
+    factory.reserve_connections(DEFAULT_MAX_POOL_CONNECTIONS)
+    assert factory.client('lambda', 'us-east-1') is larger
@@ -0,0 +1,37 @@
+import json
+import subprocess
+import sys
+
+from lambda_setuptools import container
+
+HANDLER = '''import sys
+
+
+def handle(event, context):
+    loaded = sorted(name for name in sys.modules
+                    if name.split('.')[0] in ('setuptools', 'distutils', 'lambda_setuptools'))
+    if loaded:
+        raise RuntimeError('the container loaded {}'.format(', '.join(loaded)))
+    return context.get_remaining_time_in_millis()
+'''
+
+
+def test_containers_load_nothing_but_the_handler(tmpdir):
+    tmpdir.join('handler.py').write(HANDLER)
+    tmpdir.join('entry.py').write('from handler import handle\n')
+    job = {
+        'build_dir': str(tmpdir),
+        'entry_module': 'entry',
+        'module': 'handler',
+        'function_name': 'handle',
+        'events': [['one.json', {}], ['two.json', {}]],
+        'context_settings': {'function_name': 'handler'}
+    }
+    # Isolated from site-packages, like a runtime interpreter without setuptools
+    process = subprocess.Popen([sys.executable, '-I', container.__file__], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+    stdout, _ = process.communicate(json.dumps(job).encode('utf-8'))
+    assert process.returncode == 0
+    results = json.loads(stdout.decode('utf-8'))
+    assert results['errors'] == []
+    assert len(results['latencies']) == 2
@@ -0,0 +1,148 @@
+import copy
+
+from lambda_setuptools.ldeploy import PERMISSION_SID_PREFIX, describe_plan, lambda_config_changes, \
+    permission_statement_id, plan_lambda_function, plan_permissions
+
+ROLE = 'arn:aws:iam::123456789012:role/lambda'
+LAYER = 'arn:aws:lambda:us-east-1:123456789012:layer:demo-proj-dependencies:3'
+CODE_SHA256 = 'dGhlIGNvZGUgb2YgdGhlIGZ1bmN0aW9uIGl0c2VsZiE='
+
+# A function as ListFunctions describes it: a VpcConfig with its VpcId, layers as dicts with
+# their size, and no Environment at all as none was set
+DEPLOYED = {
+    'FunctionName': 'handler',
+    'FunctionArn': 'arn:aws:lambda:us-east-1:123456789012:function:handler',
+    'Runtime': 'python3.6',
+    'Role': ROLE,
+    'Handler': 'demo_proj_function.handle',
+    'CodeSize': 5120,
+    'Description': '',
+    'Timeout': 60,
+    'MemorySize': 128,
+    'LastModified': '2026-10-01T12:00:00.000+0000',
+    'CodeSha256': CODE_SHA256,
+    'Version': '$LATEST',
+    'VpcConfig': {'SubnetIds': ['subnet-2', 'subnet-1'], 'SecurityGroupIds': ['sg-1'], 'VpcId': 'vpc-1'},
+    'TracingConfig': {'Mode': 'PassThrough'},
+    'RevisionId': '9c6f5a6e-0000-4000-8000-000000000000',
+    'Layers': [{'Arn': LAYER, 'CodeSize': 2048}],
+    'PackageType': 'Zip',
+    'Architectures': ['x86_64'],
+    'EphemeralStorage': {'Size': 512}
+}
+
+# What ldeploy asks for: lambda_config plus the function's name, role, handler, code and layer
+CONFIG = {
+    'FunctionName': 'handler',
+    'Runtime': 'python3.6',
+    'Timeout': 60,
+    'MemorySize': 128,
+    'Publish': True,
+    'Role': ROLE,
+    'Handler': 'demo_proj_function.handle',
+    'Code': {'S3Bucket': 'bucket', 'S3Key': 'demo-proj-0.1.zip'},
+    'Layers': [LAYER],
+    'VpcConfig': {'SubnetIds': ['subnet-1', 'subnet-2'], 'SecurityGroupIds': ['sg-1']},
+    'Environment': {'Variables': {}}
+}
+
+
+def _with(settings, **changes):
+    settings = copy.deepcopy(settings)
+    settings.update(changes)
+    return settings
+
+
+def test_an_unchanged_function_is_left_alone():
+    assert lambda_config_changes(CONFIG, DEPLOYED) == {}
+    plan = plan_lambda_function(CONFIG, DEPLOYED, CODE_SHA256)
+    assert plan['action'] == 'unchanged'
+    assert describe_plan(plan) == 'handler: unchanged'
+
+
+def test_new_code_only_updates_the_code():
+    plan = plan_lambda_function(CONFIG, DEPLOYED, 'bmV3IGNvZGU=')
+    assert plan['action'] == 'update'
+    assert plan['code']
+    assert plan['configuration'] == {}
+
+
+def test_unknown_code_hash_updates_the_code():
+    assert plan_lambda_function(CONFIG, DEPLOYED, None)['code']
+
+
+def test_changed_settings_are_planned():
+    new_layer = LAYER[:-1] + '4'
+    config = _with(CONFIG, Layers=[new_layer], Environment={'Variables': {'STAGE': 'prod'}}, MemorySize=256)
+    plan = plan_lambda_function(config, DEPLOYED, CODE_SHA256)
+    assert plan['action'] == 'update'
+    assert not plan['code']
+    assert plan['configuration'] == {
+        'Layers': ([LAYER], [new_layer]),
+        'Environment': ({'Variables': {}}, {'Variables': {'STAGE': 'prod'}}),
+        'MemorySize': (128, 256)
+    }
+
+
+def test_vpc_settings_compare_without_order_or_vpc_id():
+    config = _with(CONFIG, VpcConfig={'SubnetIds': ['subnet-1'], 'SecurityGroupIds': ['sg-1']})
+    changes = lambda_config_changes(config, DEPLOYED)
+    assert changes == {'VpcConfig': ({'SubnetIds': ['subnet-1', 'subnet-2'], 'SecurityGroupIds': ['sg-1']},
+                                     {'SubnetIds': ['subnet-1'], 'SecurityGroupIds': ['sg-1']})}
+    # Functions outside a VPC are listed with empty ids
+    deployed = _with(DEPLOYED, VpcConfig={'SubnetIds': [], 'SecurityGroupIds': [], 'VpcId': ''})
+    config = dict((key, value) for key, value in CONFIG.items() if key != 'VpcConfig')
+    assert lambda_config_changes(config, deployed) == {}
+
+
+def test_missing_functions_are_created():
+    plan = plan_lambda_function(CONFIG, None, CODE_SHA256)
+    assert plan['action'] == 'create'
+
+
+SOURCE_ARN = 'arn:aws:execute-api:us-east-1:123456789012:newapi/prod/ANY/handler'
+
+
+def _statement(sid, source_arn):
+    """A statement as the function's resource policy (get_policy) has it"""
+    return {
+        'Sid': sid,
+        'Effect': 'Allow',
+        'Principal': {'Service': 'apigateway.amazonaws.com'},
+        'Action': 'lambda:InvokeFunction',
+        'Resource': 'arn:aws:lambda:us-east-1:123456789012:function:handler',
+        'Condition': {'ArnLike': {'AWS:SourceArn': source_arn}}
+    }
+
+
+def test_our_own_permission_is_kept():
+    add, remove = plan_permissions([_statement(permission_statement_id(SOURCE_ARN), SOURCE_ARN)], SOURCE_ARN)
+    assert (add, remove) == (False, [])
+
+
+def test_missing_permission_is_added():
+    assert plan_permissions([], SOURCE_ARN) == (True, [])
+
+
+def test_stale_permissions_of_the_stage_are_removed():
+    old_api_arn = 'arn:aws:execute-api:us-east-1:123456789012:oldapi/prod/ANY/handler'
+    statements = [
+        # What ldeploy added before statement ids were derived from the source ARN
+        _statement(PERMISSION_SID_PREFIX, 'arn:aws:execute-api:us-east-1:123456789012:newapi/prod/*/*'),
+        # For a REST API that has since been replaced
+        _statement(permission_statement_id(old_api_arn), old_api_arn)
+    ]
+    add, remove = plan_permissions(statements, SOURCE_ARN)
+    assert add
+    assert remove == sorted([PERMISSION_SID_PREFIX, permission_statement_id(old_api_arn)])
+
+
+def test_other_stages_and_foreign_statements_are_left_alone():
+    staging_arn = 'arn:aws:execute-api:us-east-1:123456789012:newapi/staging/ANY/handler'
+    statements = [
+        _statement(permission_statement_id(staging_arn), staging_arn),
+        _statement('my-own-permission', 'arn:aws:execute-api:us-east-1:123456789012:newapi/prod/*/*'),
+        _statement('api-gateway-executed-by-someone-else', SOURCE_ARN),
+        _statement(permission_statement_id(SOURCE_ARN), SOURCE_ARN)
+    ]
+    assert plan_permissions(statements, SOURCE_ARN) == (False, [])
@@ -0,0 +1,102 @@
+import json
+import os
+import sys
+
+from conftest import make_wheel
+
+
+def _top_levels(dist):
+    return set(name.split('/')[0] for name in dist.namelist())
+
+
+def test_split_functions_keep_vendored_libraries_when_pruning(project):
+    project.ldist('--split-functions')
+    with project.dist('demo-proj-0.1-handler.zip') as dist:
+        top_levels = _top_levels(dist)
+    assert {'foo', 'foo.libs', 'foo-1.0.dist-info'} <= top_levels
+    with project.dist('demo-proj-0.1-other.zip') as dist:
+        assert not {'foo', 'foo.libs'} & _top_levels(dist)
+
+
+def test_split_functions_keep_vendored_libraries_on_a_cache_hit(project):
+    project.ldist()
+    # The cached build directory has been pruned by the first build
+    project.ldist('--split-functions')
+    with project.dist('demo-proj-0.1-handler.zip') as dist:
+        assert {'foo', 'foo.libs'} <= _top_levels(dist)
+
+
+def test_reproducible_builds_do_not_depend_on_the_build_cache(project):
+    # A cache miss installs the project with pip, the rebuilt wheel is synced on the cache hit
+    first = project.ldist('--reproducible', wheelhouse=False)
+    project.touch('demo/handler.py')
+    second = project.ldist('--reproducible', wheelhouse=False)
+    assert first['files'] == second['files']
+    assert first['CodeSha256'] == second['CodeSha256']
+
+
+def _backdate_build_cache(project, hours):
+    path = os.path.join(project.root, 'build', 'ldist-demo-proj.cache.json')
+    with open(path) as f:
+        state = json.load(f)
+    state['resolved_at'] -= hours * 3600
+    with open(path, 'w') as f:
+        json.dump(state, f)
+
+
+def test_expired_build_cache_picks_up_new_releases(project):
+    project.ldist()
+    make_wheel(project.wheelhouse, 'foo', '1.1', {'foo/__init__.py': 'VALUE = 2\n'})
+    project.ldist()
+    with project.dist() as dist:
+        assert 'foo-1.0.dist-info/METADATA' in dist.namelist()
+    _backdate_build_cache(project, 25)
+    project.ldist()
+    with project.dist() as dist:
+        assert 'foo-1.1.dist-info/METADATA' in dist.namelist()
+        assert 'foo-1.0.dist-info/METADATA' not in dist.namelist()
+
+
+def test_layer_changes_with_the_installed_files_and_the_runtime(project):
+    project.ldist('--layer')
+    layers = project.layers()
+    project.ldist('--layer')
+    assert project.layers() == layers
+
+    # A rebuilt wheel of the same version
+    make_wheel(project.wheelhouse, 'foo', '1.0', {'foo/__init__.py': 'VALUE = 3\n'})
+    project.ldist('--layer', '--no-build-cache')
+    assert len(project.layers() - layers) == 1
+    layers = project.layers()
+
+    project.write_setup(lambda_config={'Runtime': 'python3.12'})
+    project.ldist('--layer')
+    assert len(project.layers() - layers) == 1
+
+
+def test_wheels_sharing_a_namespace_package_unpack_in_order(project):
+    for name in ('nsa', 'nsb'):
+        make_wheel(project.wheelhouse, name, '1.0', {
+            'ns/__init__.py': '# from {}\n'.format(name),
+            'ns/{}.py'.format(name): ''
+        })
+    project.write_setup(install_requires=['foo', 'nsa', 'nsb'])
+    project.ldist('--zip-workers', '4')
+    with project.dist() as dist:
+        assert {'ns/nsa.py', 'ns/nsb.py'} <= set(dist.namelist())
+        assert dist.read('ns/__init__.py') == b'# from nsb\n'
+
+
+def _runtime():
+    return 'python{}.{}'.format(*sys.version_info[:2])
+
+
+def test_byte_code_does_not_outlive_compile_pyc(project):
+    project.write_setup(lambda_config={'Runtime': _runtime()})
+    project.ldist('--no-prune', '--compile-pyc')
+    with project.dist() as dist:
+        assert any(name.startswith('foo/__pycache__/') for name in dist.namelist())
+    project.ldist('--no-prune')
+    with project.dist() as dist:
+        assert not [name for name in dist.namelist() if name.endswith('.pyc')]
+
@@ -0,0 +1,25 @@
+import sys
+
+from setuptools.dist import Distribution
+
+from lambda_setuptools.lprofile import LProfile
+
+
+def _profile(tmpdir, importtime):
+    tmpdir.join('handler.py').write('import csv\n\n\ndef handle(event, context):\n    return csv.QUOTE_ALL\n')
+    cmd = LProfile(Distribution({'name': 'demo', 'version': '0.1'}))
+    cmd.ensure_finalized()
+    return cmd._profile(sys.executable, importtime, str(tmpdir), 'handler', 'handler', 'handle')
+
+
+def test_imports_are_broken_down_by_module(tmpdir):
+    profile = _profile(tmpdir, True)
+    assert 'csv' in [module['module'] for module in profile['modules']]
+    assert profile['import_ms'] > 0
+
+
+def test_interpreters_without_importtime_still_measure_the_import(tmpdir):
+    profile = _profile(tmpdir, False)
+    assert profile['modules'] == []
+    assert profile['import_ms'] > 0
+    assert profile['max_rss_kib'] > 0
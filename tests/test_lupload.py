@@ -0,0 +1,69 @@
+from setuptools.dist import Distribution
+
+from fakeaws import FakeAWS, FakeS3
+from lambda_setuptools.clients import set_client_factory
+from lambda_setuptools.lupload import LUpload
+
+BUCKET = 'bucket'
+
+
+class _Factory(object):
+    def __init__(self, client):
+        self._client = client
+
+    def reserve_connections(self, count):
+        pass
+
+    def client(self, service_name, region=None):
+        return self._client
+
+
+class _ForbiddenHeadS3(FakeS3):
+    """An S3 answering HEAD like it does for credentials without s3:GetObject"""
+
+    def _HeadObject(self, params):
+        raise self._error('403', 'HeadObject', 'Forbidden')
+
+
+def _upload(s3, path, **options):
+    dist = Distribution({'name': 'demo', 'version': '0.1'})
+    set_client_factory(dist, _Factory(s3))
+    cmd = LUpload(dist)
+    cmd.access_key = 'test'
+    cmd.secret_access_key = 'test'
+    cmd.s3_bucket = BUCKET
+    for option, value in options.items():
+        setattr(cmd, option, value)
+    cmd.ensure_finalized()
+    cmd.upload(path, 'demo.zip')
+    return cmd.upload_skipped
+
+
+def _dist(tmpdir):
+    path = tmpdir.join('demo.zip')
+    path.write_binary(b'demo' * 100)
+    return str(path)
+
+
+def test_unchanged_objects_are_not_uploaded_again(tmpdir):
+    s3 = FakeS3(FakeAWS(latency=0), None)
+    path = _dist(tmpdir)
+    assert not _upload(s3, path)
+    assert _upload(s3, path)
+
+
+def test_forbidden_head_uploads_anyway(tmpdir):
+    aws = FakeAWS(latency=0)
+    assert not _upload(_ForbiddenHeadS3(aws, None), _dist(tmpdir))
+    assert (BUCKET, 'demo.zip') in aws.objects
+
+
+def test_changed_encryption_is_uploaded_again(tmpdir):
+    aws = FakeAWS(latency=0)
+    s3 = FakeS3(aws, None)
+    path = _dist(tmpdir)
+    assert not _upload(s3, path)
+    assert not _upload(s3, path, kms_key_id='1234abcd')
+    assert aws.objects[(BUCKET, 'demo.zip')]['Encryption']['SSEKMSKeyId'].endswith(':key/1234abcd')
+    assert _upload(s3, path, kms_key_id='1234abcd')
+    assert not _upload(s3, path, kms_key_id='5678efgh')
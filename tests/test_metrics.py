@@ -0,0 +1,33 @@
+import boto3
+from botocore.stub import Stubber
+
+from lambda_setuptools.metrics import Metrics
+
+
+def _lambda_client(metrics):
+    client = boto3.client('lambda', region_name='us-east-1', aws_access_key_id='test',
+                          aws_secret_access_key='test')
+    metrics.instrument_client(client)
+    return client
+
+
+def test_service_errors_are_counted():
+    metrics = Metrics()
+    client = _lambda_client(metrics)
+    with Stubber(client) as stubber:
+        stubber.add_client_error('get_function_configuration', service_error_code='TooManyRequestsException',
+                                 service_message='Rate exceeded', http_status_code=429)
+        stubber.add_response('get_function_configuration', {'FunctionName': 'handler'})
+        for _ in range(2):
+            try:
+                client.get_function_configuration(FunctionName='handler')
+            except client.exceptions.TooManyRequestsException:
+                pass
+
+    report = metrics.report()
+    stats = report['api_calls']['lambda.GetFunctionConfiguration']
+    assert stats['count'] == 2
+    assert stats['errors'] == 1
+    errors = [call['error'] for call in report['functions']['handler']]
+    assert errors[0].startswith('TooManyRequestsException')
+    assert errors[1] is None
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+from botocore.exceptions import ClientError
+
+from fakeaws import FakeAWS, FakeS3
+from lambda_setuptools import multipart
+from lambda_setuptools.multipart import MIN_PART_SIZE, upload_file
+
+BUCKET = 'bucket'
+
+
+class RecordingS3(FakeS3):
+    """A FakeS3 failing the parts in failures, {part number: [error code, ...]}, one error per attempt"""
+
+    def __init__(self, aws, failures=None):
+        super(RecordingS3, self).__init__(aws, None)
+        self.failures = failures or {}
+        self.attempts = {}
+        self.completed = None
+        self.aborted = False
+
+    def _UploadPart(self, params):
+        number = params['PartNumber']
+        self.attempts[number] = self.attempts.get(number, 0) + 1
+        if self.failures.get(number):
+            raise self._error(self.failures[number].pop(0), 'UploadPart')
+        return super(RecordingS3, self)._UploadPart(params)
+
+    def _CompleteMultipartUpload(self, params):
+        self.completed = params['MultipartUpload']['Parts']
+        return super(RecordingS3, self)._CompleteMultipartUpload(params)
+
+    def _AbortMultipartUpload(self, params):
+        self.aborted = True
+        return super(RecordingS3, self)._AbortMultipartUpload(params)
+
+
+@pytest.fixture
+def data_path(tmpdir, monkeypatch):
+    monkeypatch.setattr(multipart.time, 'sleep', lambda seconds: None)
+    path = tmpdir.join('dist.zip')
+    # Two and a half parts
+    path.write_binary(os.urandom(MIN_PART_SIZE * 5 // 2))
+    return str(path)
+
+
+def _upload(s3, path):
+    return upload_file(s3, path, BUCKET, 'dist.zip', extra_args={'Metadata': {'sha256': 'x'}},
+                       part_size=MIN_PART_SIZE, max_concurrency=3, retries=2)
+
+
+def test_large_files_are_uploaded_in_order(data_path):
+    aws = FakeAWS(latency=0)
+    s3 = RecordingS3(aws)
+    _upload(s3, data_path)
+    assert [part['PartNumber'] for part in s3.completed] == [1, 2, 3]
+    with open(data_path, 'rb') as f:
+        assert aws.objects[(BUCKET, 'dist.zip')]['Body'] == f.read()
+    assert aws.objects[(BUCKET, 'dist.zip')]['Metadata'] == {'sha256': 'x'}
+
+
+def test_transient_part_failures_are_retried(data_path):
+    aws = FakeAWS(latency=0)
+    s3 = RecordingS3(aws, {2: ['SlowDown', 'InternalError']})
+    _upload(s3, data_path)
+    assert s3.attempts == {1: 1, 2: 3, 3: 1}
+    with open(data_path, 'rb') as f:
+        assert aws.objects[(BUCKET, 'dist.zip')]['Body'] == f.read()
+
+
+def test_failed_uploads_are_aborted(data_path):
+    aws = FakeAWS(latency=0)
+    s3 = RecordingS3(aws, {2: ['InternalError'] * 3})
+    with pytest.raises(ClientError):
+        _upload(s3, data_path)
+    assert s3.attempts[2] == 3
+    assert s3.aborted
+    assert not aws.uploads
+    assert (BUCKET, 'dist.zip') not in aws.objects
+
+
+def test_permanent_errors_are_not_retried(data_path):
+    aws = FakeAWS(latency=0)
+    s3 = RecordingS3(aws, {2: ['AccessDenied']})
+    with pytest.raises(ClientError):
+        _upload(s3, data_path)
+    assert s3.attempts[2] == 1
+    assert s3.aborted
@@ -0,0 +1,113 @@
+import json
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from lambda_setuptools.scheduler import DeployScheduler, DeployState, Stage
+
+
+def _error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'UpdateFunctionCode')
+
+
+class FakeLambda(object):
+    """get_function_configuration answering from a list of configurations per function, the last one repeating"""
+
+    def __init__(self, configurations=None):
+        self._configurations = configurations or {}
+        self._lock = threading.Lock()
+        self.polls = {}
+
+    def get_function_configuration(self, FunctionName):
+        with self._lock:
+            self.polls[FunctionName] = self.polls.get(FunctionName, 0) + 1
+            configurations = self._configurations.get(FunctionName, [{}])
+            return configurations[min(self.polls[FunctionName], len(configurations)) - 1]
+
+
+def _scheduler(client, **kwargs):
+    kwargs.setdefault('poll_interval', 0.01)
+    kwargs.setdefault('max_poll_interval', 0.02)
+    return DeployScheduler(client, **kwargs)
+
+
+def test_conflicts_are_retried():
+    calls = []
+
+    def update():
+        calls.append(time.time())
+        if len(calls) < 3:
+            raise _error('ResourceConflictException')
+        return {'Version': '2'}
+
+    results, errors = _scheduler(FakeLambda()).run('deploy', [('fn', 'key', [Stage('code', update)], None)])
+    assert errors == {}
+    assert results == {'fn': {'Version': '2'}}
+    assert len(calls) == 3
+
+
+def test_other_errors_fail_only_their_function():
+    def broken():
+        raise _error('AccessDeniedException')
+
+    results, errors = _scheduler(FakeLambda()).run('deploy', [
+        ('broken', 'key', [Stage('permissions', broken, wait=False)], None),
+        ('fine', 'key', [Stage('permissions', lambda: {'ok': True}, wait=False)], None),
+    ])
+    assert results == {'fine': {'ok': True}}
+    assert list(errors) == ['broken']
+    assert errors['broken'].startswith('permissions failed: ')
+
+
+def test_waiting_does_not_hold_up_other_functions():
+    finished = {}
+    client = FakeLambda({'slow': [{'LastUpdateStatus': 'InProgress'}] * 20 + [{}]})
+
+    def stage(name):
+        def fn():
+            finished[name] = time.time()
+        return fn
+
+    _, errors = _scheduler(client, workers=1).run('deploy', [
+        ('slow', 'key', [Stage('code', stage('slow'))], None),
+        ('fast', 'key', [Stage('code', stage('fast'))], None),
+    ])
+    assert errors == {}
+    assert finished['fast'] < finished['slow']
+
+
+def test_gives_up_waiting_after_the_timeout():
+    client = FakeLambda({'stuck': [{'State': 'Pending'}]})
+    _, errors = _scheduler(client, timeout=0.1).run('deploy', [('stuck', 'key', [Stage('code', lambda: None)], None)])
+    assert 'gave up waiting' in errors['stuck']
+
+
+def test_failed_runs_are_resumed_from_the_state_file(tmpdir):
+    path = str(tmpdir.join('state.json'))
+
+    def broken():
+        raise _error('AccessDeniedException')
+
+    stages = [Stage('code', lambda: None), Stage('configuration', broken)]
+    _, errors = _scheduler(FakeLambda(), state=DeployState(path)).run('deploy', [('fn', 'key', stages, None)])
+    assert list(errors) == ['fn']
+    state = DeployState(path)
+    assert state.pending('deploy', 'fn', 'key') == ['configuration']
+    assert state.pending('deploy', 'fn', 'other key') == []
+
+    stages = [Stage(name, lambda: None) for name in state.pending('deploy', 'fn', 'key')]
+    _, errors = _scheduler(FakeLambda(), state=state).run('deploy', [('fn', 'key', stages, None)])
+    assert errors == {}
+    assert not tmpdir.join('state.json').exists()
+
+
+def test_functions_without_stages_are_forgotten(tmpdir):
+    path = str(tmpdir.join('state.json'))
+    with open(path, 'w') as f:
+        json.dump({'deploy': {'fn': {'key': 'old', 'stages': ['code'], 'done': []},
+                              'other': {'key': 'old', 'stages': ['code'], 'done': []}}}, f)
+    results, errors = _scheduler(FakeLambda(), state=DeployState(path)).run('deploy', [('fn', 'new', [], 'unchanged')])
+    assert (results, errors) == ({'fn': 'unchanged'}, {})
+    with open(path) as f:
+        assert json.load(f) == {'deploy': {'other': {'key': 'old', 'stages': ['code'], 'done': []}}}
@@ -0,0 +1,74 @@
+import copy
+
+from lambda_setuptools import swagger
+from lambda_setuptools.swagger import load_swagger, with_integration_uris
+
+SPEC = '''
+swagger: "2.0"
+info:
+  title: demo
+  version: "1.0"
+paths:
+  /handler:
+    get:
+      operationId: handler
+      responses:
+        200:
+          description: OK
+      x-amazon-apigateway-integration:
+        type: aws_proxy
+        httpMethod: POST
+        uri: placeholder
+  /other:
+    post:
+      operationId: other
+      responses:
+        200:
+          description: OK
+'''
+
+
+def _count_validations(monkeypatch):
+    calls = []
+    validate_spec = swagger.validate_spec
+
+    def counting_validate_spec(spec):
+        calls.append(spec)
+        return validate_spec(spec)
+    monkeypatch.setattr(swagger, 'validate_spec', counting_validate_spec)
+    return calls
+
+
+def test_cached_specifications_are_not_validated_again(tmpdir, monkeypatch):
+    calls = _count_validations(monkeypatch)
+    path = tmpdir.join('swagger.yaml')
+    path.write(SPEC)
+    cache_dir = str(tmpdir.join('cache'))
+
+    first, first_index = load_swagger(str(path), cache_dir)
+    assert len(calls) == 1
+    second, second_index = load_swagger(str(path), cache_dir)
+    assert len(calls) == 1
+    assert second == first
+    assert second_index == first_index == {'handler': [('/handler', 'get')], 'other': [('/other', 'post')]}
+
+    path.write(SPEC.replace('title: demo', 'title: changed'))
+    load_swagger(str(path), cache_dir)
+    assert len(calls) == 2
+
+
+def test_integration_uris_leave_the_specification_untouched(tmpdir):
+    spec, index = load_swagger(SPEC, str(tmpdir))
+    before = copy.deepcopy(spec)
+    uri = 'arn:aws:apigateway:us-east-1:lambda:path/2015-03-31/functions/handler/invocations'
+
+    doc = with_integration_uris(spec, index, {'handler': uri, 'other': uri})
+    assert spec == before
+    assert doc['paths']['/handler']['get']['x-amazon-apigateway-integration']['uri'] == uri
+    # Operations without an integration are not given one, and are shared rather than copied
+    assert 'x-amazon-apigateway-integration' not in doc['paths']['/other']['post']
+    assert doc['paths']['/other'] is spec['paths']['/other']
+
+    # The cached copy is as it was, too
+    cached, _ = load_swagger(SPEC, str(tmpdir))
+    assert cached == before